@@ -1,21 +1,29 @@
 # hybrid_agent.py
+import time
+_import_started = time.perf_counter()  # отсчёт времени до готовности (preload_models)
+
 import asyncio, os, websockets
-from dataclasses import dataclass
-from typing import Any, Literal, Optional, Dict, List
+from contextlib import nullcontext
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Literal, Optional, Dict, List
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph, START, END
-from llm_module import LLMManager
-import time
+from llm_module import Classification, LLMManager, classification_prompt
 import json
-from mqtt_tools import tools, execute_tool, init_mqtt
+from mqtt_tools import tools, execute_tool, init_mqtt, tool_flight
+from ws_pool import WSConnectionPool
+from ws_protocol import FLAG_FINAL, FramedRequest, MsgType, ServerRequest, is_framed, select_subprotocol, serve_framed
+from scheduler import RequestScheduler
+from speculation import Speculation, get_speculation_stats
+from sentence_splitter import SentenceBuffer
+from llm_cache import LLMCache, make_fingerprint
+from metrics import metrics
+from deadline import CANNED_REPLY, LLM_MIN_BUDGET, Deadline, DeadlineExceeded, within
 import re
-import hashlib
 
 # Импортируем оптимизированную систему парсинга
 from improved_tool_parser import OptimizedToolParser, ToolCall
 
 load_dotenv()
-init_mqtt()
 
 # Создаем глобальный экземпляр парсера
 tool_parser = OptimizedToolParser()
@@ -23,36 +31,22 @@ tool_parser = OptimizedToolParser()
 # Настройки производительности
 PERFORMANCE_MODE = os.getenv("PERFORMANCE_MODE", "balanced").lower()  # fast, balanced, accurate
 USE_LLM_FALLBACK = os.getenv("USE_LLM_FALLBACK", "true").lower() == "true"
+# Потоковое STT по мере поступления аудио и спекулятивный разбор промежуточных гипотез
+STT_STREAMING = os.getenv("STT_STREAMING", "true").lower() == "true"
+SPECULATIVE_PARSING = os.getenv("SPECULATIVE_PARSING", "true").lower() == "true"
+# Потоковая генерация LLM с озвучиванием по предложениям (для клиентов, умеющих принимать поток)
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").lower() == "true"
+# Команды, разобранные напрямую, выполняются без LangGraph (STT → разбор → инструмент → TTS)
+FAST_PATH = os.getenv("FAST_PATH", "true").lower() == "true"
+# В режиме balanced ответ LLM начинается параллельно с LLM-классификацией неоднозначной фразы
+PARSE_RACE = os.getenv("PARSE_RACE", "true").lower() == "true"
+# Неоднозначная - у прямого разбора есть зацепка (ключевое слово), но меньше порога уверенности
+PARSE_RACE_MIN_CONFIDENCE = float(os.getenv("PARSE_RACE_MIN_CONFIDENCE", "0.3"))
 CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD", "0.4"))
 
 # Устанавливаем порог уверенности
 tool_parser.set_confidence_threshold(CONFIDENCE_THRESHOLD)
 
-class PerformanceMonitor:
-    def __init__(self):
-        self.timings = {}
-        self.enabled = os.getenv("PERF_MONITOR", "true").lower() == "true"
-        self.stats = {"total_requests": 0, "tool_calls": 0, "llm_calls": 0, "direct_parse": 0}
-    
-    def start(self, phase: str):
-        if self.enabled:
-            self.timings[f"{phase}_start"] = time.perf_counter()
-    
-    def end(self, phase: str):
-        if self.enabled and f"{phase}_start" in self.timings:
-            duration = time.perf_counter() - self.timings[f"{phase}_start"]
-            print(f"[PERF] {phase}: {duration:.2f}s")
-            return duration
-    
-    def log_stat(self, stat_name: str):
-        if stat_name in self.stats:
-            self.stats[stat_name] += 1
-    
-    def get_stats(self):
-        return self.stats.copy()
-
-perf = PerformanceMonitor()
-
 @dataclass
 class AudioMsg:
     raw: bytes
@@ -71,47 +65,179 @@ class AgentState:
     # Новые поля для отслеживания
     parse_method: Optional[str] = None  # direct, llm_assisted, llm_only
     confidence: Optional[float] = None
+    # Форматы аудио, которые принимает клиент (из hello), в порядке предпочтения
+    audio_formats: Optional[List[str]] = None
+    # Комната/подключение - для честного распределения стадий между клиентами
+    site_id: Optional[str] = None
+    # Потоковая сессия STT, начатая во время записи, и спекулятивные вызовы инструментов
+    stt_stream: Optional[Any] = None
+    speculation: Optional[Any] = None
+    # Приёмник аудио для потоковой отдачи клиенту и признак, что ответ уже озвучен
+    audio_sink: Optional[Any] = None
+    audio_streamed: bool = False
+    # WebSocket клиента, которому аудио TTS пересылается по мере синтеза (hello audio_relay)
+    audio_relay: Optional[Any] = None
+    # Ответ LLM, начатый параллельно с классификацией (RacedReply)
+    raced_reply: Optional[Any] = None
+    # Срок обработки фразы (Deadline): узлы укладываются в него или деградируют
+    deadline: Optional[Any] = None
 
 # WebSocket настройки
 STT_WS_HOST = os.getenv("STT_WS_HOST", "localhost") 
 STT_WS_PORT = int(os.getenv("STT_WS_PORT", 8778))
 TTS_WS_HOST = os.getenv("TTS_WS_HOST", "localhost")
 TTS_WS_PORT = int(os.getenv("TTS_WS_PORT", 8777))
+# Форматы ответа для клиентов, не приславших hello (старые клиенты ждут WAV)
+DEFAULT_AUDIO_FORMATS = [fmt.strip() for fmt in os.getenv("MAGUS_AUDIO_FORMATS", "wav").split(",") if fmt.strip()]
+
+# Постоянные соединения к STT/TTS вместо нового рукопожатия на каждую фразу
+stt_pool = WSConnectionPool("stt", f"ws://{STT_WS_HOST}:{STT_WS_PORT}")
+tts_pool = WSConnectionPool("tts", f"ws://{TTS_WS_HOST}:{TTS_WS_PORT}")
+
+# Очереди по подключениям и лимиты параллелизма для STT/LLM/TTS
+scheduler = RequestScheduler()
 
-processing_lock = asyncio.Lock()
+# Простой системный промпт для разговора
+CONVERSATION_SYSTEM_PROMPT = """Ты дружелюбный голосовой помощник. 
+Отвечай кратко и естественно на русском языке.
+Если не понимаешь команду, честно скажи об этом и предложи помощь."""
+
+# Промпт LLM-классификации неоднозначных фраз (коды меток вместо слов)
+CLASSIFICATION_PROMPT = classification_prompt(tool_parser.intent_labels)
 
-# Кэш для LLM
-llm_manager = LLMManager()
-llm_cache = {}
+# Кэш для LLM: переживает перезапуск, сбрасывается при смене модели или промптов.
+# Модель загружается в preload_models вместе с остальными прогревами
+llm_manager = LLMManager(preload=False)
+llm_cache = LLMCache(make_fingerprint(
+    llm_manager.get_provider_info(), llm_manager.temperature,
+    CONVERSATION_SYSTEM_PROMPT, CLASSIFICATION_PROMPT,
+))
 
-def get_cache_key(prompt: str, system_prompt: str) -> str:
-    return hashlib.md5(f"{system_prompt}|{prompt}".encode()).hexdigest()
+def has_cached_response(prompt: str, system_prompt: str) -> bool:
+    return llm_cache.contains(prompt, system_prompt)
 
 def get_cached_response(prompt: str, system_prompt: str) -> Optional[str]:
-    cache_key = get_cache_key(prompt, system_prompt)
-    return llm_cache.get(cache_key)
+    return llm_cache.get(prompt, system_prompt)
 
-def cache_response(prompt: str, system_prompt: str, response: str):
-    cache_key = get_cache_key(prompt, system_prompt)
-    llm_cache[cache_key] = response
-    if len(llm_cache) > 50:  # Уменьшили размер кэша для экономии памяти
-        oldest_key = next(iter(llm_cache))
-        del llm_cache[oldest_key]
+def cache_response(prompt: str, system_prompt: str, response: str, elapsed: float = 0.0):
+    llm_cache.put(prompt, system_prompt, response, elapsed)
 
-# STT и TTS клиенты (без изменений)
+# STT и TTS клиенты через пул соединений
+@metrics.timed("stt", kind="call")
 async def stt_vosk(audio: AudioMsg) -> str:
     print(f"[LOG] [STT] Отправка аудио ({len(audio.raw)} байт)")
+
+    async def request(ws, request_id: int) -> str:
+        if isinstance(ws, FramedRequest):
+            await ws.send(MsgType.REQUEST, {"sample_rate": audio.sr})
+            await ws.send(MsgType.AUDIO, payload=audio.raw)
+            await ws.send(MsgType.END)
+            return await recv_stt_text(ws)
+        await ws.send(audio.raw)
+        return await ws.recv()
+
     try:
-        async with websockets.connect(f"ws://{STT_WS_HOST}:{STT_WS_PORT}", max_size=8*2**20) as ws:
-            await ws.send(audio.raw)
-            resp = await ws.recv()
-            if isinstance(resp, str) and not resp.startswith("ERROR"):
-                return resp
-            raise RuntimeError(f"STT error: {resp}")
+        resp = await stt_pool.request(request)
+        if isinstance(resp, str) and not resp.startswith("ERROR"):
+            return resp
+        raise RuntimeError(f"STT error: {resp}")
     except Exception as e:
         print(f"[ERROR] STT error: {e}")
         raise
 
+async def recv_stt_text(request: FramedRequest, on_partial=None) -> str:
+    """magus.v1: кадры TEXT до окончательного (FLAG_FINAL), промежуточные - в on_partial"""
+    while True:
+        frame = await request.recv()
+        if frame.type == MsgType.ERROR:
+            raise RuntimeError(f"STT error: {frame.headers.get('message')}")
+        if frame.type != MsgType.TEXT:
+            continue
+        text = frame.payload.decode("utf-8")
+        if frame.flags & FLAG_FINAL:
+            return text
+        if on_partial:
+            on_partial(text)
+
+@metrics.timed("tool", kind="call")
+async def run_tool(tool_name: str, tool_args: Dict[str, Any]) -> str:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, execute_tool, tool_name, tool_args)
+
+class UtteranceStream:
+    """
+    Отправляет фразу в STT по кускам, пока пользователь ещё говорит.
+    Промежуточные гипотезы передаются в Speculation, финальный текст - в stt_node.
+    """
+
+    def __init__(self, sample_rate: int = 16000):
+        self.sample_rate = sample_rate
+        self.chunks: List[bytes] = []
+        self.closed = False
+        self.speculation = Speculation(tool_parser, run_tool) if SPECULATIVE_PARSING else None
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(stt_pool.request(self._session))
+
+    def feed(self, chunk: bytes):
+        self.chunks.append(chunk)
+        self._updated.set()
+
+    def close(self):
+        self.closed = True
+        self._updated.set()
+
+    def cancel(self):
+        self._task.cancel()
+        if self.speculation:
+            self.speculation.discard()
+
+    async def _session(self, ws, request_id: int) -> str:
+        framed = isinstance(ws, FramedRequest)
+        if framed:
+            await ws.send(MsgType.REQUEST, {"sample_rate": self.sample_rate, "partials": self.speculation is not None})
+            reader = asyncio.create_task(recv_stt_text(ws, self.speculation.observe if self.speculation else None))
+        else:
+            await ws.send(json.dumps({"type": "stream_begin", "sample_rate": self.sample_rate}))
+            reader = asyncio.create_task(self._read(ws))
+        try:
+            # При повторе на новом соединении аудио отправляется с начала
+            sent = 0
+            while True:
+                while sent < len(self.chunks):
+                    if framed:
+                        await ws.send(MsgType.AUDIO, payload=self.chunks[sent])
+                    else:
+                        await ws.send(self.chunks[sent])
+                    sent += 1
+                if self.closed:
+                    break
+                self._updated.clear()
+                await self._updated.wait()
+            await (ws.send(MsgType.END) if framed else ws.send(json.dumps({"type": "stream_end"})))
+            return await reader
+        finally:
+            if not reader.done():
+                reader.cancel()
+
+    async def _read(self, ws) -> str:
+        while True:
+            message = await ws.recv()
+            if not (isinstance(message, str) and message.startswith('{')):
+                raise RuntimeError(f"STT error: {message}")
+            data = json.loads(message)
+            if data.get("type") == "final":
+                return data.get("text", "")
+            if data.get("type") == "partial" and self.speculation:
+                self.speculation.observe(data.get("text", ""))
+
+    async def finish(self) -> str:
+        """Финальный текст; при сбое потока - обычное распознавание всей фразы"""
+        try:
+            return await self._task
+        except Exception as e:
+            print(f"[ERROR] Потоковое STT не удалось ({e}), распознаю целиком")
+            return await stt_vosk(AudioMsg(b"".join(self.chunks), sr=self.sample_rate))
+
 def extract_tts_text(text: str) -> str:
     if not isinstance(text, str):
         text = str(text)
@@ -137,55 +263,176 @@ def extract_tts_text(text: str) -> str:
             pass
     return text.strip()
 
-async def tts_client(text: str) -> bytes:
+@metrics.timed("tts", kind="call")
+async def tts_client(text: str, formats: Optional[List[str]] = None) -> bytes:
     text = extract_tts_text(text)
     print(f"[LOG] [TTS] Синтез: {text[:100]}...")
+    formats = formats or DEFAULT_AUDIO_FORMATS
+
+    async def request(ws, request_id: int) -> bytes:
+        if isinstance(ws, FramedRequest):
+            return await request_framed(ws)
+        await ws.send(json.dumps({"text": text, "formats": formats, "id": request_id}, ensure_ascii=False))
+        resp = await ws.recv()
+        if not (isinstance(resp, str) and resp.startswith('{')):
+            return resp
+        # Сервер присылает JSON-заголовок с id запроса, затем само аудио
+        header = json.loads(resp)
+        if header.get("id") != request_id:
+            raise RuntimeError(f"TTS ответ на чужой запрос: {header.get('id')} != {request_id}")
+        audio = await ws.recv()
+        print(f"[LOG] [TTS] Формат ответа: {header.get('format')}, {len(audio)} байт")
+        return audio
+
+    async def request_framed(ws: FramedRequest):
+        # AUDIO_START, кадры AUDIO, END потока, END ответа; BUSY/ERROR - строкой, как в старом протоколе
+        await ws.send(MsgType.REQUEST, {"text": text, "formats": formats})
+        header, chunks = {}, []
+        while True:
+            frame = await ws.recv()
+            if frame.type == MsgType.AUDIO_START:
+                header = frame.headers
+            elif frame.type == MsgType.AUDIO:
+                chunks.append(frame.payload)
+            elif frame.type == MsgType.END and frame.stream_id == 0:
+                break
+            elif frame.type in (MsgType.ERROR, MsgType.BUSY):
+                return frame.headers.get("message", frame.type.name)
+        audio = b"".join(chunks)
+        print(f"[LOG] [TTS] Формат ответа: {header.get('format')}, {len(audio)} байт")
+        return audio
+
     try:
-        async with websockets.connect(f"ws://{TTS_WS_HOST}:{TTS_WS_PORT}", max_size=8*2**20) as ws:
-            await ws.send(text)
-            resp = await ws.recv()
-            if isinstance(resp, bytes):
-                return resp
-            raise RuntimeError(f"TTS error: {resp}")
+        resp = await tts_pool.request(request)
+        if isinstance(resp, bytes):
+            return resp
+        raise RuntimeError(f"TTS error: {resp}")
     except Exception as e:
         print(f"[ERROR] TTS error: {e}")
         raise
 
+class ClientGone(Exception):
+    """Клиент отключился во время пересылки: пул TTS не должен принять это за обрыв своего соединения"""
+
+@metrics.timed("tts_relay", kind="call")
+async def tts_relay(text: str, reply: "ClientReply") -> bool:
+    """
+    Пересылает клиенту PCM-фреймы потокового синтеза по мере их прихода от TTS
+    (reply.relay_begin, relay_frame, relay_end).
+    Следующий фрейм читается из TTS только после того, как клиент принял
+    предыдущий, поэтому в памяти агента ответ целиком не оказывается.
+    Возвращает False, если до клиента ничего не ушло (можно синтезировать обычным путём).
+    """
+    text = extract_tts_text(text)
+    start_time = time.perf_counter()
+    relay = {"begun": False, "bytes": 0}
+
+    async def to_client(send, *args):
+        try:
+            await send(*args)
+        except websockets.exceptions.ConnectionClosed as e:
+            raise ClientGone(str(e)) from e
+
+    async def begin(header: dict):
+        await to_client(reply.relay_begin, {"format": header["format"], "sample_rate": header["sample_rate"],
+                                            "channels": header.get("channels", 1)})
+        relay["begun"] = True
+
+    async def forward(frame: bytes):
+        if relay["bytes"] == 0:
+            metrics.observe("first_audio", time.perf_counter() - start_time, kind="request")
+        await to_client(reply.relay_frame, frame)
+        relay["bytes"] += len(frame)
+
+    async def request_framed(ws: FramedRequest):
+        await ws.send(MsgType.REQUEST, {"text": text, "stream": True, "formats": ["pcm"]})
+        while True:
+            frame = await ws.recv()
+            if frame.type == MsgType.AUDIO_START:
+                await begin(frame.headers)
+            elif frame.type == MsgType.AUDIO and relay["begun"]:
+                await forward(frame.payload)
+            elif frame.type == MsgType.END and frame.stream_id == 0:
+                return
+            elif frame.type in (MsgType.ERROR, MsgType.BUSY):
+                raise RuntimeError(f"TTS stream error: {frame.headers.get('message', frame.type.name)}")
+
+    async def request(ws, request_id: int):
+        if isinstance(ws, FramedRequest):
+            return await request_framed(ws)
+        await ws.send(json.dumps({"text": text, "stream": True, "formats": ["pcm"], "id": request_id},
+                                 ensure_ascii=False))
+        resp = await ws.recv()
+        header = json.loads(resp) if isinstance(resp, str) and resp.startswith('{') else {}
+        if header.get("type") != "stream_start" or header.get("id") != request_id:
+            raise RuntimeError(f"TTS stream error: {resp}")
+        await begin(header)
+        while True:
+            frame = await ws.recv()
+            if not isinstance(frame, bytes):
+                break
+            await forward(frame)
+        footer = json.loads(frame) if frame.startswith('{') else {}
+        if footer.get("type") != "stream_end":
+            raise RuntimeError(f"TTS stream error: {frame}")
+
+    try:
+        # Повтор после обрыва продублировал бы клиенту начало потока и уже отправленное аудио
+        await tts_pool.request(request, idempotent=False)
+        print(f"[LOG] [TTS] Переслано клиенту {relay['bytes']} байт PCM за {time.perf_counter() - start_time:.2f}s")
+    except ClientGone as e:
+        print(f"[WS] Клиент отключился во время пересылки аудио: {e}")
+        return True  # отправлять больше некому
+    except Exception as e:
+        print(f"[ERROR] TTS relay error: {e}")
+        if not relay["begun"]:
+            return False
+    if relay["begun"]:
+        await to_client(reply.relay_end)
+    return relay["begun"]
+
 # Гибридная функция для LLM-помощи в парсинге
-async def llm_assisted_parse(text: str) -> Optional[List[ToolCall]]:
-    """Использует LLM для помощи в парсинге неоднозначных команд"""
-    system_prompt = tool_parser.get_simple_system_prompt()
-    
-    # Проверяем кэш
-    cached = get_cached_response(text, system_prompt)
+async def llm_assisted_parse(text: str, site_id: Optional[str] = None,
+                             start_race: Optional[Callable[[], "RacedReply"]] = None) -> Optional[List[ToolCall]]:
+    """
+    Использует LLM для помощи в парсинге неоднозначных команд.
+    start_race вызывается, когда классификация уже заняла слот LLM: ответ гонки
+    встаёт в очередь за ней, а не перед ней. Если найден инструмент, ответ
+    отменяется ещё до освобождения слота - при одном слоте он не доходит до модели.
+    """
+    # Проверяем кэш: в нём распределение по меткам
+    cached = get_cached_response(text, CLASSIFICATION_PROMPT)
     if cached:
-        return _parse_llm_response(cached, text)
+        try:
+            return _parse_llm_response(Classification.from_probs(json.loads(cached), "cache"), text)
+        except (ValueError, AttributeError):
+            pass
     
     try:
         print(f"[DEBUG] LLM-помощь для парсинга: '{text}'")
-        perf.log_stat("llm_calls")
+        metrics.inc("llm_calls", purpose="parse")
         
-        result = await llm_manager.llm.ainvoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ])
+        async with scheduler.stage("llm", site_id):
+            raced = start_race() if start_race else None
+            started = time.perf_counter()
+            with metrics.span("llm", kind="call"):
+                result = await llm_manager.classify(text, tool_parser.intent_labels)
+            tool_calls = _parse_llm_response(result, text)
+            if raced and tool_calls and tool_calls[0].confidence >= CONFIDENCE_THRESHOLD:
+                raced.cancel()
         
-        content = result.content if hasattr(result, 'content') else str(result)
-        content = content.strip().upper()
+        print(f"[DEBUG] LLM ответ: {result.label} (p={result.probability:.2f}, {result.method})")
+        cache_response(text, CLASSIFICATION_PROMPT, json.dumps(result.probs, ensure_ascii=False),
+                       time.perf_counter() - started)
         
-        print(f"[DEBUG] LLM ответ: {content}")
-        cache_response(text, system_prompt, content)
-        
-        return _parse_llm_response(content, text)
+        return tool_calls
         
     except Exception as e:
         print(f"[ERROR] LLM-помощь failed: {e}")
         return None
 
-def _parse_llm_response(llm_response: str, original_text: str) -> Optional[List[ToolCall]]:
-    """Парсит ответ LLM и создает ToolCall"""
-    llm_response = llm_response.strip().upper()
-    
+def _parse_llm_response(result: Classification, original_text: str) -> Optional[List[ToolCall]]:
+    """Создаёт ToolCall по метке классификации; уверенность - вероятность метки"""
     tool_mapping = {
         "ВРЕМЯ": "get_time",
         "ПОГОДА": "get_weather", 
@@ -194,56 +441,145 @@ def _parse_llm_response(llm_response: str, original_text: str) -> Optional[List[
         "ЗВОНОК": "call_contact"
     }
     
-    if llm_response in tool_mapping:
-        tool_name = tool_mapping[llm_response]
+    if result.label in tool_mapping:
+        tool_name = tool_mapping[result.label]
         args = tool_parser._extract_args(tool_name, original_text)
-        return [ToolCall(name=tool_name, args=args, confidence=0.7)]
+        return [ToolCall(name=tool_name, args=args, confidence=result.probability)]
     
     return None
 
+class RacedReply:
+    """
+    Ответ LLM, запущенный одновременно с LLM-классификацией неоднозначной фразы
+    (прямой разбор нашёл зацепку, но уверенность ниже порога). Запускается из llm_assisted_parse, когда классификация уже держит слот LLM.
+    Токены копятся в очереди. Если классификация нашла инструмент, генерация
+    отменяется (при лимите LLM в один слот - ещё до начала); иначе
+    llm_node забирает уже начатый ответ вместо второго последовательного вызова.
+    """
+
+    def __init__(self, txt: str, system_prompt: str, site_id: Optional[str]):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.llm_started_at: Optional[float] = None
+        self.llm_finished_at: Optional[float] = None
+        self.consumed = False
+        metrics.inc("parse_race", outcome="launched")
+        self.task = asyncio.create_task(self._run(txt, system_prompt, site_id))
+
+    async def _run(self, txt: str, system_prompt: str, site_id: Optional[str]):
+        try:
+            async with scheduler.stage("llm", site_id):
+                self.llm_started_at = time.perf_counter()
+                metrics.inc("llm_calls", purpose="race")
+                with metrics.span("llm_race", kind="call"):
+                    async for chunk in llm_manager.stream_response(txt, system_prompt, purpose="race"):
+                        self.queue.put_nowait(chunk)
+        except Exception as e:
+            self.queue.put_nowait(e)
+        finally:
+            self.llm_finished_at = time.perf_counter()
+            self.queue.put_nowait(None)
+
+    async def stream(self):
+        """Отдаёт уже накопленные токены, затем - по мере генерации"""
+        self.consumed = True
+        metrics.inc("parse_race", outcome="reply_used")
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def text(self) -> str:
+        return "".join([chunk async for chunk in self.stream()])
+
+    def cancel(self):
+        if self.consumed:
+            return
+        self.consumed = True
+        self.task.cancel()
+        metrics.inc("parse_race", outcome="reply_cancelled")
+        if self.llm_started_at is not None:
+            # Генерация уже шла (или успела закончиться) - это лишняя нагрузка на LLM
+            finished_at = self.llm_finished_at or time.perf_counter()
+            metrics.observe("llm_race_wasted", finished_at - self.llm_started_at, kind="call")
+
 # Предзагрузка моделей
-async def preload_models():
+async def warm_stt():
+    await stt_vosk(AudioMsg(b'\x00' * 1600, sr=16000))
+    # Держим соединение к сервису открытым заранее
+    await stt_pool.warm()
+
+async def warm_tts():
+    await tts_client("Тест")
+    await tts_pool.warm()
+
+async def preload_models(services: bool = True):
+    """
+    Прогревает LLM, MQTT, граф и (для сервера) STT/TTS одновременно.
+    Длительность каждой стадии печатается и попадает в метрики (kind="startup");
+    время до готовности - от начала импорта agent до конца самой долгой стадии.
+    """
     print("[INFO] Предзагрузка моделей...")
-    
-    try:
-        test_audio = AudioMsg(b'\x00' * 1600, sr=16000)
-        await stt_vosk(test_audio)
-        print("[INFO] STT готов")
-    except:
-        print("[WARNING] STT недоступен")
-    
-    try:
-        await tts_client("Тест")
-        print("[INFO] TTS готов")
-    except:
-        print("[WARNING] TTS недоступен")
-    
+    start_time = time.perf_counter()
+
+    async def stage(name: str, warm) -> str:
+        stage_start = time.perf_counter()
+        try:
+            await warm
+            print(f"[INFO] {name.upper()} готов")
+            status = ""
+        except Exception as e:
+            print(f"[WARNING] {name.upper()} недоступен: {e}")
+            status = " (недоступен)"
+        duration = time.perf_counter() - stage_start
+        metrics.observe(name, duration, kind="startup")
+        return f"{name} {duration:.2f}s{status}"
+
+    stages = [
+        stage("llm", llm_manager.warm()),
+        stage("mqtt", asyncio.to_thread(init_mqtt)),
+        stage("graph", asyncio.to_thread(build_graphs)),
+    ]
+    if services:
+        stages += [stage("stt", warm_stt()), stage("tts", warm_tts())]
+    report = await asyncio.gather(*stages)
+
+    ready = time.perf_counter() - _import_started
+    metrics.observe("import", IMPORT_TIME, kind="startup")
+    metrics.observe("ready", ready, kind="startup")
+    print(f"[STARTUP] Готов через {ready:.2f}s: import {IMPORT_TIME:.2f}s | {' | '.join(report)} | "
+          f"прогрев {time.perf_counter() - start_time:.2f}s")
     print("[INFO] Предзагрузка завершена")
 
 # Узлы обработки
+@metrics.timed("stt")
 async def stt_node(state: AgentState) -> AgentState:
-    perf.start("stt")
     if state.audio:
         try:
-            recognized_text = await stt_vosk(state.audio)
+            async with scheduler.stage("stt", state.site_id):
+                if state.stt_stream:
+                    recognized_text = await within(state.deadline, state.stt_stream.finish())
+                else:
+                    recognized_text = await within(state.deadline, stt_vosk(state.audio))
             if recognized_text and recognized_text.strip() != "Не удалось распознать речь":
                 state.text = TextMsg(recognized_text)
                 print(f"[INFO] Распознан текст: {recognized_text}")
             else:
                 state.text = None
+        except DeadlineExceeded:
+            state.deadline.degrade("stt_timeout")
+            state.text = TextMsg("Ошибка распознавания речи")
         except Exception as e:
             print(f"[ERROR] STT error: {e}")
             state.text = TextMsg("Ошибка распознавания речи")
-    perf.end("stt")
     return state
 
+@metrics.timed("parsing")
 async def intelligent_parsing_node(state: AgentState) -> AgentState:
     """Умный узел парсинга с гибридным подходом"""
-    perf.start("parsing")
-    perf.log_stat("total_requests")
-    
     if not state.text:
-        perf.end("parsing")
         return state
     
     txt = state.text.text
@@ -257,20 +593,46 @@ async def intelligent_parsing_node(state: AgentState) -> AgentState:
         state.tool_calls = [_convert_to_tool_call_dict(tc) for tc in direct_result]
         state.parse_method = "direct"
         state.confidence = direct_result[0].confidence
-        perf.log_stat("direct_parse")
-        perf.end("parsing")
+        metrics.inc("parse_method", method="direct")
         return state
     
     # 2. Если прямой парсинг неуспешен и разрешен LLM fallback
-    if USE_LLM_FALLBACK and PERFORMANCE_MODE != "fast":
-        llm_result = await llm_assisted_parse(txt)
+    llm_fallback = USE_LLM_FALLBACK and PERFORMANCE_MODE != "fast"
+    if llm_fallback and state.deadline and not state.deadline.allows(LLM_MIN_BUDGET):
+        # На классификацию времени нет - сразу к ответу (кэш или заготовка)
+        state.deadline.degrade("skip_llm_parse")
+        llm_fallback = False
+    if llm_fallback:
+        # Ответ запускается, как только классификация заняла слот LLM: если инструмента
+        # не найдётся, он уже в очереди следующим. Запуск до этого отдал бы слот ответу
+        # (wait_for оборачивает классификацию в отдельную задачу, и она стартует позже)
+        raced_reply = None
+
+        def start_race() -> RacedReply:
+            nonlocal raced_reply
+            raced_reply = RacedReply(txt, CONVERSATION_SYSTEM_PROMPT, state.site_id)
+            return raced_reply
+
+        race = (PARSE_RACE and PERFORMANCE_MODE == "balanced"
+                and PARSE_RACE_MIN_CONFIDENCE <= tool_parser.direct_confidence(txt) < CONFIDENCE_THRESHOLD
+                and not has_cached_response(txt, CONVERSATION_SYSTEM_PROMPT))
+        try:
+            llm_result = await within(state.deadline,
+                                      llm_assisted_parse(txt, state.site_id, start_race if race else None))
+        except DeadlineExceeded:
+            state.deadline.degrade("llm_parse_timeout")
+            llm_result = None
+        state.raced_reply = raced_reply
         
         if llm_result and llm_result[0].confidence >= CONFIDENCE_THRESHOLD:
+            if raced_reply:
+                raced_reply.cancel()
+                state.raced_reply = None
             print(f"[DEBUG] LLM-помощь успешна: {llm_result[0].name} (conf: {llm_result[0].confidence:.2f})")
             state.tool_calls = [_convert_to_tool_call_dict(tc) for tc in llm_result]
             state.parse_method = "llm_assisted"
             state.confidence = llm_result[0].confidence
-            perf.end("parsing")
+            metrics.inc("parse_method", method="llm_assisted")
             return state
     
     # 3. Если ничего не сработало, используем обычный LLM для генерации ответа
@@ -278,7 +640,7 @@ async def intelligent_parsing_node(state: AgentState) -> AgentState:
         state.parse_method = "llm_only"
         # Переходим к обычной генерации LLM
     
-    perf.end("parsing")
+    metrics.inc("parse_method", method=state.parse_method or "none")
     return state
 
 def _convert_to_tool_call_dict(tc: ToolCall) -> Dict[str, Any]:
@@ -289,55 +651,298 @@ def _convert_to_tool_call_dict(tc: ToolCall) -> Dict[str, Any]:
         "id": f"tool_{tc.name}_{int(time.time())}"
     }
 
+@metrics.timed("llm")
 async def llm_node(state: AgentState) -> AgentState:
     """Упрощенный LLM узел для случаев когда парсинг не сработал"""
-    perf.start("llm")
-    
     if not state.text:  # Убираем проверку на tool_calls
-        perf.end("llm")
         return state
     
     txt = state.text.text
-    
-    # Простой системный промпт для разговора
-    system_prompt = """Ты дружелюбный голосовой помощник. 
-Отвечай кратко и естественно на русском языке.
-Если не понимаешь команду, честно скажи об этом и предложи помощь."""
+    system_prompt = CONVERSATION_SYSTEM_PROMPT
+    raced, state.raced_reply = state.raced_reply, None
     
     # Проверяем кэш
     cached = get_cached_response(txt, system_prompt)
     if cached:
+        if raced:
+            raced.cancel()
         state.text = TextMsg(cached)
-        perf.end("llm")
+        return state
+
+    if state.deadline and not state.deadline.allows(LLM_MIN_BUDGET):
+        # Генерация не успеет - лучше заготовка сразу, чем долгая тишина
+        if raced:
+            raced.cancel()
+        state.deadline.degrade("canned_reply")
+        state.text = TextMsg(CANNED_REPLY)
         return state
     
+    if state.audio_sink and LLM_STREAMING:
+        try:
+            if not raced:
+                metrics.inc("llm_calls", purpose="stream")
+            started = time.perf_counter()
+            content = await stream_llm_reply(state, system_prompt, txt, raced)
+            cache_response(txt, system_prompt, content, time.perf_counter() - started)
+            state.text = TextMsg(content)
+        except DeadlineExceeded:
+            llm_timed_out(state, raced)
+        except Exception as e:
+            print(f"[ERROR] LLM error: {e}")
+            if not state.audio_streamed:
+                state.text = TextMsg("Извините, произошла ошибка.")
+        return state
+
     try:
         print(f"[DEBUG] LLM генерация ответа для: '{txt}'")
-        perf.log_stat("llm_calls")
+        if raced:
+            # Генерация начата ещё во время классификации
+            started = time.perf_counter()
+            content = await within(state.deadline, raced.text())
+            cache_response(txt, system_prompt, content, time.perf_counter() - started)
+            state.text = TextMsg(content)
+            return state
+        metrics.inc("llm_calls", purpose="reply")
         
-        result = await llm_manager.llm.ainvoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": txt}
-        ])
+        async with scheduler.stage("llm", state.site_id):
+            started = time.perf_counter()
+            with metrics.span("llm", kind="call"):
+                content = await within(state.deadline, llm_manager.complete(txt, system_prompt))
         
-        content = result.content if hasattr(result, 'content') else str(result)
-        cache_response(txt, system_prompt, content)
+        cache_response(txt, system_prompt, content, time.perf_counter() - started)
         state.text = TextMsg(content)
-        
+
+    except DeadlineExceeded:
+        llm_timed_out(state, raced)
     except Exception as e:
         print(f"[ERROR] LLM error: {e}")
         state.text = TextMsg("Извините, произошла ошибка.")
     
-    perf.end("llm")
     return state
 
+def llm_timed_out(state: AgentState, raced: Optional[RacedReply]):
+    """LLM не уложилась в срок фразы: генерация останавливается, озвучивается заготовка"""
+    if raced:
+        raced.task.cancel()
+    state.deadline.degrade("llm_timeout")
+    if not state.audio_streamed:
+        state.text = TextMsg(CANNED_REPLY)
+
+class ThinkFilter:
+    """Вырезает из потока токенов блоки <think>...</think>, которые не озвучиваются"""
+
+    def __init__(self):
+        self.pending = ""
+        self.in_think = False
+
+    def feed(self, text: str) -> str:
+        self.pending += text
+        visible = []
+        while self.pending:
+            tag = "</think>" if self.in_think else "<think>"
+            index = self.pending.lower().find(tag)
+            if index >= 0:
+                if not self.in_think:
+                    visible.append(self.pending[:index])
+                self.pending = self.pending[index + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            # Хвост может оказаться началом тега - придерживаем его
+            keep = next((n for n in range(min(len(tag) - 1, len(self.pending)), 0, -1)
+                         if tag.startswith(self.pending[-n:].lower())), 0)
+            if not self.in_think:
+                visible.append(self.pending[:len(self.pending) - keep])
+            self.pending = self.pending[len(self.pending) - keep:]
+            break
+        return "".join(visible)
+
+    def flush(self) -> str:
+        tail, self.pending = ("" if self.in_think else self.pending), ""
+        return tail
+
+# Пустой WAV: старые клиенты ждут ответ на каждую фразу, даже если озвучить нечего
+EMPTY_WAV = b"RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00\x80>\x00\x00\x00}\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00"
+
+class ClientReply:
+    """
+    Ответ клиенту на одну фразу по старому протоколу:
+    озвученные предложения - AUDIO_STREAM_BEGIN, сегменты, AUDIO_STREAM_END;
+    пересылка PCM - JSON {"type": "audio_relay", ...}, фреймы, AUDIO_RELAY_END;
+    ответ целиком - одно бинарное сообщение или AUDIO_CHUNKS_BEGIN ... AUDIO_CHUNKS_END.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.segments = 0
+
+    # Ответ по предложениям (state.audio_sink)
+    async def send(self, audio: bytes):
+        if self.segments == 0:
+            await self.ws.send("AUDIO_STREAM_BEGIN")
+        await self.ws.send(audio)
+        self.segments += 1
+
+    async def close(self):
+        if self.segments:
+            await self.ws.send("AUDIO_STREAM_END")
+
+    # Пересылка потокового синтеза (state.audio_relay)
+    async def relay_begin(self, header: dict):
+        await self.ws.send(json.dumps({"type": "audio_relay", **header}))
+
+    async def relay_frame(self, frame: bytes):
+        await self.ws.send(frame)
+
+    async def relay_end(self):
+        await self.ws.send("AUDIO_RELAY_END")
+
+    async def audio(self, audio_result: Optional[AudioMsg]):
+        if not audio_result:
+            await self.ws.send(EMPTY_WAV)
+        elif len(audio_result.raw) > 1024 * 1024:
+            await self.ws.send("AUDIO_CHUNKS_BEGIN")
+            for chunk in split_audio_data(audio_result.raw):
+                await self.ws.send(chunk)
+            await self.ws.send("AUDIO_CHUNKS_END")
+        else:
+            await self.ws.send(audio_result.raw)
+
+    async def finish(self):
+        """Ответ отправлен целиком (в старом протоколе отдельного маркера нет)"""
+
+    async def error(self, message: str):
+        await self.ws.send(f"ERROR: {message}")
+
+    async def busy(self):
+        await self.ws.send("BUSY")
+
+class FramedClientReply(ClientReply):
+    """
+    Ответ по magus.v1 с request_id фразы: каждый аудиопоток (предложение,
+    пересылка, ответ целиком) - AUDIO_START, кадры AUDIO, END со своим stream_id;
+    END с stream_id 0 завершает ответ. BUSY и ERROR тоже завершают его.
+    """
+
+    def __init__(self, request: ServerRequest):
+        super().__init__(request.ws)
+        self.request = request
+        self.stream_id = 0
+
+    async def _stream(self, header: dict, audio: bytes):
+        await self._begin(header)
+        for chunk in split_audio_data(audio):
+            await self.request.send(MsgType.AUDIO, payload=chunk, stream_id=self.stream_id)
+        await self.request.send(MsgType.END, stream_id=self.stream_id)
+
+    async def _begin(self, header: dict):
+        self.stream_id += 1
+        await self.request.send(MsgType.AUDIO_START, header, stream_id=self.stream_id)
+
+    async def send(self, audio: bytes):
+        self.segments += 1
+        await self._stream({"segment": self.segments}, audio)
+
+    async def close(self):
+        pass
+
+    async def relay_begin(self, header: dict):
+        await self._begin(header)
+
+    async def relay_frame(self, frame: bytes):
+        await self.request.send(MsgType.AUDIO, payload=frame, stream_id=self.stream_id)
+
+    async def relay_end(self):
+        await self.request.send(MsgType.END, stream_id=self.stream_id)
+
+    async def audio(self, audio_result: Optional[AudioMsg]):
+        if audio_result:
+            await self._stream({}, audio_result.raw)
+
+    async def finish(self):
+        await self.request.send(MsgType.END)
+
+    async def error(self, message: str):
+        await self.request.send(MsgType.ERROR, {"message": message})
+
+    async def busy(self):
+        await self.request.send(MsgType.BUSY)
+
+async def stream_llm_reply(state: AgentState, system_prompt: str, txt: str,
+                           raced: Optional[RacedReply] = None) -> str:
+    """
+    Генерирует ответ потоком токенов, режет его на предложения и озвучивает
+    каждое сразу по готовности. Синтез следующих предложений идёт параллельно
+    с генерацией, клиенту они уходят строго по порядку.
+    raced - ответ, начатый параллельно с классификацией: слот LLM уже занят им.
+    """
+    start_time = time.perf_counter()
+    sentences = SentenceBuffer()
+    think = ThinkFilter()
+    parts = []
+    queue: asyncio.Queue = asyncio.Queue()
+    enqueued = 0
+
+    async def speak(sentence: str) -> Optional[bytes]:
+        try:
+            async with scheduler.stage("tts", state.site_id):
+                return await tts_client(sentence, state.audio_formats)
+        except Exception as e:
+            print(f"[ERROR] TTS error: {e}")
+            return None
+
+    async def sender():
+        while True:
+            task = await queue.get()
+            if task is None:
+                break
+            audio = await task
+            if audio:
+                if state.audio_sink.segments == 0:
+                    first_audio = time.perf_counter() - start_time
+                    metrics.observe("first_audio", first_audio, kind="request")
+                    print(f"[PERF] Первое аудио через {first_audio:.2f}s")
+                await state.audio_sink.send(audio)
+                state.audio_streamed = True
+
+    def enqueue(ready: List[str]):
+        nonlocal enqueued
+        enqueued += len(ready)
+        for sentence in ready:
+            queue.put_nowait(asyncio.create_task(speak(sentence)))
+
+    sender_task = asyncio.create_task(sender())
+    try:
+        print(f"[DEBUG] LLM потоковая генерация ответа для: '{txt}'")
+        source = raced.stream() if raced else llm_manager.stream_response(txt, system_prompt)
+        chunks = source.__aiter__()
+        async with (nullcontext() if raced else scheduler.stage("llm", state.site_id)):
+            with metrics.span("llm_stream", kind="call"):
+                while True:
+                    # Пока не готово первое предложение, ждём токены не дольше срока фразы;
+                    # дальше колонка уже говорит, и генерация не ограничивается
+                    try:
+                        chunk = await within(None if enqueued else state.deadline, chunks.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    visible = think.feed(chunk)
+                    parts.append(visible)
+                    enqueue(sentences.feed(visible))
+        tail = think.flush()
+        parts.append(tail)
+        enqueue(sentences.feed(tail) + sentences.flush())
+        print(f"[PERF] Генерация завершена за {time.perf_counter() - start_time:.2f}s")
+    finally:
+        queue.put_nowait(None)
+        await sender_task
+        await state.audio_sink.close()
+    return "".join(parts).strip()
+
 # Остальные узлы (без изменений)
+@metrics.timed("tools")
 async def tools_node(state: AgentState) -> AgentState:
     if not state.tool_calls:
         return state
     
-    perf.start("tools")
-    perf.log_stat("tool_calls")
     print(f"[LOG] [TOOLS] Выполнение {len(state.tool_calls)} инструментов")
     
     async def execute_tool_async(tool_call):
@@ -355,6 +960,7 @@ async def tools_node(state: AgentState) -> AgentState:
             return None
         
         print(f"[DEBUG] Выполняю инструмент: {tool_name} с аргументами: {tool_args}")
+        metrics.inc("tool_calls", tool=tool_name)
         
         try:
             if isinstance(tool_args, str):
@@ -362,8 +968,18 @@ async def tools_node(state: AgentState) -> AgentState:
         except:
             tool_args = {}
         
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, execute_tool, tool_name, tool_args)
+        async def call():
+            result = await state.speculation.take(tool_name, tool_args) if state.speculation else None
+            if result is None:
+                result = await run_tool(tool_name, tool_args)
+            return result
+
+        try:
+            result = await within(state.deadline, call())
+        except DeadlineExceeded:
+            # Ответ инструмента больше не ждём: MQTT-ожидание в потоке само закончится по MQTT_TIMEOUT
+            state.deadline.degrade("tool_timeout")
+            result = "Не удалось выполнить команду вовремя"
         print(f"[DEBUG] Результат инструмента {tool_name}: {result}")
         return (tool_id, result)
     
@@ -371,14 +987,13 @@ async def tools_node(state: AgentState) -> AgentState:
     results = await asyncio.gather(*tasks)
     state.tool_results = {id_: res for id_, res in results if id_ is not None}
     
-    perf.end("tools")
     return state
 
+@metrics.timed("tool_results")
 async def tool_results_processor(state: AgentState) -> AgentState:
     if not state.tool_results:
         return state
     
-    perf.start("tool_results")
     
     if len(state.tool_results) == 1:
         result = next(iter(state.tool_results.values()))
@@ -389,18 +1004,21 @@ async def tool_results_processor(state: AgentState) -> AgentState:
     state.tool_calls = None
     state.tool_results = None
     
-    perf.end("tool_results")
     return state
 
+@metrics.timed("tts")
 async def tts_node(state: AgentState) -> AgentState:
-    perf.start("tts")
-    if state.text:
+    if state.text and not state.audio_streamed:
         try:
-            audio_bytes = await tts_client(state.text.text)
+            async with scheduler.stage("tts", state.site_id):
+                if state.audio_relay:
+                    state.audio_streamed = await tts_relay(state.text.text, state.audio_relay)
+                    if state.audio_streamed:
+                        return state
+                audio_bytes = await tts_client(state.text.text, state.audio_formats)
             state.audio = AudioMsg(audio_bytes, sr=48000)
         except Exception as e:
             print(f"[ERROR] TTS error: {e}")
-    perf.end("tts")
     return state
 
 # Маршрутизаторы
@@ -418,112 +1036,300 @@ def tools_router(state: AgentState) -> Literal["tool_results_processor", "tts"]:
         return "tool_results_processor"
     return "tts"
 
-# Построение графа
-workflow = StateGraph(AgentState)
-workflow.add_node("stt", stt_node)
-workflow.add_node("intelligent_parsing", intelligent_parsing_node)
-workflow.add_node("llm", llm_node)
-workflow.add_node("tools", tools_node)
-workflow.add_node("tool_results_processor", tool_results_processor)
-workflow.add_node("tts", tts_node)
-
-workflow.add_edge(START, "stt")
-workflow.add_edge("stt", "intelligent_parsing")
-workflow.add_conditional_edges("intelligent_parsing", parsing_router, 
-                               {"tools": "tools", "llm": "llm", "tts": "tts"})
-workflow.add_edge("llm", "tts")
-workflow.add_conditional_edges("tools", tools_router, 
-                               {"tool_results_processor": "tool_results_processor", "tts": "tts"})
-workflow.add_edge("tool_results_processor", "tts")
-workflow.add_edge("tts", END)
-
-app = workflow.compile()
+# Построение графа: LangGraph импортируется только здесь - при прогреве или первой
+# фразе, которой нужен граф (команды быстрого пути обходятся без него)
+_graphs = None
+
+def build_graphs():
+    """Возвращает (app, resume_app); resume_app - продолжение графа после разбора"""
+    global _graphs
+    if _graphs is None:
+        from langgraph.graph import StateGraph, START, END
+
+        workflow = StateGraph(AgentState)
+        workflow.add_node("stt", stt_node)
+        workflow.add_node("intelligent_parsing", intelligent_parsing_node)
+        workflow.add_node("llm", llm_node)
+        workflow.add_node("tools", tools_node)
+        workflow.add_node("tool_results_processor", tool_results_processor)
+        workflow.add_node("tts", tts_node)
+
+        workflow.add_edge(START, "stt")
+        workflow.add_edge("stt", "intelligent_parsing")
+        workflow.add_conditional_edges("intelligent_parsing", parsing_router, 
+                                       {"tools": "tools", "llm": "llm", "tts": "tts"})
+        workflow.add_edge("llm", "tts")
+        workflow.add_conditional_edges("tools", tools_router, 
+                                       {"tool_results_processor": "tool_results_processor", "tts": "tts"})
+        workflow.add_edge("tool_results_processor", "tts")
+        workflow.add_edge("tts", END)
+
+        # Продолжение графа после разбора - для фраз, которые не пошли быстрым путём
+        resume_workflow = StateGraph(AgentState)
+        resume_workflow.add_node("llm", llm_node)
+        resume_workflow.add_node("tools", tools_node)
+        resume_workflow.add_node("tool_results_processor", tool_results_processor)
+        resume_workflow.add_node("tts", tts_node)
+
+        resume_workflow.add_conditional_edges(START, parsing_router,
+                                              {"tools": "tools", "llm": "llm", "tts": "tts"})
+        resume_workflow.add_edge("llm", "tts")
+        resume_workflow.add_conditional_edges("tools", tools_router,
+                                              {"tool_results_processor": "tool_results_processor", "tts": "tts"})
+        resume_workflow.add_edge("tool_results_processor", "tts")
+        resume_workflow.add_edge("tts", END)
+
+        _graphs = (workflow.compile(), resume_workflow.compile())
+    return _graphs
+
+def __getattr__(name: str):
+    # agent.app и agent.resume_app для внешнего кода (бенчмарки) - собираются при первом обращении
+    if name == "app":
+        return build_graphs()[0]
+    if name == "resume_app":
+        return build_graphs()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+async def run_pipeline(state: AgentState) -> AgentState:
+    """
+    Обрабатывает фразу и возвращает итоговое состояние.
+    Команды, разобранные напрямую (обычный случай), проходят те же узлы,
+    что и в графе, но без LangGraph: без копирования состояния и маршрутизации.
+    Остальные фразы после разбора продолжают путь в resume_app.
+    """
+    if state.deadline is None:
+        state.deadline = Deadline()
+    if not FAST_PATH:
+        app, _ = build_graphs()
+        return replace(state, **await app.ainvoke(state))
+
+    state = await stt_node(state)
+    state = await intelligent_parsing_node(state)
+    if state.parse_method != "direct":
+        metrics.inc("pipeline", path="graph")
+        _, resume_app = build_graphs()
+        return replace(state, **await resume_app.ainvoke(state))
+
+    metrics.inc("pipeline", path="fast")
+    state = await tools_node(state)
+    if tools_router(state) == "tool_results_processor":
+        state = await tool_results_processor(state)
+    return await tts_node(state)
 
 # WebSocket сервер и остальной код остается без изменений...
 HOST, PORT = os.getenv("MAGUS_WS_HOST", "0.0.0.0"), int(os.getenv("MAGUS_WS_PORT", 8765))
 
 def split_audio_data(audio_data: bytes, max_chunk_size: int = 1024 * 1024) -> list:
-    return [audio_data[i:i + max_chunk_size] for i in range(0, len(audio_data), max_chunk_size)]
+    # memoryview: куски ссылаются на исходный буфер, а не копируют его
+    view = memoryview(audio_data)
+    return [view[i:i + max_chunk_size] for i in range(0, len(audio_data), max_chunk_size)]
+
+def parse_client_hello(message: str) -> Optional[Dict[str, Any]]:
+    """
+    Разбирает hello от клиента:
+    {"type": "hello", "site_id": "kitchen", "audio_formats": ["opus", "wav"], "audio_stream": true,
+     "audio_relay": true}
+    audio_stream - клиент умеет принимать ответ по предложениям (AUDIO_STREAM_BEGIN/END).
+    audio_relay - клиент проигрывает PCM по мере прихода (audio_relay ... AUDIO_RELAY_END).
+    """
+    try:
+        data = json.loads(message)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or data.get("type") != "hello":
+        return None
+    return client_config(data)
+
+def client_config(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Поля hello: из JSON старого протокола или из заголовков кадра HELLO (magus.v1)"""
+    formats = data.get("audio_formats")
+    if isinstance(formats, list):
+        formats = [str(fmt).lower() for fmt in formats if str(fmt).lower() in ("opus", "pcm", "wav")] or None
+    else:
+        formats = None
+    site_id = str(data["site_id"]).strip() if data.get("site_id") else None
+    return {"audio_formats": formats, "site_id": site_id or None, "audio_stream": bool(data.get("audio_stream")),
+            "audio_relay": bool(data.get("audio_relay"))}
+
+async def process_utterance(reply: ClientReply, audio_data: bytes, audio_formats: Optional[List[str]], site_id: str,
+                            stt_stream: Optional[UtteranceStream] = None, audio_stream: bool = False,
+                            audio_relay: bool = False, deadline: Optional[Deadline] = None):
+    """Прогоняет одну фразу через граф и отправляет ответ клиенту; срок фразы отсчитывается от END"""
+    speculation = stt_stream.speculation if stt_stream else None
+    state = AgentState(audio=AudioMsg(audio_data), audio_formats=audio_formats, site_id=site_id,
+                       stt_stream=stt_stream, speculation=speculation,
+                       audio_sink=reply if audio_stream else None,
+                       audio_relay=reply if audio_relay else None,
+                       deadline=deadline or Deadline())
+    with metrics.request(site_id):
+        try:
+            result = await run_pipeline(state)
+            if result.audio_streamed:
+                await reply.finish()
+                return  # ответ уже отправлен клиенту по предложениям
+
+            # Логируем статистику
+            if result.parse_method:
+                print(f"[STATS] [{site_id}] Метод: {result.parse_method}, Уверенность: {result.confidence or 0:.2f}")
+
+            # tts_node кладёт синтезированный ответ в audio; если там осталось
+            # входное аудио, синтез не состоялся - озвучиваем текст один раз здесь
+            audio_result = result.audio
+            if audio_result and audio_result.raw == audio_data:
+                audio_result = None
+
+            if not audio_result:
+                text_to_speak = result.text.text if result.text else None
+                if text_to_speak:
+                    async with scheduler.stage("tts", site_id):
+                        audio_bytes = await tts_client(text_to_speak, audio_formats)
+                    audio_result = AudioMsg(audio_bytes, sr=48000)
+
+            await reply.audio(audio_result)
+            await reply.finish()
+        except websockets.exceptions.ConnectionClosed:
+            raise
+        except Exception as e:
+            print(f"[ERROR] Processing error: {e}")
+            await reply.error(str(e))
+        finally:
+            if state.raced_reply:
+                state.raced_reply.cancel()
+            if state.deadline.degradations:
+                print(f"[DEADLINE] [{site_id}] Деградации: {', '.join(state.deadline.degradations)}")
+            if speculation:
+                speculation.discard()
+                print(f"[SPEC] {get_speculation_stats()}")
+
+def default_site_id(ws) -> str:
+    address = getattr(ws, "remote_address", None)
+    return f"{address[0]}:{address[1]}" if address else f"ws-{id(ws)}"
 
 async def handle(ws):
     audio_chunks = []
+    audio_formats = None
+    audio_stream = False
+    audio_relay = False
+    stt_stream = None
+    if is_framed(ws):
+        await handle_framed(ws)
+        return
+    site = scheduler.open_site(default_site_id(ws), lambda item: process_utterance(*item))
     try:
         async for msg in ws:
             if isinstance(msg, bytes):
                 audio_chunks.append(msg)
+                # Распознавание начинается, пока клиент ещё досылает фразу
+                if STT_STREAMING:
+                    if stt_stream is None:
+                        stt_stream = UtteranceStream()
+                    stt_stream.feed(msg)
             elif isinstance(msg, str) and msg.strip().upper() == "END":
-                if processing_lock.locked():
-                    await ws.send("BUSY")
-                    audio_chunks = []
-                    continue
-                
                 audio_data = b"".join(audio_chunks)
+                audio_chunks = []
+                utterance_stream, stt_stream = stt_stream, None
+                if utterance_stream:
+                    utterance_stream.close()
                 if not audio_data:
                     await ws.send("ERROR: No audio data")
                     continue
-                
-                async with processing_lock:
-                    state = AgentState(audio=AudioMsg(audio_data))
-                    try:
-                        result = await app.ainvoke(state)
-                        
-                        # Логируем статистику
-                        if hasattr(result.get('intelligent_parsing'), 'parse_method'):
-                            method = result['intelligent_parsing'].parse_method
-                            confidence = result['intelligent_parsing'].confidence
-                            print(f"[STATS] Метод: {method}, Уверенность: {confidence:.2f}")
-                        
-                        audio_result = None
-                        for value in dict(result).values():
-                            if hasattr(value, 'audio') and value.audio:
-                                audio_result = value.audio
-                                break
-                        
-                        if not audio_result:
-                            for value in dict(result).values():
-                                text_to_speak = None
-                                if hasattr(value, 'text') and value.text:
-                                    text_to_speak = value.text.text if hasattr(value.text, 'text') else value.text
-                                elif isinstance(value, str):
-                                    text_to_speak = value
-                                elif isinstance(value, TextMsg):
-                                    text_to_speak = value.text
-                                
-                                if text_to_speak:
-                                    audio_bytes = await tts_client(text_to_speak)
-                                    audio_result = AudioMsg(audio_bytes, sr=48000)
-                                    break
-                        
-                        if audio_result:
-                            if len(audio_result.raw) > 1024 * 1024:
-                                await ws.send("AUDIO_CHUNKS_BEGIN")
-                                for chunk in split_audio_data(audio_result.raw):
-                                    await ws.send(chunk)
-                                await ws.send("AUDIO_CHUNKS_END")
-                            else:
-                                await ws.send(audio_result.raw)
-                        else:
-                            await ws.send(b"RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00\x80>\x00\x00\x00}\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00")
-                        
-                    except Exception as e:
-                        print(f"[ERROR] Processing error: {e}")
-                        await ws.send(f"ERROR: {e}")
-                
-                audio_chunks = []
+                # Фразы комнаты ждут своей очереди; BUSY - только если очередь комнаты полна
+                if not site.submit((ClientReply(ws), audio_data, audio_formats, site.site_id, utterance_stream,
+                                     audio_stream, audio_relay, Deadline())):
+                    print(f"[SCHEDULER] Очередь {site.site_id} переполнена, фраза отклонена")
+                    if utterance_stream:
+                        utterance_stream.cancel()
+                    await ws.send("BUSY")
+            elif isinstance(msg, str) and msg.startswith('{') and parse_client_hello(msg):
+                # hello не подтверждаем: клиент ждёт следующим сообщением ответ на END
+                hello = parse_client_hello(msg)
+                audio_formats = hello["audio_formats"]
+                audio_stream = hello["audio_stream"]
+                audio_relay = hello["audio_relay"]
+                if hello["site_id"]:
+                    scheduler.rename_site(site, hello["site_id"])
+                print(f"[WS] Клиент {site.site_id} принимает форматы: {audio_formats}")
             else:
                 await ws.send("ACK")
     except Exception as e:
         print(f"[ERROR] WebSocket error: {e}")
+    finally:
+        if stt_stream:
+            stt_stream.cancel()
+        scheduler.close_site(site)
+
+async def handle_framed(ws):
+    """
+    magus.v1: HELLO с полями hello в заголовках, затем на каждую фразу кадры AUDIO
+    и END с общим request_id. Следующую фразу можно слать, не дожидаясь ответа
+    на предыдущую: ответы различаются по request_id.
+    """
+    config = {"audio_formats": None, "audio_stream": False, "audio_relay": False}
+    site = scheduler.open_site(default_site_id(ws), lambda item: process_utterance(*item))
+
+    async def handle_request(request: ServerRequest):
+        first = request.first
+        if first.type == MsgType.HELLO:
+            hello = client_config(first.headers)
+            config.update(audio_formats=hello["audio_formats"], audio_stream=hello["audio_stream"],
+                          audio_relay=hello["audio_relay"])
+            if hello["site_id"]:
+                scheduler.rename_site(site, hello["site_id"])
+            print(f"[WS] Клиент {site.site_id} (magus.v1) принимает форматы: {config['audio_formats']}")
+            return
+        reply = FramedClientReply(request)
+        if first.type not in (MsgType.AUDIO, MsgType.END):
+            await reply.error(f"Unexpected {first.type.name}")
+            return
+
+        chunks = []
+        stt_stream = None
+        frame = first
+        try:
+            while frame.type != MsgType.END:
+                if frame.type == MsgType.AUDIO:
+                    chunks.append(frame.payload)
+                    if STT_STREAMING:
+                        if stt_stream is None:
+                            stt_stream = UtteranceStream(int(first.headers.get("sample_rate", 16000)))
+                        stt_stream.feed(frame.payload)
+                frame = await request.recv()
+        except asyncio.CancelledError:
+            if stt_stream:
+                stt_stream.cancel()
+            raise
+        if stt_stream:
+            stt_stream.close()
+
+        audio_data = b"".join(chunks)
+        if not audio_data:
+            await reply.error("No audio data")
+            return
+        if not site.submit((reply, audio_data, config["audio_formats"], site.site_id, stt_stream,
+                            config["audio_stream"], config["audio_relay"], Deadline())):
+            print(f"[SCHEDULER] Очередь {site.site_id} переполнена, фраза отклонена")
+            if stt_stream:
+                stt_stream.cancel()
+            await reply.busy()
+
+    try:
+        await serve_framed(ws, handle_request)
+    except Exception as e:
+        print(f"[ERROR] WebSocket error: {e}")
+    finally:
+        scheduler.close_site(site)
 
 async def main_ws():
     await preload_models()
+    await metrics.start_server()
     print(f"[WS] Serving on ws://{HOST}:{PORT}")
     print(f"[CONFIG] Performance mode: {PERFORMANCE_MODE}")
     print(f"[CONFIG] LLM fallback: {USE_LLM_FALLBACK}")
     print(f"[CONFIG] Confidence threshold: {CONFIDENCE_THRESHOLD}")
     
     try:
-        async with websockets.serve(handle, HOST, PORT, max_size=8*2**20, ping_interval=300, ping_timeout=None):
+        async with websockets.serve(handle, HOST, PORT, max_size=8*2**20, ping_interval=300, ping_timeout=None,
+                                    select_subprotocol=select_subprotocol):
             print(f"[WS] WebSocket server started successfully on {HOST}:{PORT}")
             await asyncio.Future()
     except OSError as e:
@@ -531,7 +1337,8 @@ async def main_ws():
             print(f"[ERROR] Port {PORT} is already in use. Trying alternative ports...")
             for alt_port in range(PORT + 1, PORT + 10):
                 try:
-                    async with websockets.serve(handle, HOST, alt_port, max_size=8*2**20, ping_interval=300, ping_timeout=None):
+                    async with websockets.serve(handle, HOST, alt_port, max_size=8*2**20, ping_interval=300,
+                                                ping_timeout=None, select_subprotocol=select_subprotocol):
                         print(f"[WS] WebSocket server started on alternative port {HOST}:{alt_port}")
                         print(f"[WS] Update your client to connect to port {alt_port}")
                         await asyncio.Future()
@@ -548,6 +1355,7 @@ async def cli_loop():
     print("\n[CLI] Умный голосовой помощник — текстовый режим. Введите 'exit' для выхода.")
     print(f"[CLI] Режим производительности: {PERFORMANCE_MODE}")
     print(f"[CLI] Введите 'stats' для просмотра статистики\n")
+    await preload_models(services=False)
     
     while True:
         try:
@@ -556,32 +1364,37 @@ async def cli_loop():
                 print("[CLI] Завершение работы.")
                 break
             if user_input.lower() == "stats":
-                stats = perf.get_stats()
-                print(f"[STATS] {stats}")
+                stats = metrics.get_stats()
+                for stage, values in stats["stages"].items():
+                    print(f"[STATS] {stage}: {values}")
+                print(f"[STATS] Счётчики: {stats['counters']}")
+                print(f"[STATS] STT pool: {stt_pool.get_stats()}")
+                print(f"[STATS] TTS pool: {tts_pool.get_stats()}")
+                print(f"[STATS] Scheduler: {scheduler.get_stats()}")
+                print(f"[STATS] Speculation: {get_speculation_stats()}")
+                print(f"[STATS] LLM cache: {llm_cache.get_stats()}")
+                print(f"[STATS] LLM streams: {llm_manager.get_stream_stats()}")
+                if llm_manager.residency:
+                    print(f"[STATS] LLM residency: {llm_manager.residency.get_stats()}")
+                print(f"[STATS] Tool single-flight: {tool_flight.get_stats()}")
                 continue
             if not user_input:
                 continue
             
             state = AgentState(text=TextMsg(user_input))
-            result = await app.ainvoke(state)
-            
-            response_text = None
-            for value in dict(result).values():
-                if hasattr(value, 'text') and value.text:
-                    response_text = value.text.text if hasattr(value.text, 'text') else value.text
-                elif isinstance(value, str):
-                    response_text = value
-                elif isinstance(value, TextMsg):
-                    response_text = value.text
-                
-                if response_text:
-                    break
+            with metrics.request("cli"):
+                result = await run_pipeline(state)
             
+            response_text = result.text.text if result.text else None
             print(f"Ассистент: {response_text or '[Нет ответа]'}")
                 
         except (KeyboardInterrupt, EOFError):
             print("\n[CLI] Завершение работы.")
             break
+    await llm_manager.close()
+    llm_cache.close()
+
+IMPORT_TIME = time.perf_counter() - _import_started
 
 if __name__ == "__main__":
     import sys
@@ -597,4 +1410,6 @@ if __name__ == "__main__":
         try:
             asyncio.run(main_ws())
         except KeyboardInterrupt:
-            print("Interrupted.")
\ No newline at end of file
+            print("Interrupted.")
+    # Дописываем отложенные изменения кэша ответов
+    llm_cache.close()
@@ -0,0 +1,218 @@
+# agent_bench.py
+"""
+Нагрузочный прогон конвейера agent.py без Vosk, Piper, Ollama и MQTT.
+STT, TTS, LLM и выполнение инструментов заменяются локальными заглушками
+с заданным распределением задержек; фразы корпуса прогоняются через
+граф (app.ainvoke), run_pipeline (как в handle) или текстом (как в cli_loop)
+при разных уровнях параллелизма.
+
+    python agent_bench.py --mode pipeline --concurrency 1,2,4 --requests 60 \\
+        --stt lognormal:0.15,0.3 --llm normal:0.8,0.2 --tts uniform:0.05,0.15
+
+Распределения: const:S, uniform:A,B, normal:MEAN,SD, lognormal:MEDIAN,SIGMA (секунды).
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import time
+from types import SimpleNamespace
+from typing import List
+
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import agent
+from agent import AgentState, AudioMsg, TextMsg
+from llm_cache import LLMCache
+from llm_module import LLMManager
+from metrics import metrics
+
+DEFAULT_CORPUS = [
+    "который час",
+    "сколько времени",
+    "какая погода",
+    "какая сейчас погода на улице",
+    "поставь таймер на пять минут",
+    "напомни позвонить маме через час",
+    "позвони папе",
+    "привет как дела",
+    "расскажи анекдот",
+    "что ты умеешь",
+]
+
+# Ответы заглушки LLM на классификацию: метка текстом, без logprobs (как у Claude)
+CLASSIFICATION_KEYWORDS = [
+    ("напомн", "НАПОМИНАНИЕ"),
+    ("таймер", "ТАЙМЕР"),
+    ("позвон", "ЗВОНОК"),
+    ("погод", "ПОГОДА"),
+    ("врем", "ВРЕМЯ"),
+    ("час", "ВРЕМЯ"),
+]
+
+
+class Latency:
+    """Распределение задержки заглушки; random.Random с seed делает прогоны повторяемыми"""
+
+    def __init__(self, spec: str, rng: random.Random):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",") if value]
+        self.rng = rng
+        if kind not in ("const", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Неизвестное распределение: {spec}")
+
+    def sample(self) -> float:
+        p = self.params
+        if self.kind == "const":
+            value = p[0]
+        elif self.kind == "uniform":
+            value = self.rng.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            value = self.rng.gauss(p[0], p[1])
+        else:
+            value = self.rng.lognormvariate(math.log(p[0]), p[1])
+        return max(0.0, value)
+
+
+class FakeChatModel:
+    """Вместо llm_manager.llm: классификация по ключевым словам или болтовня, целиком или потоком слов"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.classification_prompt = agent.CLASSIFICATION_PROMPT
+
+    def reply(self, messages) -> str:
+        system = next((m.content for m in messages if m.type == "system"), "")
+        text = next((m.content for m in messages if m.type == "human"), "")
+        if system == self.classification_prompt:
+            lowered = text.lower()
+            return next((label for keyword, label in CLASSIFICATION_KEYWORDS if keyword in lowered), "НЕТ")
+        return f"Конечно. Вы сказали: {text}. Чем ещё помочь?"
+
+    async def ainvoke(self, messages):
+        await asyncio.sleep(self.latency.sample())
+        return SimpleNamespace(content=self.reply(messages))
+
+
+    async def astream(self, messages):
+        words = self.reply(messages).split(" ")
+        delay = self.latency.sample() / max(1, len(words))
+        for word in words:
+            await asyncio.sleep(delay)
+            yield SimpleNamespace(content=word + " ")
+
+
+class FakeLLMManager(LLMManager):
+    """Настоящий LLMManager (потоки, замеры TTFT) поверх заглушки модели"""
+
+    def __init__(self, latency: Latency):
+        super().__init__(provider="bench", preload=False)
+        self._llm = FakeChatModel(latency)
+
+
+def install_fakes(args, rng: random.Random):
+    stt_latency = Latency(args.stt, rng)
+    tts_latency = Latency(args.tts, rng)
+    tool_latency = Latency(args.tool, rng)
+
+    async def fake_stt(audio: AudioMsg) -> str:
+        # Корпус передаётся "аудио" в виде UTF-8 текста
+        await asyncio.sleep(stt_latency.sample())
+        return audio.raw.decode("utf-8")
+
+    async def fake_tts(text: str, formats=None) -> bytes:
+        await asyncio.sleep(tts_latency.sample())
+        return b"RIFF" + b"\x00" * (len(text) * 64)
+
+    def fake_execute_tool(tool_name, tool_args) -> str:
+        # Выполняется в пуле потоков, как настоящий вызов через MQTT
+        time.sleep(tool_latency.sample())
+        return f"{tool_name}: готово"
+
+    agent.stt_vosk = agent.metrics.timed("stt", kind="call")(fake_stt)
+    agent.tts_client = agent.metrics.timed("tts", kind="call")(fake_tts)
+    agent.execute_tool = fake_execute_tool
+    agent.llm_manager = FakeLLMManager(Latency(args.llm, rng))
+
+
+def make_state(mode: str, text: str, site_id: str) -> AgentState:
+    if mode == "cli":
+        return AgentState(text=TextMsg(text))
+    return AgentState(audio=AudioMsg(text.encode("utf-8")), site_id=site_id)
+
+
+async def run_level(args, corpus: List[str], concurrency: int) -> dict:
+    metrics.reset()
+    # Кэш LLM только в памяти, свежий на каждый уровень; по умолчанию выключен
+    agent.llm_cache = LLMCache("bench", path=None, max_entries=500 if args.llm_cache else 0)
+    run = agent.app.ainvoke if args.mode == "graph" else agent.run_pipeline
+    counter = iter(range(args.requests))
+
+    async def worker(index: int):
+        site_id = f"site{index}"
+        for i in counter:
+            with metrics.request(site_id):
+                await run(make_state(args.mode, corpus[i % len(corpus)], site_id))
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    return {"concurrency": concurrency, "elapsed": elapsed, **metrics.get_stats()}
+
+
+def print_report(result: dict, requests: int):
+    stages, counters = result["stages"], result["counters"]
+    total = stages.get("request:request", {})
+    print(f"\n=== Параллелизм {result['concurrency']}: {requests} запросов за {result['elapsed']:.2f}s, "
+          f"{requests / result['elapsed']:.2f} req/s, "
+          f"p50 {total.get('p50', 0):.3f}s p95 {total.get('p95', 0):.3f}s p99 {total.get('p99', 0):.3f}s")
+    print(f"{'стадия':<22}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, values in stages.items():
+        if name != "request:request":
+            print(f"{name:<22}{values['count']:>7}{values['p50']:>9.3f}{values['p95']:>9.3f}{values['p99']:>9.3f}")
+
+    def group(prefix: str) -> str:
+        items = {key[len(prefix) + 1:-1].split("=", 1)[-1]: value
+                 for key, value in counters.items() if key.startswith(prefix + "{")}
+        return ", ".join(f"{key}: {value:g}" for key, value in sorted(items.items())) or "-"
+
+    print(f"Методы разбора: {group('parse_method')}")
+    print(f"Вызовы LLM: {group('llm_calls')}")
+    print(f"Путь обработки: {group('pipeline')}")
+    print(f"Гонка разбора: {group('parse_race')}")
+    print(f"Деградации: {group('degradations')}")
+    print(f"Токены LLM: {group('llm_tokens')}, отменённые потоки: {group('llm_streams_cancelled')}")
+    print(f"Ошибки: {group('errors')}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон конвейера агента на заглушках")
+    parser.add_argument("--mode", choices=["graph", "pipeline", "cli"], default="pipeline")
+    parser.add_argument("--concurrency", default="1,2,4", help="уровни параллелизма через запятую")
+    parser.add_argument("--requests", type=int, default=50, help="запросов на каждый уровень")
+    parser.add_argument("--corpus", help="файл с фразами, по одной в строке")
+    parser.add_argument("--stt", default="lognormal:0.15,0.3")
+    parser.add_argument("--tts", default="uniform:0.05,0.15")
+    parser.add_argument("--llm", default="normal:0.8,0.2")
+    parser.add_argument("--tool", default="const:0.02")
+    parser.add_argument("--llm-cache", action="store_true", help="включить кэш ответов LLM (в памяти)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = DEFAULT_CORPUS
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+
+    install_fakes(args, random.Random(args.seed))
+    print(f"[BENCH] Режим {args.mode}, {len(corpus)} фраз, лимиты стадий: "
+          f"{ {name: stage.limit for name, stage in agent.scheduler.stages.items()} }")
+    for level in (int(value) for value in args.concurrency.split(",") if value.strip()):
+        print_report(await run_level(args, corpus, level), args.requests)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
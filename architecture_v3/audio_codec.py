@@ -0,0 +1,124 @@
+# audio_codec.py
+import io
+import os
+from typing import List, Optional
+
+from audio_utils import PCM16Resampler, pcm_to_wav
+
+# Частота для Opus: кодек поддерживает только 8/12/16/24/48 кГц
+try:
+    OPUS_SAMPLE_RATE = int(os.getenv("TTS_OPUS_SAMPLE_RATE", "24000"))
+except (ValueError, TypeError):
+    OPUS_SAMPLE_RATE = 24000
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+# Имена форматов в запросе клиента -> имена в заголовке ответа
+FORMAT_NAMES = {
+    "opus": "ogg_opus",
+    "pcm": "pcm_s16le",
+    "wav": "wav",
+}
+
+try:
+    import numpy as np
+    import soundfile as sf
+    OPUS_AVAILABLE = "OPUS" in sf.available_subtypes("OGG")
+except (ImportError, OSError):
+    OPUS_AVAILABLE = False
+
+
+def supported_formats(stream: bool = False) -> List[str]:
+    formats = ["opus"] if OPUS_AVAILABLE else []
+    formats.append("pcm")
+    # Потоковый WAV не имеет смысла: размер в заголовке заранее неизвестен
+    if not stream:
+        formats.append("wav")
+    return formats
+
+
+def negotiate_format(requested: Optional[List[str]], stream: bool = False) -> str:
+    """Выбирает первый поддерживаемый формат из списка предпочтений клиента"""
+    available = supported_formats(stream)
+    for fmt in requested or []:
+        fmt = str(fmt).lower()
+        if fmt in available:
+            return fmt
+    return "pcm" if stream else "wav"
+
+
+class AudioEncoder:
+    """Потоковый кодировщик: encode() для каждого куска PCM, finish() в конце"""
+
+    format_name = "pcm_s16le"
+
+    def __init__(self, src_rate: int, sample_rate: Optional[int] = None):
+        self.src_rate = src_rate
+        self.sample_rate = sample_rate or src_rate
+        self.channels = 1
+        # Куски одного потока передискретизируются как единый сигнал
+        self._resampler = PCM16Resampler(src_rate, self.sample_rate)
+
+    def header(self) -> dict:
+        return {"format": self.format_name, "sample_rate": self.sample_rate, "channels": self.channels}
+
+    def encode(self, pcm: bytes) -> bytes:
+        return self._resampler.process(pcm)
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class WavEncoder(AudioEncoder):
+    """WAV собирается целиком в finish(), т.к. длина пишется в заголовок"""
+
+    format_name = "wav"
+
+    def __init__(self, src_rate: int, sample_rate: Optional[int] = None):
+        super().__init__(src_rate, sample_rate)
+        self._chunks = []
+
+    def encode(self, pcm: bytes) -> bytes:
+        self._chunks.append(super().encode(pcm))
+        return b""
+
+    def finish(self) -> bytes:
+        return pcm_to_wav(b"".join(self._chunks), self.sample_rate)
+
+
+class OpusEncoder(AudioEncoder):
+    """OGG/Opus через libsndfile; готовые OGG-страницы отдаются по мере записи"""
+
+    format_name = "ogg_opus"
+
+    def __init__(self, src_rate: int, sample_rate: Optional[int] = None):
+        rate = sample_rate if sample_rate in OPUS_RATES else OPUS_SAMPLE_RATE
+        super().__init__(src_rate, rate)
+        self._buffer = io.BytesIO()
+        self._file = sf.SoundFile(self._buffer, mode='w', samplerate=self.sample_rate, channels=1,
+                                  format='OGG', subtype='OPUS')
+
+    def _drain(self) -> bytes:
+        # Отданное из буфера убирается: он не растёт на весь ответ и не копируется целиком
+        with self._buffer.getbuffer() as view:
+            data = bytes(view)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(super().encode(pcm), dtype=np.int16)
+        if samples.size:
+            self._file.write(samples)
+        return self._drain()
+
+    def finish(self) -> bytes:
+        self._file.close()
+        return self._drain()
+
+
+def create_encoder(fmt: str, src_rate: int, sample_rate: Optional[int] = None) -> AudioEncoder:
+    if fmt == "opus":
+        return OpusEncoder(src_rate, sample_rate)
+    if fmt == "wav":
+        return WavEncoder(src_rate, sample_rate)
+    return AudioEncoder(src_rate, sample_rate)
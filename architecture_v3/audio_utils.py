@@ -0,0 +1,70 @@
+# audio_utils.py
+import io
+import wave
+
+
+def wav_to_pcm(wav_bytes: bytes):
+    """Возвращает (pcm, sample_rate, channels, sample_width) из WAV-байтов"""
+    with wave.open(io.BytesIO(wav_bytes), 'rb') as wav_file:
+        return (
+            wav_file.readframes(wav_file.getnframes()),
+            wav_file.getframerate(),
+            wav_file.getnchannels(),
+            wav_file.getsampwidth(),
+        )
+
+
+def pcm_to_wav(pcm: bytes, sample_rate: int, channels: int = 1, sample_width: int = 2) -> bytes:
+    """Собирает WAV в памяти из сырого PCM"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def resample_pcm16(pcm: bytes, src_rate: int, dst_rate: int) -> bytes:
+    """Линейная передискретизация моно PCM s16le (достаточно для речи)"""
+    if src_rate == dst_rate or not pcm:
+        return pcm
+    import numpy as np
+
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+    dst_length = max(1, int(round(len(samples) * dst_rate / src_rate)))
+    positions = np.linspace(0, len(samples) - 1, dst_length, dtype=np.float64)
+    resampled = np.interp(positions, np.arange(len(samples)), samples)
+    return np.clip(resampled, -32768, 32767).astype(np.int16).tobytes()
+
+
+class PCM16Resampler:
+    """
+    Та же линейная передискретизация для потока кусков: последний отсчёт и
+    дробная позиция переносятся в следующий кусок, поэтому на стыках нет
+    щелчков, а длина результата не копит ошибку округления от куска к куску.
+    """
+
+    def __init__(self, src_rate: int, dst_rate: int):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self._step = src_rate / dst_rate
+        self._last = None
+        # Позиция следующего выходного отсчёта относительно self._last
+        self._position = 0.0
+
+    def process(self, pcm: bytes) -> bytes:
+        if self.src_rate == self.dst_rate or not pcm:
+            return pcm
+        import numpy as np
+
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        if self._last is not None:
+            samples = np.concatenate(([self._last], samples))
+        end = len(samples) - 1
+        count = int(np.floor((end - self._position) / self._step)) + 1 if self._position <= end else 0
+        positions = self._position + np.arange(count, dtype=np.float64) * self._step
+        resampled = np.interp(positions, np.arange(len(samples)), samples)
+        self._position += count * self._step - end
+        self._last = samples[-1]
+        return np.clip(resampled, -32768, 32767).astype(np.int16).tobytes()
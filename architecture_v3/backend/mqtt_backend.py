@@ -391,8 +391,11 @@ def play_sound_file(sound_file_path):
         return False
 
 # Функция для прямого синтеза речи через TTS сервер
-def synthesize_speech(text):
-    """Синтезирует речь напрямую, отправляя запрос TTS серверу"""
+def synthesize_speech(text, priority="conversation"):
+    """
+    Синтезирует речь напрямую, отправляя запрос TTS серверу.
+    priority: alarm / reminder / conversation - порядок в очереди TTS сервера
+    """
     try:
         import websockets
         import asyncio
@@ -404,7 +407,7 @@ def synthesize_speech(text):
             try:
                 async with websockets.connect(uri) as websocket:
                     print(f"[TTS] Отправка текста: {text}")
-                    await websocket.send(text)
+                    await websocket.send(json.dumps({"text": text, "priority": priority}, ensure_ascii=False))
                     
                     # Получаем аудио данные
                     audio_data = await websocket.recv()
@@ -468,14 +471,14 @@ def event_checker(client):
                     time.sleep(1.5)
                     
                     # Напрямую синтезируем речь для воспроизведения
-                    tts_thread = threading.Thread(target=synthesize_speech, args=(response,), daemon=True)
+                    tts_thread = threading.Thread(target=synthesize_speech, args=(response, "alarm"), daemon=True)
                     tts_thread.start()
                     
                     # Даем время на обработку TTS
                     time.sleep(0.5)
                 # Если это напоминание, озвучиваем текст напоминания через TTS
                 elif event_type == "SetNotificationEvent":
-                    tts_thread = threading.Thread(target=synthesize_speech, args=(response,), daemon=True)
+                    tts_thread = threading.Thread(target=synthesize_speech, args=(response, "reminder"), daemon=True)
                     tts_thread.start()
                     time.sleep(0.5)
                 
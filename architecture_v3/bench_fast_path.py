@@ -0,0 +1,61 @@
+# bench_fast_path.py
+"""
+Сравнение накладных расходов: полный граф LangGraph против быстрого пути
+для команд, разобранных напрямую. STT, TTS и инструменты заменены мгновенными
+заглушками, поэтому разница - это стоимость самого конвейера.
+
+    python bench_fast_path.py [повторов]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+import agent
+from agent import AgentState, TextMsg
+
+COMMANDS = ["который час", "какая погода", "сколько времени"]
+
+
+async def fake_tts(text, formats=None):
+    return b"RIFF" + b"\x00" * 64
+
+
+async def fake_tool(name, args):
+    return f"{name}: ok"
+
+
+async def measure(run, repeats: int):
+    timings = []
+    for i in range(repeats):
+        state = AgentState(text=TextMsg(COMMANDS[i % len(COMMANDS)]))
+        start_time = time.perf_counter()
+        result = await run(state)
+        timings.append(time.perf_counter() - start_time)
+        assert result.audio is not None and result.parse_method == "direct", result
+    return timings
+
+
+async def main(repeats: int):
+    agent.tts_client = fake_tts
+    agent.run_tool = fake_tool
+
+    async def graph(state):
+        return AgentState(**await agent.app.ainvoke(state))
+
+    await measure(graph, 10)  # прогрев
+    await measure(agent.run_pipeline, 10)
+
+    for name, run in (("graph", graph), ("fast path", agent.run_pipeline)):
+        timings = sorted(await measure(run, repeats))
+        print(f"{name:>10}: mean {statistics.mean(timings) * 1000:.3f} ms, "
+              f"p50 {timings[len(timings) // 2] * 1000:.3f} ms, "
+              f"p95 {timings[int(len(timings) * 0.95)] * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
@@ -0,0 +1,74 @@
+# deadline.py
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+from metrics import metrics
+
+# Бюджет на фразу: от конца речи пользователя до начала ответа
+try:
+    REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "8"))
+except (ValueError, TypeError):
+    REQUEST_BUDGET = 8.0
+
+# Сколько оставить на синтез ответа: остальные стадии укладываются в бюджет минус этот запас
+try:
+    TTS_RESERVE = float(os.getenv("TTS_RESERVE", "1.0"))
+except (ValueError, TypeError):
+    TTS_RESERVE = 1.0
+
+# Меньше этого времени на вызов LLM не начинаем - отвечаем из кэша или заготовкой
+try:
+    LLM_MIN_BUDGET = float(os.getenv("LLM_MIN_BUDGET", "2.0"))
+except (ValueError, TypeError):
+    LLM_MIN_BUDGET = 2.0
+
+# Заготовка вместо ответа LLM, на который не хватило времени
+CANNED_REPLY = os.getenv("CANNED_REPLY", "Извините, сейчас не успеваю ответить. Спросите, пожалуйста, ещё раз.")
+
+
+class Deadline:
+    """
+    Срок обработки одной фразы. Узлы конвейера спрашивают, сколько осталось
+    (с учётом запаса на TTS), ограничивают по нему свои ожидания и отмечают
+    сработавшие деградации - они попадают в счётчик degradations{kind}.
+    """
+
+    def __init__(self, budget: float = REQUEST_BUDGET, reserve: float = TTS_RESERVE):
+        self.budget = budget
+        self.reserve = reserve
+        self.expires_at = time.monotonic() + budget
+        self.degradations: List[str] = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def timeout(self) -> float:
+        """Сколько можно ждать стадию, не трогая запас на синтез ответа"""
+        return max(0.0, self.remaining() - self.reserve)
+
+    def allows(self, needed: float) -> bool:
+        return self.timeout() >= needed
+
+    def degrade(self, kind: str):
+        self.degradations.append(kind)
+        metrics.inc("degradations", kind=kind)
+        print(f"[DEADLINE] {kind}: осталось {self.remaining():.2f}s из {self.budget:.1f}s")
+
+
+class DeadlineExceeded(Exception):
+    """Стадия не уложилась в срок фразы"""
+
+
+async def within(deadline: Optional[Deadline], awaitable):
+    """await с таймаутом по сроку фразы; без срока - как обычный await"""
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, deadline.timeout())
+    except asyncio.TimeoutError:
+        # Собственный таймаут стадии (например, подключения) - не срок фразы
+        if deadline.timeout() > 0:
+            raise
+        raise DeadlineExceeded(f"срок фразы {deadline.budget:.1f}s исчерпан")
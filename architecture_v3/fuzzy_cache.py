@@ -0,0 +1,164 @@
+# fuzzy_cache.py
+import os
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Размерность хэшированного пространства n-грамм и длина n-граммы
+try:
+    FUZZY_CACHE_DIM = int(os.getenv("FUZZY_CACHE_DIM", "512"))
+except (ValueError, TypeError):
+    FUZZY_CACHE_DIM = 512
+
+try:
+    FUZZY_CACHE_NGRAM = int(os.getenv("FUZZY_CACHE_NGRAM", "3"))
+except (ValueError, TypeError):
+    FUZZY_CACHE_NGRAM = 3
+
+# Порог косинусной близости, начиная с которого фразы считаются одной и той же
+try:
+    FUZZY_CACHE_THRESHOLD = float(os.getenv("FUZZY_CACHE_THRESHOLD", "0.9"))
+except (ValueError, TypeError):
+    FUZZY_CACHE_THRESHOLD = 0.9
+
+# Слова, которые меняют смысл при почти том же написании
+_NEGATIONS = {"не", "нет", "ни", "без"}
+_NUMBER = re.compile(r'\d+')
+
+
+def _number_words() -> Dict[str, str]:
+    """
+    Числительные словами (так их выдаёт Vosk) -> значение: «двадцать пять» и
+    «двадцать шесть» пишутся почти одинаково, но это разные вопросы.
+    Падежные формы дают то же значение, порядковые - со суффиксом «-й».
+    """
+    words: Dict[str, str] = {}
+
+    def add(value, *forms):
+        for form in forms:
+            words[form] = str(value)
+
+    add(0, "ноль", "нуль", "нуля", "нулю", "нулем")
+    add(1, "один", "одна", "одно", "одну", "одного", "одной", "одному", "одним", "одном")
+    add(1.5, "полтора", "полторы", "полутора")
+    add(2, "два", "две", "двух", "двум", "двумя")
+    add(3, "три", "трех", "трем", "тремя")
+    add(4, "четыре", "четырех", "четырем", "четырьмя")
+    soft = [(5, "пят"), (6, "шест"), (7, "сем"), (8, "восем"), (8, "восьм"), (9, "девят"), (10, "десят"),
+            (11, "одиннадцат"), (12, "двенадцат"), (13, "тринадцат"), (14, "четырнадцат"), (15, "пятнадцат"),
+            (16, "шестнадцат"), (17, "семнадцат"), (18, "восемнадцат"), (19, "девятнадцат"),
+            (20, "двадцат"), (30, "тридцат")]
+    for value, stem in soft:
+        add(value, stem + "ь", stem + "и", stem + "ью")
+    add(40, "сорок", "сорока")
+    for value, nominative, oblique, instrumental in [(50, "пятьдесят", "пятидесяти", "пятьюдесятью"),
+                                                     (60, "шестьдесят", "шестидесяти", "шестьюдесятью"),
+                                                     (70, "семьдесят", "семидесяти", "семьюдесятью"),
+                                                     (80, "восемьдесят", "восьмидесяти", "восемьюдесятью")]:
+        add(value, nominative, oblique, instrumental)
+    add(90, "девяносто", "девяноста")
+    add(100, "сто", "ста", "сотня", "сотни")
+    add(200, "двести", "двухсот")
+    add(300, "триста", "трехсот")
+    add(400, "четыреста", "четырехсот")
+    for value, nominative, genitive in [(500, "пятьсот", "пятисот"), (600, "шестьсот", "шестисот"),
+                                        (700, "семьсот", "семисот"), (800, "восемьсот", "восьмисот"),
+                                        (900, "девятьсот", "девятисот")]:
+        add(value, nominative, genitive)
+    add(1000, "тысяча", "тысячи", "тысячу", "тысяч", "тысячей", "тысячам")
+    add(10 ** 6, "миллион", "миллиона", "миллионов")
+
+    endings = ("ый", "ой", "ая", "ое", "ого", "ому", "ым", "ом", "ую", "ые", "ых", "ыми")
+    ordinals = [(1, "перв"), (2, "втор"), (4, "четверт"), (5, "пят"), (6, "шест"), (7, "седьм"), (8, "восьм"),
+                (9, "девят"), (10, "десят"), (20, "двадцат"), (30, "тридцат"), (40, "сороков"), (100, "сот")]
+    ordinals += [(value, stem) for value, stem in soft if 11 <= value <= 19]
+    for value, stem in ordinals:
+        add(f"{value}-й", *(stem + ending for ending in endings))
+    add("3-й", "третий", "третья", "третье", "третьего", "третьему", "третьим", "третьем", "третью", "третьи")
+    return words
+
+
+_NUMBER_WORDS = _number_words()
+
+
+def vectorize(text: str, dim: int = FUZZY_CACHE_DIM, n: int = FUZZY_CACHE_NGRAM) -> np.ndarray:
+    """Мешок символьных n-грамм по словам, захэшированный в dim измерений и нормированный"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in text.split():
+        padded = f" {word} "
+        for i in range(max(1, len(padded) - n + 1)):
+            vector[zlib.crc32(padded[i:i + n].encode("utf-8")) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _signature(text: str) -> Tuple[frozenset, frozenset]:
+    words = text.split()
+    numbers = set(_NUMBER.findall(text)) | {_NUMBER_WORDS[word] for word in words if word in _NUMBER_WORDS}
+    return frozenset(numbers), frozenset(word for word in words if word in _NEGATIONS)
+
+
+class FuzzyIndex:
+    """
+    Индекс фраз для поиска почти-дубликатов: строки матрицы - векторы n-грамм,
+    поиск - одно матричное умножение. Фразы с разными числами (цифрами или
+    словами) или отрицаниями дубликатами не считаются, как бы близко они ни были написаны.
+    """
+
+    def __init__(self, dim: int = FUZZY_CACHE_DIM, threshold: float = FUZZY_CACHE_THRESHOLD, capacity: int = 64):
+        self.dim = dim
+        self.threshold = threshold
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.keys: List[Optional[str]] = []
+        self.signatures: List[Optional[Tuple[frozenset, frozenset]]] = []
+        self.rows: Dict[str, int] = {}
+        self._free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, key: str, text: str):
+        if key in self.rows:
+            self.remove(key)
+        if self._free:
+            row = self._free.pop()
+        else:
+            row = len(self.keys)
+            if row >= len(self.matrix):
+                grown = np.zeros((len(self.matrix) * 2, self.dim), dtype=np.float32)
+                grown[:len(self.matrix)] = self.matrix
+                self.matrix = grown
+            self.keys.append(None)
+            self.signatures.append(None)
+        self.matrix[row] = vectorize(text, self.dim)
+        self.keys[row] = key
+        self.signatures[row] = _signature(text)
+        self.rows[key] = row
+
+    def remove(self, key: str):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        self.matrix[row] = 0.0
+        self.keys[row] = None
+        self.signatures[row] = None
+        self._free.append(row)
+
+    def search(self, text: str) -> Optional[Tuple[str, float]]:
+        """Возвращает (ключ, близость) самой похожей фразы выше порога или None"""
+        if not self.rows:
+            return None
+        scores = self.matrix[:len(self.keys)] @ vectorize(text, self.dim)
+        signature = _signature(text)
+        # Обычно подходит лучший кандидат; проверяем несколько на случай расхождения чисел
+        top = min(3, len(scores))
+        candidates = np.argpartition(-scores, top - 1)[:top]
+        for row in candidates[np.argsort(-scores[candidates])]:
+            score = float(scores[row])
+            if score < self.threshold:
+                break
+            if self.signatures[row] == signature:
+                return self.keys[row], score
+        return None
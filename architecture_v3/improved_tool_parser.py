@@ -97,6 +97,16 @@ class OptimizedToolParser:
         # Минимальная уверенность для выполнения инструмента
         self.min_confidence = 0.4
         
+        # Метки LLM-классификации намерений: метка -> когда её выбирать
+        self.intent_labels = {
+            "ВРЕМЯ": "спрашивают про время",
+            "ПОГОДА": "спрашивают про погоду",
+            "ТАЙМЕР": "просят поставить таймер",
+            "НАПОМИНАНИЕ": "просят напомнить",
+            "ЗВОНОК": "просят позвонить",
+            "НЕТ": "обычный разговор",
+        }
+        
         # Простой системный промпт для LLM
         self.simple_system_prompt = """Отвечай ТОЛЬКО одним словом:
 - ВРЕМЯ - если спрашивают про время
@@ -146,17 +156,7 @@ class OptimizedToolParser:
         matches = []
         
         for tool_name, config in self.tool_patterns.items():
-            confidence = 0.0
-            
-            # Проверяем ключевые слова
-            keyword_matches = sum(1 for keyword in config["keywords"] if keyword in text)
-            confidence += keyword_matches * 0.3
-            
-            # Проверяем паттерны
-            for pattern in config["patterns"]:
-                if re.search(pattern, text, re.IGNORECASE):
-                    confidence += 0.5
-                    break
+            confidence = self._evidence(config, text)
             
             # Добавляем boost уверенности
             confidence += config.get("confidence_boost", 0)
@@ -195,6 +195,31 @@ class OptimizedToolParser:
         
         return [matches[0]]
 
+    def _evidence(self, config: Dict[str, Any], text: str) -> float:
+        """Уверенность по ключевым словам и паттернам инструмента (без boost)"""
+        # Проверяем ключевые слова
+        keyword_matches = sum(1 for keyword in config["keywords"] if keyword in text)
+        confidence = keyword_matches * 0.3
+        
+        # Проверяем паттерны
+        for pattern in config["patterns"]:
+            if re.search(pattern, text, re.IGNORECASE):
+                confidence += 0.5
+                break
+        return confidence
+
+    def direct_confidence(self, text: str) -> float:
+        """
+        Насколько фраза похожа на команду по прямому разбору: теги или лучшее
+        совпадение ключевых слов и паттернов. Boost приоритета не учитывается -
+        иначе любая фраза «похожа» на запрос времени.
+        """
+        tag_result = self._parse_action_tags(text)
+        if tag_result:
+            return tag_result[0].confidence
+        text_lower = text.lower().strip()
+        return max(self._evidence(config, text_lower) for config in self.tool_patterns.values())
+
     def _parse_with_llm_hint(self, original_text: str, text_lower: str) -> Optional[List[ToolCall]]:
         """Placeholder для LLM-помощи. Будет реализован позже"""
         # Этот метод будет вызывать LLM для получения подсказки
@@ -0,0 +1,96 @@
+# llm_bench.py
+"""
+Сравнение задержек одной и той же локальной модели через Ollama (HTTP, отдельный
+демон) и через llama.cpp в процессе агента. Сравнение честное, только если обе
+стороны работают с одним GGUF: LOCAL_MODEL - имя модели в Ollama, LLAMACPP_MODEL_PATH -
+путь к её файлу (у Ollama это blob из ~/.ollama/models/blobs, путь показывает
+`ollama show --modelfile <модель>`). Контекст, потоки и длина ответа берутся из LOCAL_*.
+
+    python llm_bench.py --providers local,llamacpp --repeats 5
+
+Для каждого провайдера: загрузка (warm: загрузка модели и первый ответ), затем
+фразы корпуса - ответ потоком (первый токен, токен/с, полное время) и классификация.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+# Прогон не должен попадать в статистику использования колонки
+os.environ.setdefault("LLM_RESIDENCY", "false")
+
+from agent import CONVERSATION_SYSTEM_PROMPT, tool_parser
+from llm_module import LLMManager
+from metrics import RollingHistogram
+
+REPLY_PROMPTS = [
+    "привет как дела",
+    "расскажи анекдот",
+    "что ты умеешь",
+    "как приготовить омлет",
+]
+
+CLASSIFY_PROMPTS = [
+    "какая сейчас погода на улице",
+    "сколько времени",
+    "напомни позвонить маме через час",
+    "расскажи анекдот",
+]
+
+
+async def bench_provider(provider: str, repeats: int) -> dict:
+    manager = LLMManager(provider=provider, preload=False)
+    start_time = time.perf_counter()
+    await manager.warm()
+    load = time.perf_counter() - start_time
+
+    timings = {name: RollingHistogram() for name in ("ttft", "reply", "tok_s", "classify")}
+    for _ in range(repeats):
+        for prompt in REPLY_PROMPTS:
+            stream = manager.stream_response(prompt, CONVERSATION_SYSTEM_PROMPT, purpose="bench")
+            async for _ in stream:
+                pass
+            if stream.ttft is not None:
+                timings["ttft"].observe(stream.ttft)
+            timings["reply"].observe(stream.elapsed)
+            timings["tok_s"].observe(stream.tokens_per_s)
+        for prompt in CLASSIFY_PROMPTS:
+            started = time.perf_counter()
+            await manager.classify(prompt, tool_parser.intent_labels)
+            timings["classify"].observe(time.perf_counter() - started)
+    await manager.close()
+    return {"provider": manager.get_provider_info(), "load": load,
+            **{name: histogram.quantiles((0.5, 0.95)) for name, histogram in timings.items()}}
+
+
+def print_report(results: list):
+    print(f"\n{'провайдер':<34}{'загрузка':>10}{'TTFT p50':>10}{'TTFT p95':>10}"
+          f"{'ответ p50':>11}{'ток/с p50':>11}{'класс. p50':>12}{'класс. p95':>12}")
+    for result in results:
+        info = result["provider"]
+        name = f"{info['provider']} {info['model']}"[:33]
+        print(f"{name:<34}{result['load']:>10.2f}{result['ttft'][0.5]:>10.3f}{result['ttft'][0.95]:>10.3f}"
+              f"{result['reply'][0.5]:>11.3f}{result['tok_s'][0.5]:>11.1f}"
+              f"{result['classify'][0.5]:>12.3f}{result['classify'][0.95]:>12.3f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Задержки локальной LLM: Ollama против llama.cpp в процессе")
+    parser.add_argument("--providers", default="local,llamacpp", help="провайдеры через запятую")
+    parser.add_argument("--repeats", type=int, default=5, help="повторов корпуса на провайдера")
+    args = parser.parse_args()
+
+    results = []
+    for provider in (name.strip() for name in args.providers.split(",") if name.strip()):
+        print(f"[BENCH] {provider}...")
+        try:
+            results.append(await bench_provider(provider, args.repeats))
+        except Exception as e:
+            print(f"[BENCH] {provider} недоступен: {e}")
+    print_report(results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
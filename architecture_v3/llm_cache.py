@@ -0,0 +1,276 @@
+# llm_cache.py
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from fuzzy_cache import FuzzyIndex, FUZZY_CACHE_THRESHOLD
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(BASE_DIR, "llm_cache.db"))
+
+try:
+    LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "500"))
+except (ValueError, TypeError):
+    LLM_CACHE_MAX_ENTRIES = 500
+
+try:
+    LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(2 * 2**20)))
+except (ValueError, TypeError):
+    LLM_CACHE_MAX_BYTES = 2 * 2**20
+
+# Время жизни ответа (сек): разговорные ответы со временем устаревают
+try:
+    LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(24 * 3600)))
+except (ValueError, TypeError):
+    LLM_CACHE_TTL = 24 * 3600.0
+
+# Запись в SQLite идёт пачками из фонового потока раз в столько секунд (и при close)
+try:
+    LLM_CACHE_FLUSH_INTERVAL = float(os.getenv("LLM_CACHE_FLUSH_INTERVAL", "5"))
+except (ValueError, TypeError):
+    LLM_CACHE_FLUSH_INTERVAL = 5.0
+
+# Поиск почти-дубликатов ("какая сегодня погода" / "какая погода сегодня") при промахе по точному ключу
+FUZZY_CACHE = os.getenv("FUZZY_CACHE", "true").lower() == "true"
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def normalize_prompt(text: str) -> str:
+    """'Привет!' и 'привет' дают один ключ: регистр, ё, пунктуация и пробелы не важны"""
+    text = (text or "").lower().replace("ё", "е")
+    text = _PUNCTUATION.sub(" ", text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def make_fingerprint(*parts) -> str:
+    """Отпечаток модели и системных промптов: при его смене кэш сбрасывается"""
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:16]
+
+
+class LLMCache:
+    """
+    LRU-кэш ответов LLM с TTL, ограниченный по числу записей и объёму,
+    с сохранением в SQLite между перезапусками. При промахе по точному ключу
+    ищется почти такая же фраза с тем же системным промптом (FuzzyIndex).
+
+    get и put вызываются прямо из event loop, поэтому SQLite они не трогают:
+    изменения копятся в памяти и записываются одной транзакцией фоновым
+    потоком (flush). Несброшенное при аварийном завершении теряется - это кэш.
+    """
+
+    def __init__(self, fingerprint: str, path: Optional[str] = LLM_CACHE_PATH,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 ttl: float = LLM_CACHE_TTL, fuzzy: bool = FUZZY_CACHE,
+                 fuzzy_threshold: float = FUZZY_CACHE_THRESHOLD,
+                 flush_interval: float = LLM_CACHE_FLUSH_INTERVAL):
+        self.fingerprint = fingerprint
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.fuzzy = fuzzy
+        self.fuzzy_threshold = fuzzy_threshold
+        # key -> (ответ, истекает_в, секунд генерации)
+        self._items: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        # key -> область (хэш системного промпта); по области - индекс нормализованных фраз
+        self._scopes: Dict[str, str] = {}
+        self._indexes: Dict[str, FuzzyIndex] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # Ещё не записанное: key -> строка entries (None - удалить) и key -> last_used
+        self._pending: Dict[str, Optional[tuple]] = {}
+        self._touched: Dict[str, float] = {}
+        self.flush_interval = max(0.1, flush_interval)
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.stats = {"hits": 0, "fuzzy_hits": 0, "misses": 0, "expired": 0, "evictions": 0, "saved_seconds": 0.0}
+        if path:
+            self._open()
+
+    @staticmethod
+    def make_key(prompt: str, system_prompt: str) -> str:
+        return hashlib.md5(f"{system_prompt}|{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_scope(system_prompt: str) -> str:
+        return hashlib.md5(system_prompt.encode("utf-8")).hexdigest()[:16]
+
+    # === Хранилище ===
+    def _open(self):
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+            if columns and "prompt" not in columns:
+                # Старый формат без текста фраз - для нечёткого поиска его не восстановить
+                self._db.execute("DROP TABLE entries")
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, response TEXT, "
+                             "expires_at REAL, cost REAL, last_used REAL, scope TEXT, prompt TEXT)")
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+            if row is None or row[0] != self.fingerprint:
+                if row is not None:
+                    print("[LLM CACHE] Модель или системный промпт изменились - кэш сброшен")
+                self._db.execute("DELETE FROM entries")
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (self.fingerprint,))
+            now = time.time()
+            self._db.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            rows = self._db.execute("SELECT key, response, expires_at, cost, scope, prompt FROM entries "
+                                    "ORDER BY last_used").fetchall()
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"[LLM CACHE] Хранилище {self.path} недоступно, кэш только в памяти: {e}")
+            self._db = None
+            return
+
+        for key, response, expires_at, cost, scope, prompt in rows:
+            self._add(key, response, expires_at, cost, scope, prompt)
+        self._evict()
+        print(f"[LLM CACHE] Загружено {len(self._items)} ответов из {self.path}")
+        self._flusher = threading.Thread(target=self._flush_loop, name="llm-cache-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        if self._db is None:
+            return
+        # _db_lock снаружи: пачки попадают в базу в том же порядке, в каком собраны
+        with self._db_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                touched, self._touched = self._touched, {}
+            if self._db is None or (not pending and not touched):
+                return
+            try:
+                with self._db:
+                    self._db.executemany("DELETE FROM entries WHERE key = ?",
+                                         [(key,) for key, row in pending.items() if row is None])
+                    self._db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         [row for row in pending.values() if row is not None])
+                    self._db.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                         [(last_used, key) for key, last_used in touched.items()])
+            except sqlite3.Error as e:
+                print(f"[LLM CACHE] Ошибка записи: {e}")
+
+    def close(self):
+        """Останавливает фоновую запись, дописывает остаток и закрывает хранилище"""
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # === Операции кэша ===
+    def get(self, prompt: str, system_prompt: str) -> Optional[str]:
+        key = self.make_key(prompt, system_prompt)
+        with self._lock:
+            if key not in self._items:
+                key = self._fuzzy_search(prompt, system_prompt)
+                if key is None:
+                    self.stats["misses"] += 1
+                    return None
+            response, expires_at, cost = self._items[key]
+            if expires_at <= time.time():
+                self._remove(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += cost
+            if self._db is not None:
+                self._touched[key] = time.time()
+            return response
+
+    def contains(self, prompt: str, system_prompt: str) -> bool:
+        """Есть ли живой ответ (точный или похожий) - без учёта в статистике и LRU"""
+        with self._lock:
+            key = self.make_key(prompt, system_prompt)
+            if key not in self._items:
+                key = self._fuzzy_search(prompt, system_prompt, record=False)
+            return key is not None and self._items[key][1] > time.time()
+
+    def put(self, prompt: str, system_prompt: str, response: str, cost: float = 0.0):
+        """cost - сколько секунд заняла генерация (для статистики сэкономленного времени)"""
+        size = len(response.encode("utf-8"))
+        if not response or size > self.max_bytes:
+            return
+        key = self.make_key(prompt, system_prompt)
+        scope = self.make_scope(system_prompt)
+        normalized = normalize_prompt(prompt)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._add(key, response, expires_at, cost, scope, normalized)
+            if self._db is not None:
+                self._pending[key] = (key, response, expires_at, cost, time.time(), scope, normalized)
+            self._evict()
+
+    def _add(self, key: str, response: str, expires_at: float, cost: float, scope: str, prompt: str):
+        self._items[key] = (response, expires_at, cost)
+        self._bytes += len(response.encode("utf-8"))
+        self._scopes[key] = scope
+        if self.fuzzy and prompt:
+            index = self._indexes.get(scope)
+            if index is None:
+                index = self._indexes[scope] = FuzzyIndex(threshold=self.fuzzy_threshold)
+            index.add(key, prompt)
+
+    def _remove(self, key: str):
+        response, _, _ = self._items.pop(key)
+        self._bytes -= len(response.encode("utf-8"))
+        index = self._indexes.get(self._scopes.pop(key, None))
+        if index is not None:
+            index.remove(key)
+        if self._db is not None:
+            self._pending[key] = None
+            self._touched.pop(key, None)
+
+    def _fuzzy_search(self, prompt: str, system_prompt: str, record: bool = True) -> Optional[str]:
+        index = self._indexes.get(self.make_scope(system_prompt)) if self.fuzzy else None
+        if index is None:
+            return None
+        found = index.search(normalize_prompt(prompt))
+        if found is None:
+            return None
+        key, score = found
+        if not record:
+            return key
+        self.stats["fuzzy_hits"] += 1
+        print(f"[LLM CACHE] Похожая фраза в кэше (близость {score:.2f}): '{prompt}'")
+        return key
+
+    def _evict(self):
+        while self._items and (len(self._items) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._items)))
+            self.stats["evictions"] += 1
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "saved_seconds": round(self.stats["saved_seconds"], 2),
+                "hit_ratio": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+            }
@@ -1,8 +1,20 @@
+import asyncio
+import json
+import math
 import os
-from typing import Optional, List, Dict, Any
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional, List, Dict, Any, AsyncIterator
 from dotenv import load_dotenv
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_core.language_models import BaseChatModel
+
+from metrics import RollingHistogram, metrics
+
+# LangChain импортируется при первом обращении к модели: импорт занимает заметную часть запуска
+if TYPE_CHECKING:
+    from langchain_core.language_models import BaseChatModel
 
 # --- ENVIRONMENT & GLOBALS ---
 load_dotenv()
@@ -26,11 +38,81 @@ LOCAL_TOP_K      = int(os.getenv("LOCAL_TOP_K",       "20"))   # Уменьше
 # Настройки квантизации для Ollama
 LOCAL_NUM_GPU    = int(os.getenv("LOCAL_NUM_GPU", "0"))           # Не используем GPU
 LOCAL_LOW_VRAM   = os.getenv("LOCAL_LOW_VRAM", "true").lower() == "true"
+# Параметры раннера Ollama: запрос с другими значениями перезагружает модель,
+# поэтому ответ, классификация и пинги ResidencyManager передают одни и те же
+LOCAL_RUNNER_OPTIONS = {
+    "num_ctx": LOCAL_CONTEXT,
+    "num_thread": LOCAL_THREADS,
+    "num_gpu": LOCAL_NUM_GPU,
+    "low_vram": LOCAL_LOW_VRAM,
+}
+
+# llama.cpp в процессе агента (LLM_PROVIDER=llamacpp): GGUF-файл, те же LOCAL_* для контекста и потоков
+LLAMACPP_MODEL_PATH = os.getenv("LLAMACPP_MODEL_PATH",
+                                os.getenv("LLM_MODEL_PATH", "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"))
+try:
+    LLAMACPP_BATCH = int(os.getenv("LLAMACPP_BATCH", "256"))
+except (ValueError, TypeError):
+    LLAMACPP_BATCH = 256
+try:
+    # Кэш состояний промптов в RAM: системные промпты разговора и классификации не пересчитываются
+    LLAMACPP_CACHE_MB = int(os.getenv("LLAMACPP_CACHE_MB", "64"))
+except (ValueError, TypeError):
+    LLAMACPP_CACHE_MB = 64
+LLAMACPP_MLOCK = os.getenv("LLAMACPP_MLOCK", "false").lower() == "true"
+# logprobs требуют logits_all - это память n_ctx x словарь и медленнее prefill
+LLAMACPP_LOGPROBS = os.getenv("LLAMACPP_LOGPROBS", "false").lower() == "true"
+
+# Удержание локальной модели в памяти Ollama (см. ResidencyManager)
+LLM_RESIDENCY = os.getenv("LLM_RESIDENCY", "true").lower() == "true"
+LLM_RESIDENCY_PATH = os.getenv("LLM_RESIDENCY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  "llm_residency.json"))
+try:
+    # Столько секунд после последнего запроса модель держится горячей в любом случае
+    RESIDENCY_ACTIVE_WINDOW = float(os.getenv("RESIDENCY_ACTIVE_WINDOW", "600"))
+except (ValueError, TypeError):
+    RESIDENCY_ACTIVE_WINDOW = 600.0
+try:
+    # Вес часа суток (запросов в этот час в среднем за день), начиная с которого час считается активным
+    RESIDENCY_HOUR_MIN = float(os.getenv("RESIDENCY_HOUR_MIN", "0.5"))
+except (ValueError, TypeError):
+    RESIDENCY_HOUR_MIN = 0.5
+try:
+    # Меньше стольких МБ свободной памяти - давление: модель не удерживается и выгружается в простое
+    RESIDENCY_MIN_FREE_MB = int(os.getenv("RESIDENCY_MIN_FREE_MB", "512"))
+except (ValueError, TypeError):
+    RESIDENCY_MIN_FREE_MB = 512
+try:
+    # Загрузка модели дольше этого времени означает, что запрос попал на холодную модель
+    RESIDENCY_COLD_LOAD = float(os.getenv("RESIDENCY_COLD_LOAD", "0.5"))
+except (ValueError, TypeError):
+    RESIDENCY_COLD_LOAD = 0.5
+
+# Классификация намерений (LLMManager.classify)
+try:
+    # Ответ - код метки из одного токена; запас на пробел/конец строки
+    CLASSIFY_MAX_TOKENS = int(os.getenv("CLASSIFY_MAX_TOKENS", "2"))
+except (ValueError, TypeError):
+    CLASSIFY_MAX_TOKENS = 2
+try:
+    CLASSIFY_TOP_LOGPROBS = int(os.getenv("CLASSIFY_TOP_LOGPROBS", "10"))
+except (ValueError, TypeError):
+    CLASSIFY_TOP_LOGPROBS = 10
+try:
+    # Температура калибровки: >1 смягчает самоуверенные распределения маленьких моделей
+    CLASSIFY_TEMPERATURE = float(os.getenv("CLASSIFY_TEMPERATURE", "1.0"))
+except (ValueError, TypeError):
+    CLASSIFY_TEMPERATURE = 1.0
+try:
+    # Вероятность метки, когда провайдер не отдаёт logprobs и метка известна только по тексту
+    CLASSIFY_TEXT_CONFIDENCE = float(os.getenv("CLASSIFY_TEXT_CONFIDENCE", "0.7"))
+except (ValueError, TypeError):
+    CLASSIFY_TEXT_CONFIDENCE = 0.7
 
 SHOW_TEXT = os.getenv("SHOW_TEXT", "true").lower() == "true"
 
 # --- PROVIDER INITIALIZATION ---
-def _init_llm(provider: str, temperature: float) -> BaseChatModel:
+def _init_llm(provider: str, temperature: float) -> "BaseChatModel":
     provider = provider.lower()
     model = LLM_MODEL or {
         "claude": CLAUDE_MODEL,
@@ -50,6 +132,11 @@ def _init_llm(provider: str, temperature: float) -> BaseChatModel:
             return ChatDeepSeek(model=model, temperature=temperature)
         except ImportError:
             raise ImportError("[ERROR] langchain-deepseek not installed. Run: pip install langchain-deepseek")
+    elif provider == "llamacpp":
+        try:
+            return _init_llamacpp(temperature)
+        except ImportError:
+            raise ImportError("[ERROR] llama-cpp-python not installed. Run: pip install llama-cpp-python langchain-community")
     elif provider == "local":
         try:
             from langchain_ollama import ChatOllama
@@ -58,13 +145,10 @@ def _init_llm(provider: str, temperature: float) -> BaseChatModel:
                 model=model, 
                 temperature=temperature,
                 num_predict=LOCAL_MAX_TOKENS,
-                num_ctx=LOCAL_CONTEXT,
-                num_thread=LOCAL_THREADS,
                 keep_alive=f"{LOCAL_KEEP_ALIVE}s",
                 top_p=LOCAL_TOP_P,
                 top_k=LOCAL_TOP_K,
-                num_gpu=LOCAL_NUM_GPU,
-                low_vram=LOCAL_LOW_VRAM,
+                **LOCAL_RUNNER_OPTIONS,
                 mirostat=0,  # Отключаем для скорости
                 repeat_penalty=1.0,  # Отключаем для скорости
                 seed=42,  # Фиксированный seed для консистентности
@@ -76,31 +160,551 @@ def _init_llm(provider: str, temperature: float) -> BaseChatModel:
         from langchain_ollama import ChatOllama
         return ChatOllama(model=model, temperature=temperature)
 
+# Один контекст llama.cpp на процесс: генерации не должны перемежаться
+_llamacpp_lock = threading.Lock()
+
+@lru_cache(maxsize=None)
+def _llamacpp_class():
+    from langchain_community.chat_models import ChatLlamaCpp
+
+    class SerializedChatLlamaCpp(ChatLlamaCpp):
+        """
+        ChatLlamaCpp, у которого генерации идут строго по одной. Асинхронные вызовы
+        LangChain выполняет в потоках, и отменённый поток может ещё дописывать токен,
+        когда начинается следующий запрос. Потоковая генерация идёт в отдельном потоке
+        под блокировкой и складывает куски в очередь: блокировка не держится между
+        yield и освобождается, когда генерация закончилась (не дольше max_tokens)
+        или потребитель закрыл поток - даже если он просто перестал читать.
+        """
+
+        def _generate(self, *args, **kwargs):
+            if self.streaming and not kwargs.get("tool_choice"):
+                # ChatLlamaCpp сам собирает ответ из _stream, а тот уже под блокировкой
+                return super()._generate(*args, **kwargs)
+            with _llamacpp_lock:
+                return super()._generate(*args, **kwargs)
+
+        def _stream(self, *args, **kwargs):
+            chunks: "queue.Queue" = queue.Queue()
+            stopped = threading.Event()
+            done = object()
+            parent = super()
+
+            def generate():
+                with _llamacpp_lock:
+                    stream = parent._stream(*args, **kwargs)
+                    try:
+                        for chunk in stream:
+                            chunks.put(chunk)
+                            if stopped.is_set():
+                                break
+                    except Exception as e:
+                        chunks.put(e)
+                    finally:
+                        stream.close()
+                        chunks.put(done)
+
+            threading.Thread(target=generate, name="llamacpp-stream", daemon=True).start()
+            try:
+                while True:
+                    item = chunks.get()
+                    if item is done:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                stopped.set()
+
+    return SerializedChatLlamaCpp
+
+def _init_llamacpp(temperature: float) -> "BaseChatModel":
+    """
+    GGUF-модель в процессе агента: без HTTP и JSON между агентом и моделью.
+    Веса отображаются в память (use_mmap) и делят страницы с кэшем ФС; контекст
+    живёт всё время работы, и llama.cpp переиспользует KV-кэш общего префикса
+    промпта, а LlamaRAMCache хранит состояния для чередующихся системных промптов.
+    """
+    if not os.path.exists(LLAMACPP_MODEL_PATH):
+        raise FileNotFoundError(f"Файл модели не найден: {LLAMACPP_MODEL_PATH}")
+    llm = _llamacpp_class()(
+        model_path=LLAMACPP_MODEL_PATH,
+        temperature=temperature,
+        max_tokens=LOCAL_MAX_TOKENS,
+        n_ctx=LOCAL_CONTEXT,
+        n_threads=LOCAL_THREADS,
+        n_batch=LLAMACPP_BATCH,
+        n_gpu_layers=LOCAL_NUM_GPU,
+        use_mmap=True,
+        use_mlock=LLAMACPP_MLOCK,
+        logits_all=LLAMACPP_LOGPROBS,
+        top_p=LOCAL_TOP_P,
+        top_k=LOCAL_TOP_K,
+        repeat_penalty=1.0,
+        seed=42,
+        streaming=True,
+        verbose=False,
+    )
+    if LLAMACPP_CACHE_MB > 0:
+        from llama_cpp import LlamaRAMCache
+        llm.client.set_cache(LlamaRAMCache(capacity_bytes=LLAMACPP_CACHE_MB * 2**20))
+    return llm
+
+@lru_cache(maxsize=None)
+def _llamacpp_grammar(labels_count: int):
+    from llama_cpp import LlamaGrammar
+    return LlamaGrammar.from_string(f"root ::= [1-{labels_count}]", verbose=False)
+
+def _init_classifier(provider: str) -> Optional["BaseChatModel"]:
+    """
+    Та же модель, настроенная на классификацию: без случайности, ответ в несколько
+    токенов и (где провайдер умеет) logprobs первого токена. Для Ollama контекст и
+    потоки совпадают с основной моделью - иначе она перезагрузится в памяти.
+    """
+    model = LLM_MODEL or {"claude": CLAUDE_MODEL, "deepseek": DEEPSEEK_MODEL, "local": LOCAL_MODEL}.get(provider)
+    if provider == "claude":
+        from langchain_anthropic import ChatAnthropic
+        return ChatAnthropic(model=model, temperature=0, max_tokens=CLASSIFY_MAX_TOKENS)
+    if provider == "deepseek":
+        from langchain_deepseek import ChatDeepSeek
+        return ChatDeepSeek(model=model, temperature=0, max_tokens=CLASSIFY_MAX_TOKENS,
+                            logprobs=True, top_logprobs=CLASSIFY_TOP_LOGPROBS)
+    if provider == "local":
+        from langchain_ollama import ChatOllama
+        return ChatOllama(
+            model=model,
+            temperature=0,
+            num_predict=CLASSIFY_MAX_TOKENS,
+            keep_alive=f"{LOCAL_KEEP_ALIVE}s",
+            **LOCAL_RUNNER_OPTIONS,
+            seed=42,
+            logprobs=True,
+            top_logprobs=CLASSIFY_TOP_LOGPROBS,
+        )
+    return None
+
+def _ollama_runner_options() -> Dict[str, Any]:
+    """LOCAL_RUNNER_OPTIONS, которые ChatOllama действительно передаёт в Ollama (low_vram она не знает)"""
+    from langchain_ollama import ChatOllama
+    return {name: value for name, value in LOCAL_RUNNER_OPTIONS.items() if name in ChatOllama.model_fields}
+
+def _messages(prompt: str, system_prompt: Optional[str] = None) -> list:
+    from langchain_core.messages import SystemMessage, HumanMessage
+    messages = []
+    if system_prompt:
+        messages.append(SystemMessage(content=system_prompt))
+    messages.append(HumanMessage(content=prompt))
+    return messages
+
+def _chunk_text(chunk) -> str:
+    content = chunk.content if hasattr(chunk, "content") else chunk
+    if isinstance(content, list):
+        # Anthropic отдаёт content списком блоков
+        content = "".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return content or ""
+
+def _output_tokens(chunk) -> Optional[int]:
+    # Ollama, Anthropic и DeepSeek присылают usage_metadata в последних чанках
+    usage = getattr(chunk, "usage_metadata", None)
+    if usage:
+        return usage.get("output_tokens") or None
+    return None
+
+def _load_time(chunk) -> Optional[float]:
+    # Ollama сообщает время загрузки модели (нс) в метаданных последнего чанка
+    load_duration = (getattr(chunk, "response_metadata", None) or {}).get("load_duration")
+    return load_duration / 1e9 if load_duration is not None else None
+
+# --- CLASSIFICATION ---
+# Метки кодируются цифрами: цифра - один токен в любом токенизаторе,
+# поэтому распределение по меткам читается из logprobs первого токена
+LABEL_CODES = "123456789"
+
+def classification_prompt(labels: Dict[str, str]) -> str:
+    """Системный промпт классификации: метка -> когда её выбирать"""
+    if len(labels) > len(LABEL_CODES):
+        raise ValueError(f"Не больше {len(LABEL_CODES)} меток")
+    lines = [f"{code} - {label}: {description}" for code, (label, description) in zip(LABEL_CODES, labels.items())]
+    return "Определи, к чему относится фраза. Отвечай ТОЛЬКО одной цифрой:\n" + "\n".join(lines)
+
+@dataclass
+class Classification:
+    label: Optional[str]
+    probability: float
+    probs: Dict[str, float] = field(default_factory=dict)
+    method: str = "logprobs"  # logprobs - по распределению первого токена, text - по тексту ответа
+
+    @classmethod
+    def from_probs(cls, probs: Dict[str, float], method: str = "logprobs") -> "Classification":
+        if not probs:
+            return cls(None, 0.0, {}, method)
+        label = max(probs, key=probs.get)
+        return cls(label, probs[label], probs, method)
+
+def _logprob_entries(response) -> list:
+    # Ollama: список токенов; OpenAI-совместимые (DeepSeek): {"content": [...]}
+    logprobs = (getattr(response, "response_metadata", None) or {}).get("logprobs")
+    if isinstance(logprobs, dict):
+        logprobs = logprobs.get("content")
+    return logprobs or []
+
+def _label_probs(response, labels: List[str], temperature: float = CLASSIFY_TEMPERATURE) -> Optional[Dict[str, float]]:
+    """Распределение по меткам из top_logprobs первого значимого токена; метки вне top-k - ноль"""
+    codes = dict(zip(LABEL_CODES, labels))
+    first = next((entry for entry in _logprob_entries(response) if str(entry.get("token", "")).strip()), None)
+    if first is None:
+        return None
+    scores: Dict[str, float] = {}
+    for candidate in first.get("top_logprobs") or [first]:
+        code = str(candidate.get("token", "")).strip()
+        if code in codes and candidate.get("logprob") is not None:
+            scores[code] = max(scores.get(code, -math.inf), candidate["logprob"])
+    if not scores:
+        return None
+    top = max(scores.values())
+    weights = {code: math.exp((logprob - top) / temperature) for code, logprob in scores.items()}
+    total = sum(weights.values())
+    return {codes[code]: weights[code] / total for code in sorted(weights)}
+
+def _label_from_text(content: str, labels: List[str]) -> Optional[str]:
+    content = content.strip().upper()
+    if content[:1] in LABEL_CODES[:len(labels)]:
+        return labels[LABEL_CODES.index(content[0])]
+    return next((label for label in labels if label in content), None)
+
+# --- RESIDENCY ---
+class ResidencyManager:
+    """
+    Держит локальную модель в памяти Ollama, когда колонкой, скорее всего, будут
+    пользоваться: недавно были запросы или сейчас (либо через час) обычно активный
+    час суток. Тогда раз в треть LOCAL_KEEP_ALIVE отправляется пустой запрос
+    /api/generate - он продлевает keep_alive, а холодную модель загружает заранее.
+    В остальное время модель выгружается сама по LOCAL_KEEP_ALIVE, а при нехватке
+    памяти - сразу (keep_alive=0). Частоты по часам суток затухают раз в сутки и
+    сохраняются в LLM_RESIDENCY_PATH, чтобы переживать перезапуск.
+    """
+
+    DAILY_DECAY = 0.8
+
+    def __init__(self, model: str, keep_alive: int = LOCAL_KEEP_ALIVE, path: Optional[str] = LLM_RESIDENCY_PATH,
+                 options: Optional[Dict[str, Any]] = None):
+        self.model = model
+        # Пинги должны совпадать по параметрам раннера с запросами ответа - иначе перезагрузка
+        self.options = LOCAL_RUNNER_OPTIONS if options is None else options
+        self.keep_alive = keep_alive
+        self.path = path
+        self.interval = max(5.0, keep_alive / 3)
+        self.hours = [0.0] * 24
+        self.day = time.strftime("%Y-%m-%d")
+        self.last_use: Optional[float] = None
+        self.resident_until = 0.0
+        self._dirty = False
+        self.stats = {"requests": 0, "cold": 0, "pings": 0, "prewarms": 0, "unloads": 0}
+        self._client = None
+        self._task: Optional[asyncio.Task] = None
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            if len(state.get("hours", [])) == 24:
+                self.hours = [float(value) for value in state["hours"]]
+                self.day = state.get("day", self.day)
+        except (OSError, ValueError) as e:
+            print(f"[RESIDENCY] Не удалось прочитать {self.path}: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"day": self.day, "hours": [round(value, 3) for value in self.hours]}, f)
+        except OSError as e:
+            print(f"[RESIDENCY] Не удалось сохранить {self.path}: {e}")
+
+    def _roll_day(self, now: float):
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        if day != self.day:
+            self.hours = [value * self.DAILY_DECAY for value in self.hours]
+            self.day = day
+            self._save()
+
+    def hour_weight(self, hour: int) -> float:
+        # При затухании 0.8 вес в установившемся режиме - пять суточных запросов
+        return self.hours[hour % 24] * (1 - self.DAILY_DECAY)
+
+    def available_mb(self) -> Optional[int]:
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) // 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def under_pressure(self) -> bool:
+        available = self.available_mb()
+        return available is not None and available < RESIDENCY_MIN_FREE_MB
+
+    def should_stay_hot(self, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        if self.under_pressure():
+            return False
+        if self.last_use is not None and now - self.last_use < RESIDENCY_ACTIVE_WINDOW:
+            return True
+        hour = time.localtime(now).tm_hour
+        return max(self.hour_weight(hour), self.hour_weight(hour + 1)) >= RESIDENCY_HOUR_MIN
+
+    def note_request(self, load_time: Optional[float], now: Optional[float] = None) -> bool:
+        """Учитывает запрос к модели; возвращает True, если он попал на холодную модель"""
+        now = time.time() if now is None else now
+        self._roll_day(now)
+        if load_time is not None:
+            cold = load_time >= RESIDENCY_COLD_LOAD
+        else:
+            cold = now > self.resident_until
+        self.hours[time.localtime(now).tm_hour] += 1
+        self._dirty = True
+        self.last_use = now
+        self.resident_until = now + self.keep_alive
+        self.stats["requests"] += 1
+        metrics.inc("llm_requests", residency="cold" if cold else "warm")
+        if cold:
+            self.stats["cold"] += 1
+            print(f"[RESIDENCY] Запрос попал на холодную модель"
+                  f"{f' (загрузка {load_time:.1f}s)' if load_time is not None else ''}")
+        return cold
+
+    def start(self):
+        """Запускает фоновый цикл; повторные вызовы ничего не делают"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._save()
+
+    async def _loop(self):
+        from ollama import AsyncClient
+        self._client = AsyncClient()
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"[RESIDENCY] Ollama недоступна: {e}")
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def _model_name(name: Optional[str]) -> Optional[str]:
+        # Ollama показывает gemma3 как gemma3:latest
+        return name if not name or ":" in name else f"{name}:latest"
+
+    async def _loaded(self) -> bool:
+        running = await self._client.ps()
+        model = self._model_name(self.model)
+        return any(model in (self._model_name(item.model), self._model_name(getattr(item, "name", None)))
+                   for item in running.models)
+
+    async def tick(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        self._roll_day(now)
+        if self._dirty:
+            self._dirty = False
+            self._save()
+        loaded = await self._loaded()
+        if self.should_stay_hot(now):
+            # Пустой generate только продлевает keep_alive; выгруженную модель он загружает
+            await self._client.generate(model=self.model, keep_alive=f"{self.keep_alive}s",
+                                        options=self.options)
+            self.resident_until = now + self.keep_alive
+            self.stats["pings"] += 1
+            if not loaded:
+                self.stats["prewarms"] += 1
+                metrics.inc("llm_residency", event="prewarm")
+                print("[RESIDENCY] Модель загружена заранее")
+        elif loaded and self.under_pressure():
+            await self._client.generate(model=self.model, keep_alive=0, options=self.options)
+            self.resident_until = 0.0
+            self.stats["unloads"] += 1
+            metrics.inc("llm_residency", event="unload")
+            print(f"[RESIDENCY] Мало памяти ({self.available_mb()} МБ) - модель выгружена")
+        elif not loaded:
+            self.resident_until = 0.0
+
+    def get_stats(self) -> dict:
+        requests = self.stats["requests"]
+        return {**self.stats, "cold_rate": round(self.stats["cold"] / requests, 3) if requests else 0.0,
+                "hot": self.should_stay_hot(), "free_mb": self.available_mb()}
+
+# --- TOKEN STREAM ---
+class TokenStream:
+    """
+    Поток токенов одного вызова модели: async for отдаёт текст по мере генерации.
+    cancel() из любой задачи прерывает ожидание следующего токена и закрывает
+    запрос к провайдеру (Ollama при этом прекращает генерацию).
+    По завершении известны ttft, tokens и tokens_per_s; они же уходят в метрики.
+    """
+
+    def __init__(self, manager: "LLMManager", messages: list, purpose: str = "reply"):
+        self.manager = manager
+        self.messages = messages
+        self.purpose = purpose
+        self.ttft: Optional[float] = None
+        self.tokens = 0
+        self.elapsed = 0.0
+        self.load_time: Optional[float] = None
+        self.cancelled = False
+        self._cancel = asyncio.Event()
+        self._started = False
+
+    @property
+    def tokens_per_s(self) -> float:
+        # Скорость генерации после первого токена - без времени на разбор промпта
+        generating = self.elapsed - (self.ttft or 0.0)
+        return (self.tokens - 1) / generating if self.tokens > 1 and generating > 0 else 0.0
+
+    def cancel(self):
+        self._cancel.set()
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        if self._started:
+            raise RuntimeError("TokenStream можно прочитать только один раз")
+        self._started = True
+        return self._run()
+
+    async def _next(self, source) -> Any:
+        if self._cancel.is_set():
+            raise asyncio.CancelledError()
+        next_chunk = asyncio.ensure_future(source.__anext__())
+        cancelled = asyncio.ensure_future(self._cancel.wait())
+        try:
+            await asyncio.wait({next_chunk, cancelled}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            cancelled.cancel()
+            if not next_chunk.done():
+                next_chunk.cancel()
+        if not next_chunk.done() or next_chunk.cancelled():
+            raise asyncio.CancelledError()
+        return next_chunk.result()
+
+    async def _run(self) -> AsyncIterator[str]:
+        start_time = time.perf_counter()
+        if self.manager.residency:
+            self.manager.residency.start()
+        source = self.manager.llm.astream(self.messages).__aiter__()
+        reported_tokens = None
+        finished = False
+        try:
+            while True:
+                try:
+                    chunk = await self._next(source)
+                except StopAsyncIteration:
+                    finished = True
+                    break
+                except asyncio.CancelledError:
+                    if not self._cancel.is_set():
+                        raise  # отменили задачу потребителя
+                    break
+                reported_tokens = _output_tokens(chunk) or reported_tokens
+                self.load_time = _load_time(chunk) or self.load_time
+                content = _chunk_text(chunk)
+                if not content:
+                    continue
+                if self.ttft is None:
+                    self.ttft = time.perf_counter() - start_time
+                # Один чанк потока - один токен, если провайдер не сообщил точное число
+                self.tokens += 1
+                yield content
+        finally:
+            self.elapsed = time.perf_counter() - start_time
+            self.cancelled = not finished
+            if reported_tokens:
+                self.tokens = reported_tokens
+            if hasattr(source, "aclose"):
+                try:
+                    await source.aclose()
+                except Exception:
+                    pass
+            self.manager._record(self)
+
 # --- LLM MANAGER ---
 class LLMManager:
-    """Класс для управления различными LLM провайдерами"""
-    def __init__(self, provider: str = LLM_PROVIDER, temperature: float = LLM_TEMPERATURE):
+    """
+    Класс для управления различными LLM провайдерами.
+    Модель создаётся при первом обращении к llm; preload=False откладывает и
+    предзагрузку - тогда её выполняет warm() параллельно с остальным запуском.
+    """
+    def __init__(self, provider: str = LLM_PROVIDER, temperature: float = LLM_TEMPERATURE, preload: bool = True):
         self.provider = provider.lower()
         self.temperature = temperature
-        self.llm = _init_llm(self.provider, self.temperature)
+        self._llm = None
+        self._classifier = None
+        self._llm_lock = threading.RLock()
+        self._ttft = RollingHistogram()
+        self._speed = RollingHistogram()
+        self.stream_stats = {"streams": 0, "cancelled": 0, "tokens": 0}
+        self.residency: Optional[ResidencyManager] = None
+        if self.provider == "local" and LLM_RESIDENCY:
+            self.residency = ResidencyManager(LLM_MODEL or LOCAL_MODEL, options=_ollama_runner_options())
         
         # Предзагрузка модели для Orange Pi
-        if self.provider == "local":
+        if preload and self.provider in ("local", "llamacpp"):
             self._preload_model()
         
         if SHOW_TEXT:
             print(f"[INFO] Initialized LLM provider: {self.provider}")
-            if self.provider == "local":
-                model_name = LLM_MODEL or LOCAL_MODEL
+            if self.provider in ("local", "llamacpp"):
+                model_name = LLAMACPP_MODEL_PATH if self.provider == "llamacpp" else LLM_MODEL or LOCAL_MODEL
                 print(f"[INFO] Using model: {model_name}")
                 print(f"[INFO] Optimization: context={LOCAL_CONTEXT}, max_tokens={LOCAL_MAX_TOKENS}, threads={LOCAL_THREADS}")
 
+    @property
+    def llm(self) -> "BaseChatModel":
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    self._llm = _init_llm(self.provider, self.temperature)
+        return self._llm
+
+    @property
+    def classifier(self) -> "BaseChatModel":
+        if self._classifier is None:
+            with self._llm_lock:
+                if self._classifier is None and self.provider == "llamacpp":
+                    # Вторая копия модели не нужна: тот же контекст, другие параметры генерации
+                    self._classifier = self.llm.model_copy(update={
+                        "streaming": False, "max_tokens": CLASSIFY_MAX_TOKENS, "temperature": 0.0})
+                if self._classifier is None:
+                    self._classifier = _init_classifier(self.provider) or self.llm
+        return self._classifier
+
+    async def warm(self):
+        """Импорт провайдера и (для локальной модели) загрузка её в память - в отдельном потоке"""
+        if self.provider in ("local", "llamacpp"):
+            await asyncio.to_thread(self._preload_model)
+            if self.residency:
+                self.residency.start()
+        else:
+            await asyncio.to_thread(lambda: self.llm)
+
+    async def close(self):
+        if self.residency:
+            await self.residency.stop()
+
     def _preload_model(self):
         """Предзагружает модель в память для уменьшения первого отклика"""
         try:
             print("[INFO] Предзагрузка модели...")
             # Простой вызов для загрузки модели в память
-            self.llm.invoke([HumanMessage(content="Привет")])
+            self.llm.invoke(_messages("Привет"))
+            if self.residency:
+                self.residency.resident_until = time.time() + self.residency.keep_alive
             print("[INFO] Модель предзагружена")
         except Exception as e:
             print(f"[WARNING] Не удалось предзагрузить модель: {e}")
@@ -114,10 +718,7 @@ class LLMManager:
             system_prompt: Опциональный системный промпт
             tools: Опциональный список инструментов для LLM
         """
-        messages = []
-        if system_prompt:
-            messages.append(SystemMessage(content=system_prompt))
-        messages.append(HumanMessage(content=prompt))
+        messages = _messages(prompt, system_prompt)
         
         try:
             print(f"[LOG] [LLM] Отправка запроса модели: {prompt[:50]}...")
@@ -147,6 +748,75 @@ class LLMManager:
             traceback.print_exc()
             return f"Произошла ошибка при генерации ответа: {str(e)}"
 
+    def stream_response(self, prompt: str, system_prompt: Optional[str] = None,
+                        purpose: str = "reply") -> TokenStream:
+        """
+        Генерирует ответ потоком: отдаёт текст по мере поступления токенов.
+        Ошибки пробрасываются вызывающему - он решает, что озвучить.
+        """
+        print(f"[LOG] [LLM] Потоковый запрос модели: {prompt[:50]}...")
+        return TokenStream(self, _messages(prompt, system_prompt), purpose)
+
+    async def complete(self, prompt: str, system_prompt: Optional[str] = None, purpose: str = "reply") -> str:
+        """Ответ целиком, но через поток - с теми же замерами, что и у потоковых вызовов"""
+        return "".join([chunk async for chunk in TokenStream(self, _messages(prompt, system_prompt), purpose)])
+
+    async def classify(self, text: str, labels: Dict[str, str]) -> Classification:
+        """
+        Относит фразу к одной из меток (метка -> описание). Модель отвечает кодом
+        метки; для Ollama ответ ограничен грамматикой (JSON-схема с enum кодов).
+        Вероятности - softmax по logprobs кодов среди top-k первого токена;
+        без logprobs (Claude) метка берётся из текста с CLASSIFY_TEXT_CONFIDENCE.
+        """
+        names = list(labels)
+        kwargs = {}
+        if self.provider == "local":
+            kwargs["format"] = {"type": "integer", "enum": [int(code) for code in LABEL_CODES[:len(names)]]}
+        elif self.provider == "llamacpp":
+            kwargs["grammar"] = _llamacpp_grammar(len(names))
+            if LLAMACPP_LOGPROBS:
+                kwargs.update(logprobs=True, top_logprobs=CLASSIFY_TOP_LOGPROBS)
+        response = await self.classifier.ainvoke(_messages(text, classification_prompt(labels)), **kwargs)
+        if self.residency:
+            self.residency.note_request(_load_time(response))
+
+        probs = _label_probs(response, names)
+        if probs:
+            result = Classification.from_probs(probs)
+        else:
+            label = _label_from_text(_chunk_text(response), names)
+            result = Classification(label, CLASSIFY_TEXT_CONFIDENCE if label else 0.0,
+                                    {label: CLASSIFY_TEXT_CONFIDENCE} if label else {}, "text")
+        metrics.inc("llm_classify", method=result.method)
+        if SHOW_TEXT:
+            print(f"[LLM] Классификация: {result.label} ({result.probability:.2f}, {result.method})")
+        return result
+
+    def _record(self, stream: TokenStream):
+        self.stream_stats["streams"] += 1
+        if self.residency and (stream.tokens or stream.load_time is not None):
+            self.residency.note_request(stream.load_time)
+        self.stream_stats["tokens"] += stream.tokens
+        if stream.cancelled:
+            self.stream_stats["cancelled"] += 1
+            metrics.inc("llm_streams_cancelled", purpose=stream.purpose)
+        metrics.inc("llm_tokens", stream.tokens, purpose=stream.purpose)
+        if stream.ttft is not None:
+            self._ttft.observe(stream.ttft)
+            metrics.observe("llm_ttft", stream.ttft, kind="call")
+        if stream.tokens_per_s:
+            self._speed.observe(stream.tokens_per_s)
+        if SHOW_TEXT:
+            ttft = f"{stream.ttft:.2f}s" if stream.ttft is not None else "-"
+            print(f"[LLM] {stream.purpose}: первый токен {ttft}, {stream.tokens} ток. за {stream.elapsed:.2f}s, "
+                  f"{stream.tokens_per_s:.1f} ток/с{' (отменён)' if stream.cancelled else ''}")
+
+    def get_stream_stats(self) -> dict:
+        ttft, speed = self._ttft.quantiles((0.5, 0.95)), self._speed.quantiles((0.5, 0.95))
+        return {**self.stream_stats,
+                "ttft_p50": round(ttft[0.5], 3), "ttft_p95": round(ttft[0.95], 3),
+                "tok_s_p50": round(speed[0.5], 1), "tok_s_p95": round(speed[0.95], 1)}
+
     def get_provider_info(self) -> dict:
         if self.provider == "claude":
             model = LLM_MODEL or CLAUDE_MODEL
@@ -157,5 +827,7 @@ class LLMManager:
         elif self.provider == "local":
             model = LLM_MODEL or LOCAL_MODEL
             return {"provider": "Local (Ollama)", "model": model}
+        elif self.provider == "llamacpp":
+            return {"provider": "Local (llama.cpp)", "model": os.path.basename(LLAMACPP_MODEL_PATH)}
         else:
             return {"provider": self.provider, "model": "unknown"} 
\ No newline at end of file
@@ -0,0 +1,219 @@
+# metrics.py
+import asyncio
+import contextvars
+import functools
+import itertools
+import math
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# Печатать длительность каждой стадии (как раньше делал PerformanceMonitor)
+PERF_LOG = os.getenv("PERF_MONITOR", "true").lower() == "true"
+
+# Сколько последних замеров каждой стадии хранить для процентилей
+try:
+    METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1000"))
+except (ValueError, TypeError):
+    METRICS_WINDOW = 1000
+
+# Локальный HTTP-эндпоинт в формате Prometheus; 0 - выключен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+try:
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+except (ValueError, TypeError):
+    METRICS_PORT = 9108
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("magus_trace", default=None)
+
+
+class RollingHistogram:
+    """Последние N замеров для процентилей плюс накопительные count/sum"""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.samples = deque(maxlen=max(1, window))
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, qs=QUANTILES) -> Dict[float, float]:
+        samples = sorted(self.samples)
+        if not samples:
+            return {q: 0.0 for q in qs}
+        return {q: samples[max(0, math.ceil(q * len(samples)) - 1)] for q in qs}
+
+
+class Trace:
+    """Замеры одного запроса: у каждой фразы свой объект, поэтому параллельные запросы не мешают друг другу"""
+
+    def __init__(self, request_id: int, site_id: str):
+        self.request_id = request_id
+        self.site_id = site_id
+        self.started_at = time.perf_counter()
+        self.spans: List[Tuple[str, str, float]] = []
+
+    def add(self, kind: str, name: str, duration: float):
+        self.spans.append((kind, name, duration))
+
+    def summary(self) -> str:
+        def label(kind: str, name: str) -> str:
+            if kind == "call":
+                return f"{name}(call)"
+            return "total" if name == "request" else name
+
+        return " | ".join(f"{label(kind, name)} {duration:.2f}s" for kind, name, duration in self.spans)
+
+
+class Metrics:
+    """
+    Метрики агента: длительности узлов графа и внешних вызовов (скользящие
+    p50/p95/p99), счётчики методов разбора и вызовов LLM. Замеры привязываются
+    к текущему запросу через contextvars, поэтому их можно делать из любого кода,
+    который выполняется внутри metrics.request(...).
+    """
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.window = window
+        self.histograms: Dict[Tuple[str, str], RollingHistogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._ids = itertools.count(1)
+        self._server = None
+
+    # === Запись ===
+    def observe(self, name: str, duration: float, kind: str = "node"):
+        histogram = self.histograms.get((kind, name))
+        if histogram is None:
+            histogram = self.histograms[(kind, name)] = RollingHistogram(self.window)
+        histogram.observe(duration)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(kind, name, duration)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, kind: str = "node"):
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("errors", kind=kind, stage=name)
+            raise
+        finally:
+            duration = time.perf_counter() - start_time
+            self.observe(name, duration, kind)
+            if PERF_LOG and kind == "node":
+                trace = _current_trace.get()
+                prefix = f"[{trace.site_id} #{trace.request_id}] " if trace else ""
+                print(f"[PERF] {prefix}{name}: {duration:.2f}s")
+
+    def timed(self, name: str, kind: str = "node"):
+        """Декоратор для async-функций: весь вызов - один замер"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name, kind):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def request(self, site_id: str = "cli"):
+        """Обрамляет обработку одной фразы: всё, что замерено внутри, попадает в её Trace"""
+        trace = Trace(next(self._ids), site_id)
+        token = _current_trace.set(trace)
+        try:
+            with self.span("request", kind="request"):
+                yield trace
+        finally:
+            _current_trace.reset(token)
+            if PERF_LOG and trace.spans:
+                print(f"[PERF] [{site_id} #{trace.request_id}] {trace.summary()}")
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    # === Чтение ===
+    def get_stats(self) -> dict:
+        stages = {}
+        for (kind, name), histogram in sorted(self.histograms.items()):
+            quantiles = histogram.quantiles()
+            stages[f"{kind}:{name}"] = {
+                "count": histogram.count,
+                **{f"p{int(q * 100)}": round(value, 3) for q, value in quantiles.items()},
+            }
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            counters[f"{name}{{{label}}}" if label else name] = value
+        return {"stages": stages, "counters": counters}
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP magus_stage_seconds Длительность стадий (скользящее окно для квантилей)",
+            "# TYPE magus_stage_seconds summary",
+        ]
+        for (kind, name), histogram in sorted(self.histograms.items()):
+            labels = f'kind="{kind}",stage="{name}"'
+            for q, value in histogram.quantiles().items():
+                lines.append(f'magus_stage_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+            lines.append(f"magus_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}")
+            lines.append(f"magus_stage_seconds_count{{{labels}}} {histogram.count}")
+
+        declared = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = f"magus_{name}_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            label = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f"{metric}{{{label}}} {value:g}" if label else f"{metric} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    # === HTTP ===
+    async def _handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                status, body = "200 OK", self.render_prometheus().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        if not port:
+            return None
+        try:
+            self._server = await asyncio.start_server(self._handle_http, host, port)
+            print(f"[METRICS] Prometheus-метрики на http://{host}:{port}/metrics")
+        except OSError as e:
+            print(f"[METRICS] Не удалось открыть порт {port}: {e}")
+            self._server = None
+        return self._server
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = Metrics()
@@ -7,10 +7,13 @@ import threading
 import time
 import os
 import sys
+import json
+import socket
 from dotenv import load_dotenv
 import soundfile as sf
 import queue
 from wake_detector import WakeWordDetector
+from ws_protocol import SUBPROTOCOL, MsgType, ProtocolError, decode_frame, is_framed, send_frame
 
 # --- CONFIG & GLOBALS ---
 load_dotenv()
@@ -23,6 +26,23 @@ FRAME_SIZE = int(SAMPLE_RATE * (FRAME_DURATION_MS / 1000))
 SILENCE_THRESHOLD_FRAMES = int(1000 / FRAME_DURATION_MS)  # ~1 секунда тишины
 SPEECH_START_THRESHOLD = 3
 WAKEWORD = os.getenv("WAKEWORD", "okey")
+# Форматы ответа, которые умеет воспроизводить клиент (OGG/Opus в несколько раз компактнее WAV)
+AUDIO_FORMATS = [fmt.strip() for fmt in os.getenv("MIC_AUDIO_FORMATS", "opus,wav").split(",") if fmt.strip()]
+# Отправлять речь кусками во время записи: агент начинает распознавание, не дожидаясь конца фразы
+MIC_STREAMING = os.getenv("MIC_STREAMING", "true").lower() in ("true", "1", "yes")
+STREAM_BATCH_FRAMES = 10  # ~300 мс аудио в одном сообщении
+# Проигрывать PCM по мере прихода от агента, не дожидаясь конца синтеза
+MIC_AUDIO_RELAY = os.getenv("MIC_AUDIO_RELAY", "true").lower() in ("true", "1", "yes")
+RELAY_QUEUE_FRAMES = 16  # сколько фреймов держать в буфере воспроизведения; дальше агент ждёт
+# Предлагать агенту бинарный протокол magus.v1; старый агент ответит по-старому
+MIC_FRAMED = os.getenv("MIC_FRAMED", "true").lower() in ("true", "1", "yes")
+# Сколько ждать ответа агента: агент укладывается в REQUEST_BUDGET, дольше - значит, что-то сломалось
+try:
+    MIC_REPLY_TIMEOUT = float(os.getenv("MIC_REPLY_TIMEOUT", "30"))
+except (ValueError, TypeError):
+    MIC_REPLY_TIMEOUT = 30.0
+# Имя комнаты: агент по нему честно делит STT/LLM/TTS между клиентами
+SITE_ID = os.getenv("MIC_SITE_ID", socket.gethostname())
 
 # Enable or disable wake word detection
 USE_WAKE_WORD = os.getenv("USE_WAKE_WORD", "true").lower() in ("true", "1", "yes")
@@ -76,6 +96,35 @@ def play_audio(audio_data):
             except Exception as e:
                 print(f"[WARNING] Не удалось удалить временный файл: {e}")
 
+def play_audio_stream(playback):
+    """Проигрывает сегменты ответа по очереди, пока не придёт None"""
+    while True:
+        segment = playback.get()
+        if segment is None:
+            break
+        play_audio(segment)
+
+def play_pcm_relay(playback, sample_rate, channels):
+    """Проигрывает PCM-фреймы по мере поступления, пока не придёт None"""
+    frame_bytes = 2 * channels
+    remainder = b""
+    try:
+        with sd.RawOutputStream(samplerate=sample_rate, channels=channels, dtype='int16') as stream:
+            while True:
+                frame = playback.get()
+                if frame is None:
+                    break
+                data = remainder + frame
+                usable = len(data) - len(data) % frame_bytes
+                remainder = data[usable:]
+                if usable:
+                    stream.write(data[:usable])
+    except Exception as e:
+        print(f"[ERROR] Ошибка воспроизведения потока: {e}")
+        # Дочитываем очередь, чтобы не заблокировать приём
+        while playback.get() is not None:
+            pass
+
 # --- WAKE WORD HANDLING ---
 def on_wake_word_detected(detected_text):
     """Called when wake word is detected"""
@@ -94,7 +143,14 @@ async def vad_record_and_send(device=None):
             print(f"[INFO] Connecting to {URI} (микрофон)")
             async with websockets.connect(URI, max_size=8*2**20, 
                                          ping_interval=300, # 5 минут между пингами
-                                         ping_timeout=None) as ws:  # отключаем таймаут
+                                         ping_timeout=None,  # отключаем таймаут
+                                         subprotocols=[SUBPROTOCOL] if MIC_FRAMED else None) as ws:
+                hello = {"site_id": SITE_ID, "audio_formats": AUDIO_FORMATS, "audio_stream": True,
+                         "audio_relay": MIC_AUDIO_RELAY}
+                if is_framed(ws):
+                    await send_frame(ws, MsgType.HELLO, headers=hello)
+                else:
+                    await ws.send(json.dumps({"type": "hello", **hello}))
                 await mic_stream_loop(ws, device)
         except Exception as e:
             print(f"[ERROR] Ошибка соединения: {e} (микрофон)")
@@ -108,8 +164,10 @@ async def mic_stream_loop(ws, device=None):
     speech_frames = 0
     silence_frames = 0
     audio_buffer = []
+    sent_frames = 0  # сколько кадров audio_buffer уже отправлено при потоковой передаче
     processing_speech = False
     waiting_for_wake_word = USE_WAKE_WORD  # Start in wake word mode if enabled
+    request_id = 1  # номер фразы в magus.v1
     
     def callback(indata, frames, time_info, status):
         if status:
@@ -140,6 +198,7 @@ async def mic_stream_loop(ws, device=None):
                 
                 # Clear any buffered audio to start fresh for command
                 audio_buffer.clear()
+                sent_frames = 0
                 mic_queue.clear()
                 in_speech = False
                 speech_frames = 0
@@ -196,31 +255,104 @@ async def mic_stream_loop(ws, device=None):
                     else:
                         in_speech = False
                         print("[VAD] Конец речи, отправка... (микрофон)")
-                        combined_data = b"".join(audio_buffer)
+                        combined_data = b"".join(audio_buffer[sent_frames:])
                         audio_buffer.clear()
+                        sent_frames = 0
                         speech_frames = 0
                         silence_frames = 0
                         
-                        if not processing_speech and len(combined_data) > 0:
+                        if not processing_speech:
                             processing_speech = True
-                            await process_and_send(ws, combined_data)
+                            await process_and_send(ws, combined_data, request_id)
+                            request_id += 1
                             processing_speech = False
                             
                             # After processing speech, return to wake word mode if enabled
                             if USE_WAKE_WORD:
                                 waiting_for_wake_word = True
                                 print("[INFO] Возвращаюсь в режим ожидания пробуждения...")
+
+            if in_speech and MIC_STREAMING and len(audio_buffer) - sent_frames >= STREAM_BATCH_FRAMES:
+                await send_audio(ws, b"".join(audio_buffer[sent_frames:]), request_id)
+                sent_frames = len(audio_buffer)
             
             time.sleep(0.01)
 
-async def process_and_send(ws, combined_data):
+async def send_audio(ws, data: bytes, request_id: int):
+    if is_framed(ws):
+        await send_frame(ws, MsgType.AUDIO, request_id, headers={"sample_rate": SAMPLE_RATE}, payload=data)
+    else:
+        await ws.send(data)
+
+async def receive_framed_reply(ws, request_id: int):
+    """
+    Ответ magus.v1: аудиопотоки AUDIO_START / AUDIO / END со своими stream_id.
+    PCM проигрывается по мере прихода, остальные форматы - сегментами целиком.
+    END с stream_id 0, ERROR или BUSY завершают ответ.
+    """
+    segments = None  # очередь проигрывания сегментов, создаётся по первому сегменту
+    relay = None
+    chunks = []
     try:
-        # Увеличиваем таймаут ожидания ответа, если используется
-        await ws.send(combined_data)
+        while True:
+            try:
+                frame = decode_frame(await asyncio.wait_for(ws.recv(), timeout=MIC_REPLY_TIMEOUT))
+            except ProtocolError as e:
+                print(f"[ERROR] Некорректный кадр: {e}")
+                continue
+            if frame.request_id != request_id:
+                continue  # запоздалый ответ на прошлую фразу
+            if frame.type == MsgType.AUDIO_START:
+                header = frame.headers
+                if str(header.get("format", "")).startswith("pcm") and header.get("sample_rate"):
+                    print(f"[INFO] Получаем аудио потоком: pcm, {header['sample_rate']} Гц")
+                    relay = queue.Queue(maxsize=RELAY_QUEUE_FRAMES)
+                    threading.Thread(target=play_pcm_relay, args=(relay, int(header["sample_rate"]),
+                                                                  int(header.get("channels", 1))), daemon=True).start()
+                chunks = []
+            elif frame.type == MsgType.AUDIO:
+                if relay is not None:
+                    await asyncio.to_thread(relay.put, frame.payload)
+                else:
+                    chunks.append(frame.payload)
+            elif frame.type == MsgType.END and frame.stream_id:
+                if relay is not None:
+                    await asyncio.to_thread(relay.put, None)
+                    relay = None
+                elif chunks:
+                    if segments is None:
+                        segments = queue.Queue()
+                        threading.Thread(target=play_audio_stream, args=(segments,), daemon=True).start()
+                    audio = b"".join(chunks)
+                    print(f"[INFO] Получен сегмент {frame.stream_id}: {len(audio)} байт")
+                    segments.put(audio)
+                    chunks = []
+            elif frame.type == MsgType.END:
+                break
+            elif frame.type == MsgType.ERROR:
+                print(f"[ERROR] Агент: {frame.headers.get('message')}")
+                break
+            elif frame.type == MsgType.BUSY:
+                print("[INFO] Агент занят, фраза отклонена")
+                break
+    finally:
+        if relay is not None:
+            await asyncio.to_thread(relay.put, None)
+        if segments is not None:
+            segments.put(None)
+
+async def process_and_send(ws, combined_data, request_id: int = 1):
+    try:
+        # При потоковой передаче большая часть фразы уже отправлена, здесь - остаток
+        if combined_data:
+            await send_audio(ws, combined_data, request_id)
+        if is_framed(ws):
+            await send_frame(ws, MsgType.END, request_id)
+            await receive_framed_reply(ws, request_id)
+            return
         await ws.send("END")
         
-        # Добавляем большой таймаут для операций recv
-        response = await asyncio.wait_for(ws.recv(), timeout=3600)  # 1 час таймаут
+        response = await asyncio.wait_for(ws.recv(), timeout=MIC_REPLY_TIMEOUT)
         
         # Проверяем, начинается ли передача фрагментированного аудио
         if response == "AUDIO_CHUNKS_BEGIN":
@@ -244,6 +376,43 @@ async def process_and_send(ws, combined_data):
             else:
                 print("[WARNING] Получены пустые фрагменты аудио")
         
+        # Ответ по предложениям: первое играет, пока остальные ещё синтезируются
+        elif response == "AUDIO_STREAM_BEGIN":
+            print("[INFO] Получаем ответ по предложениям...")
+            playback = queue.Queue()
+            threading.Thread(target=play_audio_stream, args=(playback,), daemon=True).start()
+            segments = 0
+            while True:
+                segment = await ws.recv()
+                if isinstance(segment, str) and segment == "AUDIO_STREAM_END":
+                    break
+                if isinstance(segment, bytes):
+                    segments += 1
+                    print(f"[INFO] Получен сегмент {segments}: {len(segment)} байт")
+                    playback.put(segment)
+            playback.put(None)
+
+        # PCM пересылается по мере синтеза: играем сразу, очередь ограничена -
+        # пока она полна, сообщения не читаются и агент придерживает следующие фреймы
+        elif isinstance(response, str) and response.startswith('{') and json.loads(response).get("type") == "audio_relay":
+            header = json.loads(response)
+            print(f"[INFO] Получаем аудио потоком: {header.get('format')}, {header.get('sample_rate')} Гц")
+            playback = queue.Queue(maxsize=RELAY_QUEUE_FRAMES)
+            threading.Thread(target=play_pcm_relay, args=(playback, int(header["sample_rate"]),
+                                                          int(header.get("channels", 1))), daemon=True).start()
+            received = 0
+            try:
+                while True:
+                    frame = await ws.recv()
+                    if isinstance(frame, str) and frame == "AUDIO_RELAY_END":
+                        break
+                    if isinstance(frame, bytes):
+                        received += len(frame)
+                        await asyncio.to_thread(playback.put, frame)
+            finally:
+                await asyncio.to_thread(playback.put, None)
+            print(f"[INFO] Аудио потоком получено: {received} байт")
+
         # Обычный ответ (не разбитый на части)
         elif isinstance(response, bytes):
             print(f"[INFO] Получен аудио-ответ: {len(response)} байт")
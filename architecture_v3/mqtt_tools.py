@@ -2,6 +2,7 @@
 import json
 import time
 import asyncio
+import threading
 import paho.mqtt.client as mqtt
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
@@ -10,6 +11,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# После load_dotenv: список берётся из окружения при импорте
+from speculation import SPECULATIVE_TOOLS
+
 # MQTT конфигурация
 MQTT_HOST = os.getenv("MQTT_HOST", "localhost")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
@@ -20,6 +24,13 @@ TTS_SAY_PATH = os.getenv("TTS_SAY_PATH", "hermes/tts/say")
 MQTT_TIMEOUT = int(os.getenv("MQTT_TIMEOUT", "3"))  # Уменьшен с 10 до 3 секунд
 MQTT_ENABLED = os.getenv("MQTT_ENABLED", "true").lower() == "true"
 
+# Одинаковые одновременные вызовы инструментов без побочных эффектов (SPECULATIVE_TOOLS)
+# выполняются один раз
+TOOL_SINGLE_FLIGHT = os.getenv("TOOL_SINGLE_FLIGHT", "true").lower() == "true"
+# Инструменты с побочными эффектами не объединяются никогда, даже если их внесли в SPECULATIVE_TOOLS:
+# два одинаковых таймера от двух колонок - это два таймера
+SIDE_EFFECT_TOOLS = frozenset({"set_timer", "set_notification", "call_contact"})
+
 # Глобальные переменные
 client = None
 response_queue = {}
@@ -402,8 +413,59 @@ tool_mapping = {
     "call_contact": tool_call_contact
 }
 
+class SingleFlight:
+    """
+    Объединение одинаковых вызовов, идущих одновременно: первый поток выполняет
+    вызов, остальные с тем же ключом ждут и получают его результат (или ошибку).
+    После завершения ключ освобождается - результаты не кэшируются.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[tuple, dict] = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key: tuple, func):
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+            else:
+                self.stats["shared"] += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = func()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "in_flight": len(self._calls)}
+
+tool_flight = SingleFlight()
+
+def tool_key(tool_name: str, tool_args: Dict[str, Any]) -> tuple:
+    """Ключ вызова: имя и аргументы в каноническом виде (порядок ключей не важен)"""
+    return tool_name, json.dumps(tool_args or {}, sort_keys=True, ensure_ascii=False, default=str)
+
 def execute_tool(tool_name: str, tool_args: Dict[str, Any]) -> str:
     """Выполняет инструмент по имени с указанными аргументами"""
+    if TOOL_SINGLE_FLIGHT and tool_name in SPECULATIVE_TOOLS - SIDE_EFFECT_TOOLS:
+        return tool_flight.do(tool_key(tool_name, tool_args), lambda: _execute_tool(tool_name, tool_args))
+    return _execute_tool(tool_name, tool_args)
+
+def _execute_tool(tool_name: str, tool_args: Dict[str, Any]) -> str:
     if tool_name in tool_mapping:
         try:
             return tool_mapping[tool_name](**tool_args)
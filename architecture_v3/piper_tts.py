@@ -1,11 +1,21 @@
 import asyncio
+import functools
+import json
 import os
 import platform
 import subprocess
 import tempfile
+import time
 import websockets
 import sys
 from dotenv import load_dotenv
+from audio_codec import create_encoder, negotiate_format
+from audio_utils import pcm_to_wav, wav_to_pcm
+from sentence_splitter import split_sentences
+from tts_cache import TTSCache, collect_canned_phrases, load_phrase_file
+from tts_pool import SynthesisPool, TTSOverloaded, resolve_priority
+from tts_templates import TemplateSynthesizer
+from ws_protocol import MsgType, ServerRequest, is_framed, select_subprotocol, serve_framed
 
 load_dotenv()
 
@@ -13,6 +23,8 @@ load_dotenv()
 # Путь к .onnx-модели и конфигу
 PIPER_MODEL_PATH = os.getenv("PIPER_MODEL_PATH", "./models/ru_RU-denis-medium/ru_RU-denis-medium.onnx")
 PIPER_SPEAKER_ID = int(os.getenv("PIPER_SPEAKER_ID", "0"))
+# Частота по умолчанию, если в конфиге модели её нет (medium-модели - 22050 Гц)
+PIPER_DEFAULT_SAMPLE_RATE = int(os.getenv("PIPER_DEFAULT_SAMPLE_RATE", "22050"))
 
 # Путь к бинарнику piper
 if platform.system() == "Windows":
@@ -24,6 +36,30 @@ else:  # Linux/Unix
 TTS_WS_HOST = os.getenv("TTS_WS_HOST", "0.0.0.0")
 TTS_WS_PORT = int(os.getenv("TTS_WS_PORT", 8777))
 
+# Размер бинарного фрейма при потоковой отдаче PCM
+TTS_STREAM_FRAME_BYTES = int(os.getenv("TTS_STREAM_FRAME_BYTES", str(32 * 1024)))
+
+# === Прогрев кэша ===
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TTS_WARMUP = os.getenv("TTS_WARMUP", "true").lower() == "true"
+TTS_WARMUP_FILE = os.getenv("TTS_WARMUP_FILE", os.path.join(BASE_DIR, "tts_warmup.txt"))
+TTS_WARMUP_MAX = int(os.getenv("TTS_WARMUP_MAX", "200"))
+# Модули, из которых собираются заготовленные ответы
+TTS_WARMUP_SOURCES = [
+    os.path.join(BASE_DIR, path.strip())
+    for path in os.getenv(
+        "TTS_WARMUP_SOURCES",
+        "backend/mqtt_backend.py,backend/base_event.py,mqtt_tools.py,agent.py"
+    ).split(",")
+    if path.strip()
+]
+
+# Сборка ответов времени/погоды из пререндеренных фрагментов
+TTS_TEMPLATES = os.getenv("TTS_TEMPLATES", "true").lower() == "true"
+
+tts_cache = TTSCache()
+synthesis_pool = SynthesisPool()
+
 # === Проверка наличия piper ===
 def check_piper_installed():
     try:
@@ -39,90 +75,398 @@ if not check_piper_installed():
     print(f"[ERROR] Piper TTS не найден по пути: {PIPER_CMD}")
     print("[INFO] Скачайте piper с https://github.com/rhasspy/piper/releases и укажите путь через PIPER_CMD в .env")
 
+def _lower_priority():
+    """Понижает приоритет процесса piper для фоновых задач (только Linux/Unix)"""
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
 # === Основная функция синтеза ===
-async def tts_piper(text: str, model_path: str = None, speaker_id: int = None) -> bytes:
+async def tts_piper(text: str, model_path: str = None, speaker_id: int = None, low_priority: bool = False) -> bytes:
     """
-    Асинхронный синтез речи через Piper TTS.
+    Асинхронный синтез речи через Piper TTS с кэшем готовых фраз.
     Возвращает WAV-байты.
     """
     model_path = model_path or PIPER_MODEL_PATH
     speaker_id = speaker_id if speaker_id is not None else PIPER_SPEAKER_ID
 
+    cache_key = TTSCache.make_key(text, model_path, speaker_id)
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    return await _synthesize_and_cache(text, model_path, speaker_id, cache_key, low_priority)
+
+async def _synthesize_and_cache(text: str, model_path: str, speaker_id: int, cache_key: tuple,
+                                low_priority: bool = False) -> bytes:
+    """Синтез после промаха кэша: результат сразу кладётся в кэш"""
+    wav_bytes = await _synthesize_piper(text, model_path, speaker_id, low_priority)
+    tts_cache.put(cache_key, wav_bytes)
+    return wav_bytes
+
+async def synthesize(text: str, priority: str = "conversation") -> bytes:
+    """
+    Синтез ответа: сначала сборка по шаблону (время, погода), затем кэш и пул воркеров.
+    Может выбросить TTSOverloaded, если очередь переполнена.
+    """
+    if TTS_TEMPLATES:
+        wav_bytes = await template_synth.synthesize(text, priority)
+        if wav_bytes is not None:
+            return wav_bytes
+    return await synthesize_phrase(text, priority)
+
+async def synthesize_phrase(text: str, priority: str = "conversation") -> bytes:
+    """Синтез одной фразы через пул воркеров. Попадание в кэш отдаётся сразу, без очереди."""
+    cache_key = TTSCache.make_key(text, PIPER_MODEL_PATH, PIPER_SPEAKER_ID)
+    cached = tts_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    low_priority = priority == "warmup"
+    # Промах уже посчитан: воркер синтезирует без повторного get
+    return await synthesis_pool.submit(
+        lambda: _synthesize_and_cache(text, PIPER_MODEL_PATH, PIPER_SPEAKER_ID, cache_key, low_priority), priority)
+
+template_synth = TemplateSynthesizer(synthesize_phrase)
+
+@functools.lru_cache(maxsize=8)
+def load_model_config(model_path: str) -> dict:
+    """
+    Проверяет модель и читает её конфиг (<model>.onnx.json) один раз.
+    Возвращает параметры PCM, которые piper отдаёт в режиме --output_raw.
+    """
     if not os.path.exists(model_path):
         print(f"[WARNING] Модель не найдена: {model_path}")
         raise FileNotFoundError(f"Модель не найдена: {model_path}")
 
-    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-        temp_wav_path = temp_wav.name
-
+    sample_rate = PIPER_DEFAULT_SAMPLE_RATE
+    config_path = f"{model_path}.json"
     try:
-        cmd = [
-            PIPER_CMD,
-            '--model', model_path,
-            '--output_file', temp_wav_path,
-        ]
-        
-        if speaker_id > 0:
-            cmd.extend(['--speaker', str(speaker_id)])
-            
-        print(f"[DEBUG] Запускаю: {' '.join(cmd)}")
-        
-        if platform.system() == "Windows":
-            # Windows: запись текста во временный файл и редирект через тип
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', encoding='utf-8', delete=False) as temp_txt:
-                temp_txt_path = temp_txt.name
-                temp_txt.write(text)
-            
+        with open(config_path, 'r', encoding='utf-8') as config_file:
+            sample_rate = int(json.load(config_file).get("audio", {}).get("sample_rate", sample_rate))
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Не удалось прочитать {config_path}: {e}, sample_rate={sample_rate}")
+    return {"sample_rate": sample_rate, "channels": 1, "sample_width": 2}
+
+async def _synthesize_piper(text: str, model_path: str, speaker_id: int, low_priority: bool) -> bytes:
+    """Запуск piper для одной фразы, результат - WAV-байты"""
+    audio_format = load_model_config(model_path)
+    pcm = await synthesize_pcm(text, model_path, speaker_id, low_priority)
+    return pcm_to_wav(pcm, audio_format["sample_rate"], audio_format["channels"], audio_format["sample_width"])
+
+async def synthesize_pcm(text: str, model_path: str, speaker_id: int, low_priority: bool = False) -> bytes:
+    """
+    Запуск piper в режиме --output_raw: PCM читается из stdout прямо в память,
+    на Linux без временных файлов.
+    """
+    cmd = [
+        PIPER_CMD,
+        '--model', model_path,
+        '--output_raw',
+    ]
+
+    if speaker_id > 0:
+        cmd.extend(['--speaker', str(speaker_id)])
+
+    print(f"[DEBUG] Запускаю: {' '.join(cmd)}")
+
+    if platform.system() == "Windows":
+        # Windows: запись текста во временный файл и редирект через тип
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', encoding='utf-8', delete=False) as temp_txt:
+            temp_txt_path = temp_txt.name
+            temp_txt.write(text)
+
+        try:
             # Формируем команду для PowerShell
             cmd_str = ' '.join(cmd)
             full_cmd = f"type \"{temp_txt_path}\" | {cmd_str}"
-            
+
             # Запускаем процесс через PowerShell
             process = await asyncio.create_subprocess_shell(
                 full_cmd,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
-            stdout, stderr = await process.communicate()
-            
+            pcm, stderr = await process.communicate()
+        finally:
             # Удаляем временный текстовый файл
             if os.path.exists(temp_txt_path):
                 os.unlink(temp_txt_path)
-        else:
-            # Linux/Unix использует stdin
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            _, stderr = await process.communicate(input=text.encode('utf-8'))
-            
-        if process.returncode != 0:
-            error_msg = stderr.decode('utf-8', errors='replace') if stderr else "Неизвестная ошибка"
-            raise RuntimeError(f"Piper TTS error: {error_msg}")
-            
-        # Чтение созданного WAV файла
-        if os.path.exists(temp_wav_path) and os.path.getsize(temp_wav_path) > 0:
-            with open(temp_wav_path, 'rb') as wav_file:
-                wav_bytes = wav_file.read()
-            return wav_bytes
-        else:
-            raise RuntimeError("Piper не создал аудиофайл или файл пустой")
-    
+    else:
+        # Linux/Unix: текст в stdin, PCM из stdout
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=_lower_priority if low_priority else None
+        )
+        pcm, stderr = await process.communicate(input=text.encode('utf-8'))
+
+    if process.returncode != 0:
+        error_msg = stderr.decode('utf-8', errors='replace') if stderr else "Неизвестная ошибка"
+        raise RuntimeError(f"Piper TTS error: {error_msg}")
+
+    if not pcm:
+        raise RuntimeError("Piper не вернул аудио")
+    return pcm
+
+# === Фоновый прогрев кэша ===
+def build_warmup_list() -> list:
+    """Фразы для прогрева: заготовленные ответы модулей + файл фраз"""
+    phrases = collect_canned_phrases(TTS_WARMUP_SOURCES) + load_phrase_file(TTS_WARMUP_FILE)
+    unique = list(dict.fromkeys(phrases))
+    return unique[:TTS_WARMUP_MAX]
+
+async def warm_up(phrases: list):
+    """Фоновый прогрев: сначала фрагменты шаблонов, затем заготовленные фразы"""
+    if TTS_TEMPLATES:
+        await template_synth.prerender("warmup")
+    await warm_cache(phrases)
+
+async def warm_cache(phrases: list):
+    """Синтезирует фразы в фоне с самым низким приоритетом очереди"""
+    start_time = time.perf_counter()
+    warmed = 0
+    for phrase in phrases:
+        if tts_cache.contains(TTSCache.make_key(phrase, PIPER_MODEL_PATH, PIPER_SPEAKER_ID)):
+            continue
+        try:
+            await synthesize(phrase, "warmup")
+            warmed += 1
+        except TTSOverloaded:
+            # Очередь занята живыми запросами - ждём и пропускаем фразу
+            await asyncio.sleep(1.0)
+        except Exception as e:
+            # Ошибка одной фразы не должна останавливать прогрев остальных
+            print(f"[TTS CACHE] Фраза '{phrase}' не прогрета: {e}")
+            continue
+    print(f"[TTS CACHE] Прогрето {warmed}/{len(phrases)} фраз за {time.perf_counter() - start_time:.1f}s")
+
+# === Разбор запроса ===
+def parse_request(message: str) -> dict:
+    """
+    Запрос может быть простым текстом (старый протокол) или JSON-объектом:
+    {"text": "...", "stream": true, "priority": "alarm|reminder|conversation",
+     "formats": ["opus", "pcm", "wav"], "sample_rate": 16000, "id": 17}
+    или служебным запросом {"type": "stats"}.
+    formats - список предпочтений клиента; без него отдаётся WAV (или PCM в потоке).
+    id возвращается в JSON-заголовках ответа, чтобы клиент сверял ответы с запросами.
+    """
+    stripped = message.strip()
+    if stripped.startswith('{'):
+        try:
+            data = json.loads(stripped)
+            if isinstance(data, dict) and (data.get("type") == "stats" or "text" in data):
+                return request_from_fields(data)
+        except json.JSONDecodeError:
+            pass
+    return {"type": "synthesize", "text": message, "stream": False, "priority": "conversation",
+            "formats": None, "sample_rate": None, "id": None}
+
+def request_from_fields(data: dict) -> dict:
+    """Поля запроса из JSON (старый протокол) или заголовков REQUEST (magus.v1)"""
+    if data.get("type") == "stats":
+        return {"type": "stats"}
+    return {
+        "type": "synthesize",
+        "text": str(data.get("text", "")),
+        "stream": bool(data.get("stream", False)),
+        "priority": resolve_priority(data.get("priority")),
+        "formats": _parse_formats(data.get("formats", data.get("format"))),
+        "sample_rate": _parse_sample_rate(data.get("sample_rate")),
+        "id": data.get("id"),
+    }
+
+def _parse_formats(value) -> list:
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, list):
+        return None
+    return [str(fmt).strip().lower() for fmt in value if str(fmt).strip()] or None
+
+def _parse_sample_rate(value) -> int:
+    try:
+        rate = int(value)
+    except (ValueError, TypeError):
+        return None
+    return rate if 8000 <= rate <= 48000 else None
+
+# === Отправка ответа по старому протоколу и по magus.v1 ===
+class JsonAudioOut:
+    """Старый протокол: JSON-заголовки с id запроса и бинарные сообщения"""
+
+    def __init__(self, ws, request_id=None):
+        self.ws = ws
+        self.request_id = request_id
+
+    async def audio(self, header: dict, data: bytes):
+        # Одно бинарное сообщение после заголовка
+        await self.ws.send(json.dumps({"type": "audio", **header, "bytes": len(data), "id": self.request_id}))
+        await self.ws.send(data)
+
+    async def stream_start(self, header: dict, segments: int):
+        await self.ws.send(json.dumps({"type": "stream_start", **header, "segments": segments, "id": self.request_id}))
+
+    async def frames(self, data: bytes) -> int:
+        return await _send_frames(self.ws, data)
+
+    async def stream_end(self, segments: int, total_bytes: int):
+        await self.ws.send(json.dumps({"type": "stream_end", "segments": segments, "bytes": total_bytes,
+                                       "id": self.request_id}))
+
+    async def error(self, message: str):
+        await self.ws.send(f"ERROR: {message}")
+
+    async def busy(self):
+        await self.ws.send("BUSY")
+
+class FramedAudioOut(JsonAudioOut):
+    """magus.v1: AUDIO_START, кадры AUDIO, END потока 1 и END ответа (поток 0)"""
+
+    def __init__(self, request: ServerRequest):
+        super().__init__(request.ws, request.request_id)
+        self.request = request
+
+    async def audio(self, header: dict, data: bytes):
+        await self.stream_start(header, 1)
+        await self.stream_end(1, await self.frames(data))
+
+    async def stream_start(self, header: dict, segments: int):
+        await self.request.send(MsgType.AUDIO_START, {**header, "segments": segments}, stream_id=1)
+
+    async def frames(self, data: bytes) -> int:
+        for offset in range(0, len(data), TTS_STREAM_FRAME_BYTES):
+            await self.request.send(MsgType.AUDIO, payload=data[offset:offset + TTS_STREAM_FRAME_BYTES], stream_id=1)
+        return len(data)
+
+    async def stream_end(self, segments: int, total_bytes: int):
+        await self.request.send(MsgType.END, {"segments": segments, "bytes": total_bytes}, stream_id=1)
+        await self.request.send(MsgType.END)
+
+    async def error(self, message: str):
+        await self.request.send(MsgType.ERROR, {"message": message})
+
+    async def busy(self):
+        await self.request.send(MsgType.BUSY)
+
+# === Кодирование ответа ===
+async def send_encoded(out: JsonAudioOut, wav_bytes: bytes, formats: list, sample_rate: int = None):
+    """
+    Отдаёт синтезированный WAV в согласованном формате:
+    заголовок {"format", "sample_rate", "channels"}, затем аудио.
+    """
+    fmt = negotiate_format(formats)
+    pcm, source_rate, channels, sample_width = wav_to_pcm(wav_bytes)
+    if fmt == "wav" and sample_rate in (None, source_rate):
+        data, header = wav_bytes, {"format": "wav", "sample_rate": source_rate, "channels": channels}
+    else:
+        encoder = create_encoder(fmt, source_rate, sample_rate)
+        data = await asyncio.to_thread(lambda: encoder.encode(pcm) + encoder.finish())
+        header = encoder.header()
+    await out.audio(header, data)
+    print(f"[TTS] Ответ {header['format']}/{header['sample_rate']}: {len(data)} байт (WAV: {len(wav_bytes)})")
+
+# === Потоковый синтез по предложениям ===
+async def tts_stream(out: JsonAudioOut, text: str, priority: str = "conversation", formats: list = None,
+                     sample_rate: int = None):
+    """
+    Делит текст на предложения и отправляет аудио каждого сразу после синтеза.
+    Протокол: JSON-заголовок stream_start, бинарные фреймы в согласованном формате
+    (PCM или OGG/Opus, кодируется по ходу), JSON stream_end.
+    Следующее предложение синтезируется, пока отправляется текущее.
+    Ответ по шаблону (время, погода) не делится: собирается целиком из фрагментов.
+    """
+    if TTS_TEMPLATES and template_synth.matches(text):
+        segments = [text.strip()]
+    else:
+        segments = split_sentences(text)
+    if not segments:
+        await out.error("Empty text")
+        return
+
+    start_time = time.perf_counter()
+    total_bytes = 0
+    encoder = None
+    next_task = asyncio.create_task(synthesize(segments[0], priority))
+    try:
+        for index in range(len(segments)):
+            wav_bytes = await next_task
+            if index + 1 < len(segments):
+                next_task = asyncio.create_task(synthesize(segments[index + 1], priority))
+
+            pcm, source_rate, channels, sample_width = wav_to_pcm(wav_bytes)
+            if encoder is None:
+                print(f"[TTS] Первый сегмент готов через {time.perf_counter() - start_time:.2f}s "
+                      f"(сегментов: {len(segments)})")
+                encoder = create_encoder(negotiate_format(formats, stream=True), source_rate, sample_rate)
+                await out.stream_start(encoder.header(), len(segments))
+
+            total_bytes += await out.frames(await asyncio.to_thread(encoder.encode, pcm))
+
+        total_bytes += await out.frames(encoder.finish())
+        await out.stream_end(len(segments), total_bytes)
+        print(f"[TTS] Поток завершён за {time.perf_counter() - start_time:.2f}s, {total_bytes} байт")
     finally:
-        # Удаление временного WAV файла
-        if os.path.exists(temp_wav_path):
-            os.unlink(temp_wav_path)
+        if not next_task.done():
+            next_task.cancel()
+
+async def _send_frames(ws, data: bytes) -> int:
+    for offset in range(0, len(data), TTS_STREAM_FRAME_BYTES):
+        await ws.send(data[offset:offset + TTS_STREAM_FRAME_BYTES])
+    return len(data)
 
 # === WebSocket обработчик ===
+async def handle_synthesis(out: JsonAudioOut, request: dict):
+    try:
+        if request["stream"]:
+            await tts_stream(out, request["text"], request["priority"], request["formats"], request["sample_rate"])
+        else:
+            wav_bytes = await synthesize(request["text"], request["priority"])
+            await send_encoded(out, wav_bytes, request["formats"], request["sample_rate"])
+    except TTSOverloaded as e:
+        print(f"[TTS] Запрос отклонён ({request['priority']}): {e}")
+        await out.busy()
+    except Exception as e:
+        print(f"[ERROR] TTS ошибка: {e}")
+        await out.error(str(e))
+
+def get_server_stats() -> dict:
+    return {"pool": synthesis_pool.get_stats(), "cache": tts_cache.get_stats(), "templates": template_synth.stats}
+
+async def handle_framed_request(request: ServerRequest):
+    """magus.v1: REQUEST с полями запроса в заголовках; запросы соединения идут параллельно"""
+    if request.first.type != MsgType.REQUEST:
+        await request.send(MsgType.ERROR, {"message": f"Ожидался REQUEST, получен {request.first.type.name}"})
+        return
+    fields = request_from_fields(request.first.headers)
+    if fields["type"] == "stats":
+        await request.send(MsgType.TEXT, payload=json.dumps(get_server_stats()).encode("utf-8"), flags=1)
+        return
+    await handle_synthesis(FramedAudioOut(request), fields)
+
 async def tts_ws_handler(ws):
+    if is_framed(ws):
+        try:
+            await serve_framed(ws, handle_framed_request)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        return
     try:
         async for message in ws:
             if isinstance(message, str):
+                request = parse_request(message)
+                if request["type"] == "stats":
+                    await ws.send(json.dumps(get_server_stats()))
+                    continue
+                if request["stream"] or request["formats"]:
+                    await handle_synthesis(JsonAudioOut(ws, request["id"]), request)
+                    continue
+                # Совсем старые клиенты: текст в ответ на текст, WAV без заголовка
                 try:
-                    wav_bytes = await tts_piper(message)
-                    await ws.send(wav_bytes)
+                    await ws.send(await synthesize(request["text"], request["priority"]))
+                except TTSOverloaded as e:
+                    print(f"[TTS] Запрос отклонён ({request['priority']}): {e}")
+                    await ws.send("BUSY")
                 except Exception as e:
                     print(f"[ERROR] TTS ошибка: {e}")
                     await ws.send(f"ERROR: {e}")
@@ -135,13 +479,21 @@ async def tts_ws_handler(ws):
 
 async def main_ws():
     print(f"[TTS WS] Starting server on port {TTS_WS_PORT}")
+    synthesis_pool.start()
+    if TTS_WARMUP:
+        phrases = build_warmup_list()
+        print(f"[TTS CACHE] Прогрев {len(phrases)} фраз в фоне")
+        asyncio.create_task(warm_up(phrases))
+    elif TTS_TEMPLATES:
+        asyncio.create_task(template_synth.prerender("warmup"))
     async with websockets.serve(
         tts_ws_handler, 
         TTS_WS_HOST, 
         TTS_WS_PORT, 
         max_size=8*2**20, 
         ping_interval=300,   # 5 минут
-        ping_timeout=None):  # Без таймаута
+        ping_timeout=None,   # Без таймаута
+        select_subprotocol=select_subprotocol):
         await asyncio.Future()  # run forever
 
 # === Тестовый запуск ===
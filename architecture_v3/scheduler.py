@@ -0,0 +1,185 @@
+# scheduler.py
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Сколько запросов одновременно допускается на каждую стадию конвейера
+STAGE_LIMITS = {}
+for _stage, _default in (("stt", 2), ("llm", 1), ("tts", 2)):
+    try:
+        STAGE_LIMITS[_stage] = int(os.getenv(f"AGENT_{_stage.upper()}_CONCURRENCY", str(_default)))
+    except (ValueError, TypeError):
+        STAGE_LIMITS[_stage] = _default
+
+# Сколько фраз одной комнаты может ждать обработки, прежде чем ответить BUSY
+try:
+    SITE_QUEUE_MAX = int(os.getenv("AGENT_SITE_QUEUE_MAX", "2"))
+except (ValueError, TypeError):
+    SITE_QUEUE_MAX = 2
+
+DEFAULT_SITE = "default"
+
+
+def _wait_stats(waits) -> dict:
+    waits = sorted(waits)
+    return {
+        "wait_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+        "wait_p95": round(waits[max(0, math.ceil(0.95 * len(waits)) - 1)], 4) if waits else 0.0,
+        "wait_max": round(waits[-1], 4) if waits else 0.0,
+    }
+
+
+class FairStageLimiter:
+    """
+    Ограничитель параллелизма одной стадии (STT, LLM, TTS).
+    Освободившийся слот отдаётся комнатам по кругу, а внутри комнаты -
+    по порядку, поэтому шумная комната не вытесняет остальные.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self._active = 0
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict()
+        self._waits = deque(maxlen=500)
+        self.stats = {"acquired": 0, "max_queued": 0}
+
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    async def acquire(self, site_id: str):
+        start_time = time.perf_counter()
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(site_id, deque()).append(future)
+            self.stats["max_queued"] = max(self.stats["max_queued"], self.queued())
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Слот уже передан нам - возвращаем его следующему
+                    self.release()
+                else:
+                    self._remove_waiter(site_id, future)
+                raise
+
+        wait = time.perf_counter() - start_time
+        self._waits.append(wait)
+        self.stats["acquired"] += 1
+        if wait > 0.05:
+            print(f"[SCHEDULER] {self.name}: ожидание слота ({site_id}) {wait:.2f}s")
+
+    def release(self):
+        while self._waiters:
+            site_id, waiters = next(iter(self._waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(site_id)
+            else:
+                del self._waiters[site_id]
+            if not future.done():
+                future.set_result(None)  # слот переходит к ожидающему, _active не меняется
+                return
+        self._active -= 1
+
+    def _remove_waiter(self, site_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(site_id)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[site_id]
+
+    def get_stats(self) -> dict:
+        return {"limit": self.limit, "active": self._active, "queued": self.queued(),
+                **self.stats, **_wait_stats(self._waits)}
+
+
+class SiteQueue:
+    """Очередь фраз одного подключения: обрабатываются по порядку, длина ограничена"""
+
+    def __init__(self, site_id: str, process: Callable[[Any], Awaitable[None]], max_size: int = SITE_QUEUE_MAX):
+        self.site_id = site_id
+        self.process = process
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_size))
+        self.stats = {"submitted": 0, "processed": 0, "rejected": 0}
+        self._waits = deque(maxlen=200)
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, item) -> bool:
+        """Ставит фразу в очередь; False - очередь комнаты переполнена"""
+        self.stats["submitted"] += 1
+        try:
+            self.queue.put_nowait((time.perf_counter(), item))
+            return True
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return False
+
+    async def _run(self):
+        while True:
+            enqueued_at, item = await self.queue.get()
+            self._waits.append(time.perf_counter() - enqueued_at)
+            try:
+                await self.process(item)
+                self.stats["processed"] += 1
+            except Exception as e:
+                print(f"[SCHEDULER] Ошибка обработки ({self.site_id}): {e}")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        self._task.cancel()
+
+    def get_stats(self) -> dict:
+        return {"queued": self.queue.qsize(), **self.stats, **_wait_stats(self._waits)}
+
+
+class RequestScheduler:
+    """Планировщик конвейера: очереди по подключениям и лимиты по стадиям"""
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, site_queue_max: int = SITE_QUEUE_MAX):
+        limits = limits or STAGE_LIMITS
+        self.stages = {name: FairStageLimiter(name, limit) for name, limit in limits.items()}
+        self.site_queue_max = site_queue_max
+        self.sites: Dict[str, SiteQueue] = {}
+
+    @asynccontextmanager
+    async def stage(self, name: str, site_id: Optional[str] = None):
+        limiter = self.stages.get(name)
+        if limiter is None:
+            yield
+            return
+        await limiter.acquire(site_id or DEFAULT_SITE)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    def open_site(self, site_id: str, process: Callable[[Any], Awaitable[None]]) -> SiteQueue:
+        site = SiteQueue(site_id, process, self.site_queue_max)
+        self.sites[site_id] = site
+        return site
+
+    def rename_site(self, site: SiteQueue, site_id: str):
+        """Клиент сообщил имя комнаты в hello - дальше учитываем очередь под ним"""
+        if self.sites.get(site.site_id) is site:
+            del self.sites[site.site_id]
+        site.site_id = site_id
+        self.sites[site_id] = site
+
+    def close_site(self, site: SiteQueue):
+        site.close()
+        if self.sites.get(site.site_id) is site:
+            del self.sites[site.site_id]
+
+    def get_stats(self) -> dict:
+        return {
+            "stages": {name: limiter.get_stats() for name, limiter in self.stages.items()},
+            "sites": {site_id: site.get_stats() for site_id, site in self.sites.items()},
+        }
@@ -0,0 +1,120 @@
+# sentence_splitter.py
+import os
+import re
+from typing import List
+
+# Максимальная длина сегмента для потокового синтеза (символы).
+# Более длинные предложения режутся по запятым/точкам с запятой.
+try:
+    MAX_SEGMENT_CHARS = int(os.getenv("TTS_STREAM_MAX_CHARS", "120"))
+except (ValueError, TypeError):
+    MAX_SEGMENT_CHARS = 120
+
+# Минимальная длина клаузы: слишком короткие куски звучат рвано
+try:
+    MIN_CLAUSE_CHARS = int(os.getenv("TTS_STREAM_MIN_CHARS", "20"))
+except (ValueError, TypeError):
+    MIN_CLAUSE_CHARS = 20
+
+# Сокращения, после которых точка не означает конец предложения
+ABBREVIATIONS = {"т", "д", "е", "п", "г", "гг", "ул", "им", "др", "пр", "см", "стр", "тыс", "млн", "млрд", "руб", "коп"}
+
+_SENTENCE_END = re.compile(r'([.!?…]+["»)]*)\s+')
+_CLAUSE_END = re.compile(r'([,;:]|\s[—–-])\s+')
+
+
+def _is_abbreviation(chunk: str) -> bool:
+    """Проверяет, заканчивается ли кусок текста на сокращение вида 'т.' или 'ул.'"""
+    match = re.search(r'(\w+)\.$', chunk)
+    return bool(match) and match.group(1).lower() in ABBREVIATIONS
+
+
+def _split_by_pattern(text: str, pattern: re.Pattern) -> List[str]:
+    """Режет текст после совпадений pattern, оставляя знак препинания в куске"""
+    parts = []
+    start = 0
+    for match in pattern.finditer(text):
+        end = match.end(1)
+        chunk = text[start:end].strip()
+        if pattern is _SENTENCE_END and _is_abbreviation(chunk):
+            continue
+        if chunk:
+            parts.append(chunk)
+        start = match.end()
+    tail = text[start:].strip()
+    if tail:
+        parts.append(tail)
+    return parts
+
+
+def _split_long_sentence(sentence: str, max_chars: int, min_chars: int) -> List[str]:
+    """Делит длинное предложение на клаузы, склеивая слишком короткие куски"""
+    clauses = _split_by_pattern(sentence, _CLAUSE_END)
+    result = []
+    current = ""
+    for clause in clauses:
+        candidate = f"{current} {clause}".strip() if current else clause
+        if current and len(current) >= min_chars and len(candidate) > max_chars:
+            result.append(current)
+            current = clause
+        else:
+            current = candidate
+    if current:
+        if result and len(current) < min_chars:
+            result[-1] = f"{result[-1]} {current}"
+        else:
+            result.append(current)
+    return result
+
+
+def split_sentences(text: str, max_chars: int = MAX_SEGMENT_CHARS, min_chars: int = MIN_CLAUSE_CHARS) -> List[str]:
+    """
+    Делит текст на предложения для последовательного синтеза.
+    Предложения длиннее max_chars дополнительно режутся по клаузам.
+    """
+    text = re.sub(r'\s+', ' ', text or "").strip()
+    if not text:
+        return []
+
+    segments = []
+    for sentence in _split_by_pattern(text, _SENTENCE_END):
+        if len(sentence) > max_chars:
+            segments.extend(_split_long_sentence(sentence, max_chars, min_chars))
+        else:
+            segments.append(sentence)
+    return segments
+
+
+class SentenceBuffer:
+    """
+    Накопитель потока токенов LLM: feed() возвращает предложения, как только
+    после них пришёл пробел, flush() - остаток в конце генерации.
+    """
+
+    def __init__(self, max_chars: int = MAX_SEGMENT_CHARS, min_chars: int = MIN_CLAUSE_CHARS):
+        self.max_chars = max_chars
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self.buffer += text
+        end = 0
+        for match in _SENTENCE_END.finditer(self.buffer):
+            if not _is_abbreviation(self.buffer[:match.end(1)].strip()):
+                end = match.end()
+        if end:
+            complete, self.buffer = self.buffer[:end], self.buffer[end:]
+            return split_sentences(complete, self.max_chars, self.min_chars)
+
+        # Длинный кусок без конца предложения режем по клаузам, последний оставляем копиться
+        if len(self.buffer) > self.max_chars * 2:
+            clauses = _split_long_sentence(re.sub(r'\s+', ' ', self.buffer).strip(), self.max_chars, self.min_chars)
+            if len(clauses) > 1:
+                self.buffer = clauses[-1]
+                return clauses[:-1]
+        return []
+
+    def flush(self) -> List[str]:
+        segments = split_sentences(self.buffer, self.max_chars, self.min_chars)
+        self.buffer = ""
+        return segments
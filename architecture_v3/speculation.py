@@ -0,0 +1,94 @@
+# speculation.py
+import asyncio
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Инструменты без побочных эффектов (только чтение): их можно вызвать заранее, а одинаковые
+# одновременные вызовы - объединить (mqtt_tools). Таймеры, напоминания и звонки сюда не
+# входят - два одинаковых запроса из разных комнат должны выполниться оба
+SPECULATIVE_TOOLS = frozenset(
+    name.strip() for name in os.getenv("SPECULATIVE_TOOLS", "get_time,get_weather").split(",") if name.strip()
+)
+
+try:
+    SPECULATION_CONFIDENCE = float(os.getenv("SPECULATION_CONFIDENCE", "0.6"))
+except (ValueError, TypeError):
+    SPECULATION_CONFIDENCE = 0.6
+
+# Результат старше этого считается устаревшим (время/погода могли измениться)
+try:
+    SPECULATION_MAX_AGE = float(os.getenv("SPECULATION_MAX_AGE", "10"))
+except (ValueError, TypeError):
+    SPECULATION_MAX_AGE = 10.0
+
+# Общая статистика по всем фразам
+speculation_stats = {"launched": 0, "hits": 0, "misses": 0, "stale": 0, "failed": 0}
+
+
+def get_speculation_stats() -> dict:
+    used = speculation_stats["hits"] + speculation_stats["misses"]
+    return {**speculation_stats, "hit_rate": round(speculation_stats["hits"] / used, 3) if used else 0.0}
+
+
+class Speculation:
+    """
+    Спекулятивный разбор намерения по промежуточным гипотезам STT.
+    Если по неокончательному тексту уверенно распознан безопасный инструмент,
+    он запускается сразу. tools_node забирает готовый результат, если финальный
+    текст подтвердил тот же вызов; остальные результаты отбрасываются.
+    """
+
+    def __init__(self, parser, run_tool: Callable[[str, Dict[str, Any]], Awaitable[str]]):
+        self.parser = parser
+        self.run_tool = run_tool
+        self._tasks: Dict[str, Tuple[float, asyncio.Task]] = {}
+
+    @staticmethod
+    def make_key(name: str, args: Optional[Dict[str, Any]]) -> str:
+        return f"{name}:{json.dumps(args or {}, sort_keys=True, ensure_ascii=False)}"
+
+    def observe(self, text: str):
+        """Разбирает промежуточную гипотезу и при уверенном совпадении запускает инструмент"""
+        calls = self.parser.parse_text_for_tools(text, use_llm_fallback=False)
+        for call in calls or []:
+            if call.name not in SPECULATIVE_TOOLS or call.confidence < SPECULATION_CONFIDENCE:
+                continue
+            key = self.make_key(call.name, call.args)
+            if key in self._tasks:
+                continue
+            print(f"[SPEC] Запуск {call.name} по гипотезе '{text}' (conf: {call.confidence:.2f})")
+            speculation_stats["launched"] += 1
+            task = asyncio.create_task(self.run_tool(call.name, call.args or {}))
+            self._tasks[key] = (time.perf_counter(), task)
+
+    async def take(self, name: str, args: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Возвращает заранее полученный результат вызова или None"""
+        entry = self._tasks.pop(self.make_key(name, args), None)
+        if entry is None:
+            return None
+        started_at, task = entry
+        if time.perf_counter() - started_at > SPECULATION_MAX_AGE:
+            speculation_stats["stale"] += 1
+            task.cancel()
+            return None
+        try:
+            result = await task
+        except Exception as e:
+            speculation_stats["failed"] += 1
+            print(f"[SPEC] Спекулятивный {name} завершился ошибкой: {e}")
+            return None
+        speculation_stats["hits"] += 1
+        print(f"[SPEC] Попадание: {name} готов через {time.perf_counter() - started_at:.2f}s после запуска")
+        return result
+
+    def discard(self):
+        """Отбрасывает невостребованные результаты (финальный текст их не подтвердил)"""
+        for key, (_, task) in self._tasks.items():
+            speculation_stats["misses"] += 1
+            if task.done() and not task.cancelled():
+                task.exception()  # забираем исключение, чтобы asyncio не ругался
+            task.cancel()
+            print(f"[SPEC] Промах: {key.split(':', 1)[0]} не подтверждён финальным текстом")
+        self._tasks.clear()
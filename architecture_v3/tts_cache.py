@@ -0,0 +1,201 @@
+# tts_cache.py
+import ast
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+# Лимиты кэша синтезированного аудио
+try:
+    TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 2**20)))
+except (ValueError, TypeError):
+    TTS_CACHE_MAX_BYTES = 64 * 2**20
+
+try:
+    TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", "512"))
+except (ValueError, TypeError):
+    TTS_CACHE_MAX_ENTRIES = 512
+
+# Фразы длиннее этого не кэшируем: это ответы LLM, они не повторяются
+try:
+    TTS_CACHE_MAX_TEXT = int(os.getenv("TTS_CACHE_MAX_TEXT", "200"))
+except (ValueError, TypeError):
+    TTS_CACHE_MAX_TEXT = 200
+
+_CYRILLIC = re.compile(r'[а-яА-ЯёЁ]')
+
+
+def normalize_text(text: str) -> str:
+    """Схлопывает пробелы, чтобы 'Таймер  активирован ' и 'Таймер активирован' совпадали"""
+    return re.sub(r'\s+', ' ', text or "").strip()
+
+
+class TTSCache:
+    """LRU-кэш аудио, ограниченный по числу записей и по суммарному объёму"""
+
+    def __init__(self, max_bytes: int = TTS_CACHE_MAX_BYTES, max_entries: int = TTS_CACHE_MAX_ENTRIES,
+                 max_text: int = TTS_CACHE_MAX_TEXT):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_text = max_text
+        self._items: "OrderedDict[Tuple, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(text: str, *variant) -> Tuple:
+        return (normalize_text(text),) + tuple(variant)
+
+    def get(self, key: Tuple) -> Optional[bytes]:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return data
+
+    def contains(self, key: Tuple) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def put(self, key: Tuple, data: bytes):
+        if not data or len(key[0]) > self.max_text or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = data
+            self._bytes += len(data)
+            while self._items and (len(self._items) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._items), "bytes": self._bytes}
+
+
+# === Сбор заготовленных фраз для прогрева ===
+def _is_canned_phrase(value: str) -> bool:
+    """Отбирает строки, похожие на озвучиваемые ответы, а не на логи или ключи"""
+    value = value.strip()
+    if not (3 <= len(value) <= TTS_CACHE_MAX_TEXT):
+        return False
+    if not _CYRILLIC.search(value):
+        return False
+    if value.startswith('[') or value.endswith(':') or '\n' in value or any(ch in value for ch in '{}%/|\\'):
+        return False
+    return True
+
+
+class _PhraseCollector(ast.NodeVisitor):
+    """Обходит AST и собирает строковые константы, исключая логи, f-строки, ключи и сравнения"""
+
+    SKIP_CALLS = {"print", "input", "RuntimeError", "ValueError", "ImportError", "FileNotFoundError", "Exception"}
+    SKIP_METHODS = {"split", "startswith", "endswith", "replace", "find", "index", "strip"}
+
+    def __init__(self):
+        self.phrases: List[str] = []
+
+    def _visit_body(self, node):
+        body = getattr(node, "body", [])
+        start = 0
+        # Пропускаем docstring
+        if body and isinstance(body[0], ast.Expr) and isinstance(getattr(body[0], "value", None), ast.Constant) \
+                and isinstance(body[0].value.value, str):
+            start = 1
+        for child in body[start:]:
+            self.visit(child)
+        for field, value in ast.iter_fields(node):
+            if field == "body":
+                continue
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        self.visit(item)
+            elif isinstance(value, ast.AST):
+                self.visit(value)
+
+    visit_Module = _visit_body
+    visit_FunctionDef = _visit_body
+    visit_AsyncFunctionDef = _visit_body
+    visit_ClassDef = _visit_body
+
+    def visit_JoinedStr(self, node):
+        return  # f-строки динамические, их целиком не закэшировать
+
+    def visit_Compare(self, node):
+        return
+
+    def visit_Subscript(self, node):
+        self.visit(node.value)
+
+    def visit_Raise(self, node):
+        return
+
+    def visit_If(self, node):
+        # Блок if __name__ == "__main__" содержит только тестовые подписи
+        test = node.test
+        if isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == "__name__":
+            return
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and node.func.id in self.SKIP_CALLS:
+            return
+        if isinstance(node.func, ast.Attribute) and node.func.attr in self.SKIP_METHODS:
+            return
+        self.generic_visit(node)
+
+    def visit_Dict(self, node):
+        for key, value in zip(node.keys, node.values):
+            # Описания инструментов для LLM не озвучиваются
+            if isinstance(key, ast.Constant) and key.value == "description":
+                continue
+            self.visit(value)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str) and _is_canned_phrase(node.value):
+            self.phrases.append(node.value.strip())
+
+
+def collect_canned_phrases(paths: Iterable[str]) -> List[str]:
+    """Собирает заготовленные фразы ответов из исходников модулей (без их импорта)"""
+    phrases = []
+    for path in paths:
+        try:
+            with open(path, 'r', encoding='utf-8') as source:
+                tree = ast.parse(source.read(), filename=path)
+        except (OSError, SyntaxError) as e:
+            print(f"[TTS CACHE] Не удалось разобрать {path}: {e}")
+            continue
+        collector = _PhraseCollector()
+        collector.visit(tree)
+        phrases.extend(collector.phrases)
+    return _unique(phrases)
+
+
+def load_phrase_file(path: str) -> List[str]:
+    """Читает файл фраз: по одной на строку, '#' - комментарий"""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as phrase_file:
+        lines = (line.strip() for line in phrase_file)
+        return _unique(line for line in lines if line and not line.startswith('#'))
+
+
+def _unique(phrases: Iterable[str]) -> List[str]:
+    seen = set()
+    result = []
+    for phrase in phrases:
+        key = normalize_text(phrase)
+        if key and key not in seen:
+            seen.add(key)
+            result.append(key)
+    return result
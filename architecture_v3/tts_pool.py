@@ -0,0 +1,156 @@
+# tts_pool.py
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+# Классы приоритетов: меньше - важнее
+PRIORITY_CLASSES = {
+    "alarm": 0,
+    "reminder": 1,
+    "conversation": 2,
+    "warmup": 3,
+}
+DEFAULT_PRIORITY = "conversation"
+
+try:
+    TTS_WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+except (ValueError, TypeError):
+    TTS_WORKERS = 2
+
+try:
+    TTS_QUEUE_MAX = int(os.getenv("TTS_QUEUE_MAX", "16"))
+except (ValueError, TypeError):
+    TTS_QUEUE_MAX = 16
+
+
+class TTSOverloaded(Exception):
+    """Очередь синтеза переполнена - запрос отклонён, а не поставлен в ожидание"""
+
+
+def resolve_priority(name: Optional[str]) -> str:
+    name = (name or DEFAULT_PRIORITY).lower()
+    return name if name in PRIORITY_CLASSES else DEFAULT_PRIORITY
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "priority_class", "factory", "future", "enqueued_at")
+
+    def __init__(self, priority_class: str, seq: int, factory: Callable[[], Awaitable[bytes]], future: asyncio.Future):
+        self.priority_class = priority_class
+        self.priority = PRIORITY_CLASSES[priority_class]
+        self.seq = seq
+        self.factory = factory
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SynthesisPool:
+    """
+    Ограниченный пул воркеров синтеза за очередью с приоритетами.
+    Если очередь полна, новый запрос вытесняет самый неважный из ожидающих,
+    а если вытеснять некого - отклоняется с TTSOverloaded.
+    """
+
+    def __init__(self, workers: int = TTS_WORKERS, max_queue: int = TTS_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self._heap = []
+        self._seq = itertools.count()
+        self._available: Optional[asyncio.Condition] = None
+        self._tasks = []
+        self._busy = 0
+        self._stats: Dict[str, dict] = {
+            name: {"submitted": 0, "completed": 0, "rejected": 0, "failed": 0, "waits": deque(maxlen=500)}
+            for name in PRIORITY_CLASSES
+        }
+
+    def start(self):
+        """Запускает воркеры (нужен работающий event loop)"""
+        if self._tasks:
+            return
+        self._available = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"[TTS POOL] Воркеров: {self.workers}, длина очереди: {self.max_queue}")
+
+    async def submit(self, factory: Callable[[], Awaitable[bytes]], priority_class: str = DEFAULT_PRIORITY) -> bytes:
+        """Ставит задачу синтеза в очередь и ждёт результат"""
+        if not self._tasks:
+            self.start()
+        priority_class = resolve_priority(priority_class)
+        stats = self._stats[priority_class]
+        stats["submitted"] += 1
+
+        job = _Job(priority_class, next(self._seq), factory, asyncio.get_running_loop().create_future())
+        async with self._available:
+            self._heap = [queued for queued in self._heap if not queued.future.done()]
+            heapq.heapify(self._heap)
+            if len(self._heap) >= self.max_queue:
+                worst = max(self._heap)
+                if worst.priority <= job.priority:
+                    stats["rejected"] += 1
+                    raise TTSOverloaded(f"TTS overloaded: очередь {len(self._heap)}/{self.max_queue}")
+                self._heap.remove(worst)
+                heapq.heapify(self._heap)
+                self._stats[worst.priority_class]["rejected"] += 1
+                worst.future.set_exception(TTSOverloaded("TTS overloaded: вытеснен более важным запросом"))
+            heapq.heappush(self._heap, job)
+            self._available.notify()
+
+        return await job.future
+
+    async def _worker(self, index: int):
+        while True:
+            async with self._available:
+                while not self._heap:
+                    await self._available.wait()
+                job = heapq.heappop(self._heap)
+
+            if job.future.done():  # клиент ушёл или задача вытеснена
+                continue
+
+            wait = time.perf_counter() - job.enqueued_at
+            stats = self._stats[job.priority_class]
+            stats["waits"].append(wait)
+            if wait > 0.05:
+                print(f"[TTS POOL] Ожидание в очереди ({job.priority_class}): {wait:.2f}s")
+
+            self._busy += 1
+            try:
+                result = await job.factory()
+                if not job.future.done():
+                    job.future.set_result(result)
+                stats["completed"] += 1
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                stats["failed"] += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._busy -= 1
+
+    def get_stats(self) -> dict:
+        """Статистика по классам приоритета, включая время ожидания в очереди"""
+        result = {"workers": self.workers, "busy": self._busy, "queued": len(self._heap), "classes": {}}
+        for name, stats in self._stats.items():
+            waits = sorted(stats["waits"])
+            result["classes"][name] = {
+                "submitted": stats["submitted"],
+                "completed": stats["completed"],
+                "rejected": stats["rejected"],
+                "failed": stats["failed"],
+                "wait_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+                "wait_p95": round(waits[max(0, math.ceil(0.95 * len(waits)) - 1)], 4) if waits else 0.0,
+                "wait_max": round(waits[-1], 4) if waits else 0.0,
+            }
+        return result
@@ -0,0 +1,262 @@
+# tts_templates.py
+import asyncio
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from audio_utils import pcm_to_wav, wav_to_pcm
+
+# Параметры склейки
+try:
+    TEMPLATE_CROSSFADE_MS = float(os.getenv("TTS_TEMPLATE_CROSSFADE_MS", "10"))
+except (ValueError, TypeError):
+    TEMPLATE_CROSSFADE_MS = 10.0
+
+try:
+    TEMPLATE_GAP_MS = float(os.getenv("TTS_TEMPLATE_GAP_MS", "60"))
+except (ValueError, TypeError):
+    TEMPLATE_GAP_MS = 60.0
+
+try:
+    TEMPLATE_COMMA_PAUSE_MS = float(os.getenv("TTS_TEMPLATE_COMMA_PAUSE_MS", "180"))
+except (ValueError, TypeError):
+    TEMPLATE_COMMA_PAUSE_MS = 180.0
+
+# Порог тишины (int16) и запас, который оставляем при обрезке фрагмента
+try:
+    TEMPLATE_SILENCE_THRESHOLD = int(os.getenv("TTS_TEMPLATE_SILENCE_THRESHOLD", "300"))
+except (ValueError, TypeError):
+    TEMPLATE_SILENCE_THRESHOLD = 300
+
+try:
+    TEMPLATE_PAD_MS = float(os.getenv("TTS_TEMPLATE_PAD_MS", "30"))
+except (ValueError, TypeError):
+    TEMPLATE_PAD_MS = 30.0
+
+# Сколько фрагментов, отрендеренных по требованию (регион, дробные числа), держать в памяти
+try:
+    TEMPLATE_DYNAMIC_FRAGMENTS = int(os.getenv("TTS_TEMPLATE_DYNAMIC_FRAGMENTS", "128"))
+except (ValueError, TypeError):
+    TEMPLATE_DYNAMIC_FRAGMENTS = 128
+
+# Дробные значения числовых слотов («12.3 градусов») округляются до целых и берутся
+# из пререндеренных; иначе каждое новое значение - отдельный запуск Piper
+TEMPLATE_ROUND_NUMBERS = os.getenv("TTS_TEMPLATE_ROUND_NUMBERS", "true").lower() == "true"
+
+# Шаблоны ответов backend/mqtt_tools. Числовые слоты с диапазоном пререндерятся,
+# остальные слоты рендерятся по требованию и запоминаются.
+TEMPLATES = [
+    (
+        "time",
+        "Текущее время {hours} часов, {minutes} минут",
+        {"hours": range(0, 24), "minutes": range(0, 60)},
+    ),
+    (
+        "weather",
+        "Текущая погода для региона {region}: температура {temperature} градусов по цельсию, "
+        "скорость ветра {wind} километров в час",
+        {"temperature": range(-40, 41), "wind": range(0, 61)},
+    ),
+]
+
+_SLOT = re.compile(r'\{(\w+)\}')
+_PUNCTUATION = " ,.:;!?"
+
+
+def normalize_number(value: str, round_numbers: bool = TEMPLATE_ROUND_NUMBERS) -> Optional[int]:
+    """'14', '14.0', '-3,0' -> целое; дробное - округлённое (или None без округления)"""
+    try:
+        number = float(value.strip().replace(",", "."))
+    except ValueError:
+        return None
+    if number.is_integer():
+        return int(number)
+    return math.floor(number + 0.5) if round_numbers else None
+
+
+class SynthesisTemplate:
+    """Шаблон фразы: фиксированные фрагменты и слоты между ними"""
+
+    def __init__(self, name: str, template: str, number_slots: Dict[str, range]):
+        self.name = name
+        self.number_slots = number_slots
+        # parts: ("text", фрагмент, пауза_мс) или ("slot", имя, пауза_мс)
+        self.parts: List[Tuple[str, str, float]] = []
+
+        pattern = []
+        position = 0
+        for match in _SLOT.finditer(template):
+            self._add_text(template[position:match.start()], pattern)
+            slot = match.group(1)
+            self.parts.append(("slot", slot, TEMPLATE_GAP_MS))
+            if slot in number_slots:
+                pattern.append(rf'(?P<{slot}>-?\d+(?:[.,]\d+)?)')
+            else:
+                pattern.append(rf'(?P<{slot}>.+?)')
+            position = match.end()
+        self._add_text(template[position:], pattern)
+        self.regex = re.compile(''.join(pattern), re.IGNORECASE)
+
+    def _add_text(self, raw: str, pattern: List[str]):
+        if not raw:
+            return
+        pattern.append(r'\s*'.join(re.escape(chunk) for chunk in re.split(r'\s+', raw)))
+        # Знак препинания сразу после слота - пауза после слота
+        if self.parts and raw.lstrip()[:1] in (",", ":", ";"):
+            kind, value, _ = self.parts[-1]
+            self.parts[-1] = (kind, value, TEMPLATE_COMMA_PAUSE_MS)
+        text = raw.strip(_PUNCTUATION)
+        if text:
+            pause = TEMPLATE_COMMA_PAUSE_MS if raw.rstrip()[-1:] in (",", ":", ";") else TEMPLATE_GAP_MS
+            self.parts.append(("text", text, pause))
+
+    def match(self, text: str) -> Optional[Dict[str, str]]:
+        match = self.regex.fullmatch(text.strip())
+        return match.groupdict() if match else None
+
+    def fixed_fragments(self) -> List[str]:
+        return [value for kind, value, _ in self.parts if kind == "text"]
+
+    def number_fragments(self) -> List[str]:
+        return [str(number) for numbers in self.number_slots.values() for number in numbers]
+
+
+class TemplateSynthesizer:
+    """
+    Сборка ответов вида «Текущее время 12 часов, 5 минут» из заранее
+    отрендеренных фрагментов с короткими кроссфейдами вместо полного запуска Piper.
+    render(text, priority) должна возвращать WAV-байты.
+    """
+
+    def __init__(self, render: Callable[[str, str], Awaitable[bytes]], templates=TEMPLATES):
+        self.render = render
+        self.templates = [SynthesisTemplate(*spec) for spec in templates]
+        self.fragments: Dict[str, np.ndarray] = {}
+        self.dynamic: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.sample_rate: Optional[int] = None
+        self.ready = False
+        self.stats = {"assembled": 0, "dynamic_renders": 0}
+
+    def matches(self, text: str) -> bool:
+        """Будет ли фраза собрана по шаблону (до деления на предложения)"""
+        return self.ready and self.match(text) is not None
+
+    def match(self, text: str) -> Optional[Tuple[SynthesisTemplate, Dict[str, str]]]:
+        for template in self.templates:
+            values = template.match(text)
+            if values is not None:
+                return template, values
+        return None
+
+    async def prerender(self, priority: str = "warmup"):
+        """Рендерит фиксированные фрагменты и закрытое множество чисел"""
+        start_time = time.perf_counter()
+        texts = []
+        for template in self.templates:
+            texts.extend(template.fixed_fragments())
+            texts.extend(template.number_fragments())
+        texts = list(dict.fromkeys(texts))
+
+        for text in texts:
+            for attempt in range(3):
+                if text in self.fragments:
+                    break
+                try:
+                    self.fragments[text] = await self._render_fragment(text, priority)
+                except Exception as e:
+                    # Очередь синтеза может быть занята живыми запросами - повторяем позже
+                    print(f"[TTS TEMPLATE] Не удалось отрендерить '{text}': {e}")
+                    await asyncio.sleep(1.0)
+            if text not in self.fragments:
+                print("[TTS TEMPLATE] Пререндер прерван, шаблоны отключены")
+                return
+        self.ready = True
+        print(f"[TTS TEMPLATE] Отрендерено {len(self.fragments)} фрагментов за {time.perf_counter() - start_time:.1f}s")
+
+    async def synthesize(self, text: str, priority: str = "conversation") -> Optional[bytes]:
+        """Собирает WAV по шаблону или возвращает None, если шаблон не подходит"""
+        if not self.ready:
+            return None
+        matched = self.match(text)
+        if not matched:
+            return None
+
+        template, values = matched
+        start_time = time.perf_counter()
+        pieces = []
+        for kind, value, pause_ms in template.parts:
+            if kind == "text":
+                fragment = self.fragments[value]
+            else:
+                fragment = await self._slot_fragment(template, value, values[value], priority)
+            pieces.append((fragment, pause_ms))
+
+        pcm = self._join(pieces)
+        self.stats["assembled"] += 1
+        print(f"[TTS TEMPLATE] '{template.name}' собран за {(time.perf_counter() - start_time) * 1000:.1f}ms")
+        return pcm_to_wav(pcm.tobytes(), self.sample_rate)
+
+    async def _slot_fragment(self, template: SynthesisTemplate, slot: str, value: str, priority: str) -> np.ndarray:
+        value = value.strip()
+        if slot in template.number_slots:
+            number = normalize_number(value)
+            if number is not None:
+                value = str(number)
+                if number in template.number_slots[slot] and value in self.fragments:
+                    return self.fragments[value]
+
+        if value in self.dynamic:
+            self.dynamic.move_to_end(value)
+            return self.dynamic[value]
+
+        fragment = await self._render_fragment(value, priority)
+        self.stats["dynamic_renders"] += 1
+        self.dynamic[value] = fragment
+        while len(self.dynamic) > TEMPLATE_DYNAMIC_FRAGMENTS:
+            self.dynamic.popitem(last=False)
+        return fragment
+
+    async def _render_fragment(self, text: str, priority: str) -> np.ndarray:
+        pcm, sample_rate, channels, sample_width = wav_to_pcm(await self.render(text, priority))
+        if channels != 1 or sample_width != 2:
+            raise RuntimeError(f"Неподдерживаемый формат фрагмента: {channels} канал(ов), {sample_width * 8} бит")
+        if self.sample_rate is None:
+            self.sample_rate = sample_rate
+        elif sample_rate != self.sample_rate:
+            raise RuntimeError(f"Частота фрагмента {sample_rate} != {self.sample_rate}")
+        return self._trim(np.frombuffer(pcm, dtype=np.int16))
+
+    def _trim(self, samples: np.ndarray) -> np.ndarray:
+        """Обрезает тишину по краям, оставляя небольшой запас"""
+        voiced = np.flatnonzero(np.abs(samples.astype(np.int32)) > TEMPLATE_SILENCE_THRESHOLD)
+        if voiced.size == 0:
+            return samples
+        pad = int(self.sample_rate * TEMPLATE_PAD_MS / 1000)
+        start = max(0, voiced[0] - pad)
+        end = min(len(samples), voiced[-1] + pad + 1)
+        return samples[start:end].copy()
+
+    def _join(self, pieces: List[Tuple[np.ndarray, float]]) -> np.ndarray:
+        """Склеивает фрагменты с паузами и кроссфейдом на каждом стыке"""
+        crossfade = int(self.sample_rate * TEMPLATE_CROSSFADE_MS / 1000)
+        sequence = []
+        for index, (fragment, pause_ms) in enumerate(pieces):
+            sequence.append(fragment.astype(np.float32))
+            if index + 1 < len(pieces):
+                sequence.append(np.zeros(int(self.sample_rate * pause_ms / 1000), dtype=np.float32))
+
+        result = sequence[0]
+        for piece in sequence[1:]:
+            overlap = min(crossfade, len(result), len(piece))
+            if overlap == 0:
+                result = np.concatenate([result, piece])
+                continue
+            fade_in = np.linspace(0.0, 1.0, overlap, dtype=np.float32)
+            mixed = result[-overlap:] * (1.0 - fade_in) + piece[:overlap] * fade_in
+            result = np.concatenate([result[:-overlap], mixed, piece[overlap:]])
+        return np.clip(result, -32768, 32767).astype(np.int16)
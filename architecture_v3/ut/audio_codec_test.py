@@ -0,0 +1,69 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_codec import OPUS_AVAILABLE, create_encoder, negotiate_format
+from audio_utils import PCM16Resampler, resample_pcm16
+
+
+def _tone(seconds: float, sample_rate: int = 22050) -> bytes:
+    samples = np.sin(np.arange(int(seconds * sample_rate)) * 2 * np.pi * 440 / sample_rate) * 8000
+    return samples.astype(np.int16).tobytes()
+
+
+def test_negotiate_format():
+
+    assert negotiate_format(["flac", "wav"]) == "wav"
+    assert negotiate_format(None) == "wav"
+    assert negotiate_format(["wav"], stream=True) == "pcm"
+    assert negotiate_format(["opus", "wav"]) == ("opus" if OPUS_AVAILABLE else "wav")
+
+
+def test_resample_pcm16_length():
+
+    pcm = _tone(1.0)
+    assert len(resample_pcm16(pcm, 22050, 16000)) == 16000 * 2
+    assert resample_pcm16(pcm, 22050, 22050) is pcm
+
+
+def test_pcm_encoder_streams_chunks():
+
+    encoder = create_encoder("pcm", 22050, 16000)
+    pcm = _tone(1.0)
+    data = encoder.encode(pcm[:22050]) + encoder.encode(pcm[22050:]) + encoder.finish()
+    assert encoder.header() == {"format": "pcm_s16le", "sample_rate": 16000, "channels": 1}
+    assert abs(len(data) - 16000 * 2) <= 4
+
+
+def test_resampler_keeps_state_across_chunks():
+
+    pcm = _tone(2.0)
+    resampler = PCM16Resampler(22050, 16000)
+    # Куски некратной длины: позиция и последний отсчёт переносятся между ними
+    data = b"".join(resampler.process(pcm[i:i + 4410]) for i in range(0, len(pcm), 4410))
+    samples = np.frombuffer(data, dtype=np.int16)
+    ideal = np.sin(np.arange(len(samples)) * 2 * np.pi * 440 / 16000) * 8000
+    assert abs(len(samples) - 2 * 16000) <= 1
+    assert np.abs(samples - ideal).max() < 50
+
+
+@pytest.mark.skipif(not OPUS_AVAILABLE, reason="libsndfile без OGG/Opus")
+def test_opus_encoder_roundtrip():
+
+    import soundfile as sf
+
+    encoder = create_encoder("opus", 22050)
+    pcm = _tone(2.0)
+    data = b"".join(encoder.encode(pcm[i:i + 8820]) for i in range(0, len(pcm), 8820)) + encoder.finish()
+    assert data[:4] == b"OggS"
+    # Отданные страницы не копятся в буфере кодировщика
+    assert encoder._buffer.tell() == 0
+    assert len(data) < len(pcm) / 4
+    decoded, sample_rate = sf.read(io.BytesIO(data), dtype='int16')
+    assert sample_rate == 24000
+    assert abs(len(decoded) - 2 * 24000) < 24000 * 0.05
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_module import LLMManager, classification_prompt
+
+LABELS = {"ВРЕМЯ": "спрашивают про время", "ПОГОДА": "спрашивают про погоду", "НЕТ": "обычный разговор"}
+
+
+class FakeClassifier:
+
+    def __init__(self, content, logprobs=None):
+        self.content = content
+        self.logprobs = logprobs
+        self.calls = []
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls.append((messages, kwargs))
+        return SimpleNamespace(content=self.content, response_metadata={"logprobs": self.logprobs})
+
+
+def classify(content, logprobs=None, provider="test"):
+    manager = LLMManager(provider=provider, preload=False)
+    manager._classifier = FakeClassifier(content, logprobs)
+    return asyncio.run(manager.classify("какая погода", LABELS)), manager._classifier
+
+
+def test_prompt_numbers_labels():
+
+    assert classification_prompt(LABELS).splitlines()[1:] == [
+        "1 - ВРЕМЯ: спрашивают про время", "2 - ПОГОДА: спрашивают про погоду", "3 - НЕТ: обычный разговор"]
+    with pytest.raises(ValueError):
+        classification_prompt({str(i): "" for i in range(10)})
+
+
+def test_probabilities_come_from_first_token_logprobs():
+
+    # Формат Ollama; токены, не являющиеся кодами меток, не участвуют
+    logprobs = [{"token": "2", "logprob": -0.1, "top_logprobs": [
+        {"token": "2", "logprob": -0.1}, {"token": " 1", "logprob": -2.5}, {"token": "Я", "logprob": -3.0}]}]
+    result, classifier = classify("2", logprobs, provider="local")
+    assert result.label == "ПОГОДА" and result.method == "logprobs"
+    assert result.probability == pytest.approx(1 / (1 + 2.718281828 ** -2.4), rel=1e-6)
+    assert set(result.probs) == {"ВРЕМЯ", "ПОГОДА"}
+    assert classifier.calls[0][1]["format"] == {"type": "integer", "enum": [1, 2, 3]}
+
+
+def test_openai_style_logprobs_are_understood():
+
+    logprobs = {"content": [{"token": "3", "logprob": -0.01, "top_logprobs": [{"token": "3", "logprob": -0.01}]}]}
+    result, _ = classify("3", logprobs)
+    assert result.label == "НЕТ" and result.probability == pytest.approx(1.0)
+
+
+def test_text_fallback_without_logprobs():
+
+    result, classifier = classify("ПОГОДА.")
+    assert (result.label, result.probability, result.method) == ("ПОГОДА", 0.7, "text")
+    assert classifier.calls[0][1] == {}
+    assert classify("не знаю")[0].label is None
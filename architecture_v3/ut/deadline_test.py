@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deadline import Deadline, DeadlineExceeded, within
+from metrics import metrics
+
+
+def test_budget_keeps_tts_reserve():
+
+    deadline = Deadline(budget=3.0, reserve=1.0)
+    assert 1.9 < deadline.timeout() <= 2.0
+    assert deadline.allows(1.5)
+    assert not deadline.allows(2.5)
+
+
+def test_degradations_are_counted():
+
+    metrics.reset()
+    deadline = Deadline(budget=1.0)
+    deadline.degrade("canned_reply")
+    assert deadline.degradations == ["canned_reply"]
+    assert metrics.get_stats()["counters"]["degradations{kind=canned_reply}"] == 1
+
+
+def test_within_raises_only_for_the_request_deadline():
+
+    async def stage_timeout():
+        raise asyncio.TimeoutError()
+
+    async def scenario():
+        assert await within(None, asyncio.sleep(0, result="ok")) == "ok"
+        with pytest.raises(DeadlineExceeded):
+            await within(Deadline(budget=0.15, reserve=0.1), asyncio.sleep(1))
+        # Таймаут внутри стадии при оставшемся сроке - обычный TimeoutError
+        with pytest.raises(asyncio.TimeoutError):
+            await within(Deadline(budget=5.0), stage_timeout())
+
+    asyncio.run(scenario())
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+from dataclasses import fields
+
+import pytest
+
+os.environ.setdefault("MQTT_ENABLED", "false")
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from agent import AgentState, AudioMsg, TextMsg
+from metrics import metrics
+from scheduler import RequestScheduler
+
+# Поля, которые зависят от конкретного прогона, а не от пути обработки
+VOLATILE = {"deadline"}
+
+
+@pytest.fixture
+def services(monkeypatch):
+    """STT, инструменты и TTS без сети и MQTT"""
+    calls = {"stt": [], "tools": [], "tts": []}
+
+    async def stt_vosk(audio):
+        calls["stt"].append(audio.raw)
+        return calls["phrase"]
+
+    async def run_tool(name, args):
+        calls["tools"].append(name)
+        return f"Результат {name}"
+
+    async def tts_client(text, formats=None):
+        calls["tts"].append(text)
+        return b"WAV:" + text.encode("utf-8")
+
+    monkeypatch.setattr(agent, "stt_vosk", stt_vosk)
+    monkeypatch.setattr(agent, "run_tool", run_tool)
+    monkeypatch.setattr(agent, "tts_client", tts_client)
+    monkeypatch.setattr(agent, "scheduler", RequestScheduler())
+    return calls
+
+
+def run(phrase: str, calls: dict) -> AgentState:
+    calls["phrase"] = phrase
+    return asyncio.run(agent.run_pipeline(AgentState(audio=AudioMsg(b"\x00" * 320, sr=16000), site_id="kitchen")))
+
+
+def comparable(state: AgentState) -> dict:
+    values = {f.name: getattr(state, f.name) for f in fields(state) if f.name not in VOLATILE}
+    # id вызова инструмента содержит время - сравниваем остальное
+    values["tool_calls"] = [{k: v for k, v in call.items() if k != "id"} for call in state.tool_calls or []] or None
+    values["audio"] = (state.audio.raw, state.audio.sr) if state.audio else None
+    return values
+
+
+def test_fast_path_matches_graph_for_direct_command(monkeypatch, services):
+
+    monkeypatch.setattr(agent, "FAST_PATH", False)
+    graph = run("который час", services)
+    graph_calls = {name: list(value) for name, value in services.items() if name != "phrase"}
+    for name in graph_calls:
+        services[name].clear()
+
+    metrics.reset()
+    monkeypatch.setattr(agent, "FAST_PATH", True)
+    fast = run("который час", services)
+
+    assert fast.parse_method == "direct"
+    assert fast.text.text == "Результат get_time"
+    assert comparable(fast) == comparable(graph)
+    assert {name: services[name] for name in graph_calls} == graph_calls
+    assert metrics.get_stats()["counters"]["pipeline{path=fast}"] == 1
+
+
+def test_parse_miss_continues_in_resume_app(monkeypatch, services):
+
+    resumed = []
+
+    class ResumeApp:
+        async def ainvoke(self, state):
+            resumed.append(state)
+            return {"text": TextMsg("Ответ LLM"), "audio": AudioMsg(b"WAV", sr=48000)}
+
+    app, _ = agent.build_graphs()
+    monkeypatch.setattr(agent, "_graphs", (app, ResumeApp()))
+    monkeypatch.setattr(agent, "FAST_PATH", True)
+    # Без LLM-классификации: промах прямого разбора сразу уходит в граф
+    monkeypatch.setattr(agent, "USE_LLM_FALLBACK", False)
+    metrics.reset()
+
+    state = run("расскажи анекдот", services)
+
+    assert len(resumed) == 1
+    assert resumed[0].text.text == "расскажи анекдот"
+    assert resumed[0].parse_method != "direct" and not resumed[0].tool_calls
+    assert state.text.text == "Ответ LLM" and state.audio.raw == b"WAV"
+    # Инструменты и TTS быстрого пути не вызывались
+    assert services["tools"] == [] and services["tts"] == []
+    assert metrics.get_stats()["counters"]["pipeline{path=graph}"] == 1
+
+
+def test_fast_path_does_not_build_graphs(monkeypatch, services):
+
+    def build_graphs():
+        raise AssertionError("граф не нужен быстрому пути")
+
+    monkeypatch.setattr(agent, "build_graphs", build_graphs)
+    monkeypatch.setattr(agent, "FAST_PATH", True)
+
+    state = run("который час", services)
+    assert state.parse_method == "direct"
+    assert state.text.text == "Результат get_time"
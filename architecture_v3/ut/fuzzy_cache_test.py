@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzy_cache import FuzzyIndex
+from llm_cache import LLMCache
+
+
+def test_index_matches_reordered_words_but_not_numbers():
+
+    index = FuzzyIndex(capacity=2)
+    index.add("weather", "какая сегодня погода")
+    index.add("timer", "поставь таймер на 5 минут")
+    index.add("joke", "расскажи анекдот")
+
+    key, score = index.search("какая погода сегодня")
+    assert key == "weather" and score > 0.99
+    assert index.search("поставь таймер на 6 минут") is None
+    assert index.search("расскажи сказку") is None
+
+    index.remove("weather")
+    assert index.search("какая сегодня погода") is None
+    assert len(index) == 2
+
+
+def test_spelled_out_numbers_are_not_merged():
+
+    # Vosk отдаёт числа словами: близость таких фраз выше порога, но ответы разные
+    cache = LLMCache("v1", path=None)
+    cache.put("сколько будет двадцать пять умножить на три", "system", "Семьдесят пять")
+    cache.put("поставь будильник на семь утра", "system", "Будильник на семь")
+    cache.put("что было восьмого марта", "system", "Праздник")
+
+    assert cache.get("сколько будет двадцать шесть умножить на три", "system") is None
+    assert cache.get("поставь будильник на восемь утра", "system") is None
+    assert cache.get("что было седьмого марта", "system") is None
+    # Та же фраза с другой пунктуацией по-прежнему находится
+    assert cache.get("Поставь будильник на семь утра!", "system") == "Будильник на семь"
+
+
+def test_cache_fuzzy_hit_is_scoped_and_survives_restart(tmp_path):
+
+    path = str(tmp_path / "cache.db")
+    writer = LLMCache("v1", path=path)
+    writer.put("Какая сегодня погода?", "system", "Солнечно")
+    writer.close()
+
+    cache = LLMCache("v1", path=path)
+    assert cache.get("какая погода сегодня", "system") == "Солнечно"
+    assert cache.get("какая погода сегодня", "other system") is None
+    assert cache.get_stats()["fuzzy_hits"] == 1
+
+    assert LLMCache("v1", path=path, fuzzy=False).get("какая погода сегодня", "system") is None
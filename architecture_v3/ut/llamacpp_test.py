@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("langchain_community.chat_models")
+llama_cpp = pytest.importorskip("llama_cpp")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_module
+
+TOKENS = ["Раз", " два", " три", " четыре", " пять"]
+
+
+class FakeLlama:
+    """Llama без модели: отдаёт TOKENS потоком и следит, чтобы генерации не перемежались"""
+
+    active = 0
+    overlaps = 0
+    generated = []
+
+    def __init__(self, model_path, **params):
+        self.model_path = model_path
+
+    def create_chat_completion(self, messages, stream=False, **params):
+        def chunks():
+            FakeLlama.active += 1
+            FakeLlama.overlaps += FakeLlama.active > 1
+            try:
+                for token in TOKENS:
+                    time.sleep(0.01)
+                    FakeLlama.generated.append(token)
+                    yield {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+            finally:
+                FakeLlama.active -= 1
+        return chunks()
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    monkeypatch.setattr(llama_cpp, "Llama", FakeLlama)
+    FakeLlama.active, FakeLlama.overlaps, FakeLlama.generated = 0, 0, []
+    return llm_module._llamacpp_class()(model_path="fake.gguf", streaming=True, max_tokens=16)
+
+
+def lock_is_free(timeout: float = 1.0) -> bool:
+    if not llm_module._llamacpp_lock.acquire(timeout=timeout):
+        return False
+    llm_module._llamacpp_lock.release()
+    return True
+
+
+def test_stream_returns_all_tokens(llm):
+
+    assert "".join(chunk.content for chunk in llm.stream("привет")) == "".join(TOKENS)
+    assert lock_is_free(timeout=0)
+
+
+def test_abandoned_stream_releases_the_lock(llm):
+
+    # Потребитель прочитал один кусок и перестал читать, не закрыв поток
+    stream = llm.stream("привет")
+    assert next(stream).content == TOKENS[0]
+    assert lock_is_free()
+    assert "".join(chunk.content for chunk in llm.stream("ещё")) == "".join(TOKENS)
+    stream.close()
+
+
+def test_closed_stream_stops_generation(llm):
+
+    stream = llm.stream("привет")
+    next(stream)
+    stream.close()
+    assert lock_is_free()
+    assert len(FakeLlama.generated) < len(TOKENS)
+
+
+def test_concurrent_streams_do_not_interleave(llm):
+
+    results = []
+
+    def consume():
+        results.append("".join(chunk.content for chunk in llm.stream("привет")))
+
+    threads = [threading.Thread(target=consume) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["".join(TOKENS)] * 3
+    assert FakeLlama.overlaps == 0
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_cache import LLMCache
+
+
+def test_normalized_keys_match(tmp_path):
+
+    cache = LLMCache("v1", path=str(tmp_path / "cache.db"))
+    cache.put("Привет", "system", "Здравствуйте!", cost=1.5)
+
+    assert cache.get("привет!", "system") == "Здравствуйте!"
+    assert cache.get("привет", "other system") is None
+    stats = cache.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["saved_seconds"] == 1.5
+
+
+def test_persists_and_invalidates_on_fingerprint_change(tmp_path):
+
+    path = str(tmp_path / "cache.db")
+
+    def reopen(fingerprint):
+        cache = LLMCache(fingerprint, path=path)
+        cache.close()
+        return cache
+
+    cache = LLMCache("v1", path=path)
+    cache.put("Как дела", "system", "Отлично")
+    cache.close()
+
+    assert reopen("v1").get("как дела?", "system") == "Отлично"
+    assert reopen("v2").get("как дела?", "system") is None
+    assert reopen("v1").get("как дела?", "system") is None
+
+
+def test_ttl_and_bounds(tmp_path):
+
+    expired = LLMCache("v1", path=None, ttl=-1)
+    expired.put("раз", "system", "один")
+    assert expired.get("раз", "system") is None
+
+    bounded = LLMCache("v1", path=str(tmp_path / "cache.db"), max_entries=2)
+    for prompt in ["раз", "два", "три"]:
+        bounded.put(prompt, "system", prompt.upper())
+    assert bounded.get("раз", "system") is None
+    assert bounded.get("три", "system") == "ТРИ"
+    assert bounded.get_stats()["evictions"] == 1
+    bounded.close()
+    assert len(LLMCache("v1", path=str(tmp_path / "cache.db"), max_entries=2)._items) == 2
+
+
+def test_contains_does_not_touch_stats():
+
+    cache = LLMCache("v1", path=None)
+    cache.put("Какая сегодня погода", "system", "Солнечно")
+
+    assert cache.contains("какая погода сегодня", "system")
+    assert not cache.contains("расскажи сказку", "system")
+    stats = cache.get_stats()
+    assert stats["hits"] == 0 and stats["misses"] == 0 and stats["fuzzy_hits"] == 0
+
+
+def test_writes_are_batched_off_the_request_path(tmp_path):
+
+    path = str(tmp_path / "cache.db")
+    cache = LLMCache("v1", path=path, flush_interval=60)
+    reader = sqlite3.connect(path)
+
+    def rows():
+        return reader.execute("SELECT key, last_used FROM entries").fetchall()
+
+    cache.put("раз", "system", "один")
+    cache.put("два", "system", "два")
+    assert cache.get("раз", "system") == "один"
+    # get и put не пишут в SQLite - всё ждёт flush
+    assert rows() == []
+
+    cache.flush()
+    first = dict(rows())
+    assert len(first) == 2
+    assert reader.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    cache.get("два", "system")
+    cache._remove(cache.make_key("раз", "system"))
+    cache.close()
+    last = dict(rows())
+    assert list(last) == [cache.make_key("два", "system")]
+    assert last[cache.make_key("два", "system")] > first[cache.make_key("два", "system")]
+
+
+def test_background_flush(tmp_path):
+
+    path = str(tmp_path / "cache.db")
+    cache = LLMCache("v1", path=path, flush_interval=0.1)
+    cache.put("раз", "system", "один")
+    cache._closed.wait(0.3)
+    assert sqlite3.connect(path).execute("SELECT response FROM entries").fetchall() == [("один",)]
+    cache.close()
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_module import LLMManager
+from metrics import metrics
+
+
+class SlowModel:
+
+    def __init__(self, words, delay, usage=None):
+        self.words = words
+        self.delay = delay
+        self.usage = usage
+        self.closed = False
+
+    async def astream(self, messages):
+        try:
+            for word in self.words:
+                await asyncio.sleep(self.delay)
+                yield SimpleNamespace(content=word, usage_metadata=None)
+            if self.usage:
+                yield SimpleNamespace(content="", usage_metadata={"output_tokens": self.usage})
+        finally:
+            self.closed = True
+
+
+def make_manager(model) -> LLMManager:
+    manager = LLMManager(provider="test", preload=False)
+    manager._llm = model
+    return manager
+
+
+def test_stream_measures_first_token_and_speed():
+
+    metrics.reset()
+    manager = make_manager(SlowModel(["Привет", ", ", "мир"], 0.02, usage=5))
+
+    async def scenario():
+        stream = manager.stream_response("привет", purpose="reply")
+        return "".join([chunk async for chunk in stream]), stream
+
+    text, stream = asyncio.run(scenario())
+    assert text == "Привет, мир"
+    assert 0.015 < stream.ttft < stream.elapsed
+    assert stream.tokens == 5 and stream.tokens_per_s > 0
+    assert not stream.cancelled
+    assert metrics.get_stats()["counters"]["llm_tokens{purpose=reply}"] == 5
+    assert manager.get_stream_stats()["streams"] == 1
+
+
+def test_cancel_stops_waiting_and_closes_the_model_stream():
+
+    model = SlowModel(["раз", "два", "три"], 0.5)
+    manager = make_manager(model)
+
+    async def scenario():
+        stream = manager.stream_response("считай")
+        asyncio.get_running_loop().call_later(0.1, stream.cancel)
+        started = asyncio.get_running_loop().time()
+        chunks = [chunk async for chunk in stream]
+        return chunks, stream, asyncio.get_running_loop().time() - started
+
+    chunks, stream, elapsed = asyncio.run(scenario())
+    assert chunks == [] and elapsed < 0.4
+    assert stream.cancelled and stream.ttft is None
+    assert model.closed
+    assert manager.get_stream_stats()["cancelled"] == 1
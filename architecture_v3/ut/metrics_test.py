@@ -0,0 +1,44 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Metrics, RollingHistogram
+
+
+def test_rolling_histogram_quantiles():
+
+    histogram = RollingHistogram(window=100)
+    for value in range(1, 201):
+        histogram.observe(value / 100)
+
+    quantiles = histogram.quantiles()
+    assert quantiles[0.5] == 1.5 and quantiles[0.99] == 1.99
+    assert histogram.count == 200
+
+
+def test_concurrent_requests_keep_separate_traces():
+
+    metrics = Metrics()
+
+    @metrics.timed("stt")
+    async def stt(delay):
+        await asyncio.sleep(delay)
+
+    async def utterance(site_id, delay):
+        with metrics.request(site_id) as trace:
+            await asyncio.gather(stt(delay))
+            metrics.inc("parse_method", method="direct")
+        return trace
+
+    async def main():
+        return await asyncio.gather(utterance("kitchen", 0.05), utterance("hall", 0.01))
+
+    kitchen, hall = asyncio.run(main())
+    assert [name for _, name, _ in kitchen.spans] == ["stt", "request"]
+    assert kitchen.spans[0][2] > hall.spans[0][2]
+
+    text = metrics.render_prometheus()
+    assert 'magus_stage_seconds_count{kind="node",stage="stt"} 2' in text
+    assert 'magus_parse_method_total{method="direct"} 2' in text
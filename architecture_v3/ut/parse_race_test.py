@@ -0,0 +1,160 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("MQTT_ENABLED", "false")
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from agent import AgentState, RacedReply, TextMsg
+from deadline import Deadline
+from llm_cache import LLMCache
+from llm_module import Classification
+from metrics import metrics
+from scheduler import RequestScheduler
+
+
+class FakeLLM:
+    """classify и stream_response с журналом: кто и когда получил слот LLM"""
+
+    def __init__(self, label: str, delay: float = 0.05, words=("Расскажу", "анекдот.")):
+        self.label = label
+        self.delay = delay
+        self.words = words
+        self.events = []
+
+    async def classify(self, text, labels):
+        self.events.append("classify_start")
+        await asyncio.sleep(self.delay)
+        self.events.append("classify_end")
+        return Classification.from_probs({self.label: 0.9})
+
+    def stream_response(self, prompt, system_prompt=None, purpose="reply"):
+        async def generate():
+            self.events.append("reply_start")
+            for word in self.words:
+                await asyncio.sleep(self.delay)
+                yield word + " "
+            self.events.append("reply_end")
+        return generate()
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    def install(label: str) -> FakeLLM:
+        llm = FakeLLM(label)
+        monkeypatch.setattr(agent, "llm_manager", llm)
+        monkeypatch.setattr(agent, "llm_cache", LLMCache("test", path=None))
+        monkeypatch.setattr(agent, "scheduler", RequestScheduler(limits={"llm": 1}))
+        monkeypatch.setattr(agent, "USE_LLM_FALLBACK", True)
+        monkeypatch.setattr(agent, "PERFORMANCE_MODE", "balanced")
+        monkeypatch.setattr(agent, "PARSE_RACE", True)
+        return llm
+    return install
+
+
+def parse(text: str) -> AgentState:
+    async def scenario():
+        state = await agent.intelligent_parsing_node(AgentState(text=TextMsg(text), deadline=Deadline(budget=5.0)))
+        # Даём отменённому ответу шанс (ошибочно) дойти до модели
+        await asyncio.sleep(0.1)
+        return state
+    return asyncio.run(scenario())
+
+
+def test_direct_confidence_ignores_priority_boost():
+
+    # Прямой разбор отдаёт любой фразе get_time с boost 0.3 - зацепкой это не считается
+    assert agent.tool_parser.direct_confidence("расскажи анекдот") == 0.0
+    assert agent.tool_parser.direct_confidence("засеки") == pytest.approx(0.3)
+    assert agent.tool_parser.direct_confidence("который час") >= agent.CONFIDENCE_THRESHOLD
+
+
+def test_classification_takes_the_llm_slot_before_the_raced_reply(fake_llm):
+
+    llm = fake_llm("ТАЙМЕР")
+    state = parse("засеки")
+    assert state.parse_method == "llm_assisted"
+    # Классификация нашла инструмент - ответ отменён, не дойдя до модели
+    assert llm.events == ["classify_start", "classify_end"]
+    assert state.raced_reply is None
+
+
+def test_raced_reply_runs_right_after_classification(fake_llm):
+
+    llm = fake_llm("НЕТ")
+    state = parse("засеки")
+    assert state.raced_reply is not None
+    assert llm.events[:3] == ["classify_start", "classify_end", "reply_start"]
+
+
+def test_no_race_without_borderline_direct_candidate(fake_llm):
+
+    llm = fake_llm("НЕТ")
+    state = parse("расскажи анекдот")
+    assert state.raced_reply is None
+    assert llm.events == ["classify_start", "classify_end"]
+
+
+def test_raced_reply_is_consumed_with_tokens_generated_so_far(fake_llm):
+
+    fake_llm("НЕТ")
+    metrics.reset()
+
+    async def scenario():
+        raced = RacedReply("засеки", "system", None)
+        # Часть токенов готова ещё до того, как ответ забрали
+        await asyncio.sleep(0.07)
+        return await raced.text(), raced
+
+    text, raced = asyncio.run(scenario())
+    assert text == "Расскажу анекдот. "
+    assert raced.consumed and raced.llm_finished_at >= raced.llm_started_at
+    counters = metrics.get_stats()["counters"]
+    assert counters["parse_race{outcome=launched}"] == 1
+    assert counters["parse_race{outcome=reply_used}"] == 1
+    assert "call:llm_race_wasted" not in metrics.get_stats()["stages"]
+
+
+def test_cancelled_raced_reply_reports_wasted_llm_time(fake_llm):
+
+    llm = fake_llm("НЕТ")
+    metrics.reset()
+
+    async def scenario():
+        raced = RacedReply("засеки", "system", None)
+        await asyncio.sleep(0.07)
+        raced.cancel()
+        # Повторная отмена и отмена забранного ответа ничего не считают
+        raced.cancel()
+        await asyncio.sleep(0.1)
+        return raced
+
+    raced = asyncio.run(scenario())
+    assert raced.task.cancelled()
+    assert "reply_end" not in llm.events
+    counters = metrics.get_stats()["counters"]
+    assert counters["parse_race{outcome=reply_cancelled}"] == 1
+    wasted = metrics.get_stats()["stages"]["call:llm_race_wasted"]
+    assert wasted["count"] == 1 and wasted["p50"] >= 0.05
+
+
+def test_raced_reply_cancelled_before_start_wastes_nothing(fake_llm):
+
+    fake_llm("НЕТ")
+    metrics.reset()
+
+    async def scenario():
+        raced = RacedReply("засеки", "system", None)
+        raced.cancel()
+        await asyncio.sleep(0.01)
+        return raced
+
+    raced = asyncio.run(scenario())
+    assert raced.llm_started_at is None
+    assert "call:llm_race_wasted" not in metrics.get_stats()["stages"]
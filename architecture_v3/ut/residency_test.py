@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_module
+from llm_module import ResidencyManager
+
+
+class FakeOllama:
+
+    def __init__(self, loaded, name="m"):
+        self.loaded = loaded
+        self.name = name
+        self.generated = []
+        self.options = []
+
+    async def ps(self):
+        return SimpleNamespace(models=[SimpleNamespace(model=self.name, name=self.name)] if self.loaded else [])
+
+    async def generate(self, model, keep_alive=None, options=None):
+        self.generated.append(keep_alive)
+        self.options.append(options)
+        self.loaded = keep_alive != 0
+
+
+def make_residency(monkeypatch, free_mb=4096) -> ResidencyManager:
+    residency = ResidencyManager("m", keep_alive=60, path=None)
+    monkeypatch.setattr(residency, "available_mb", lambda: free_mb)
+    return residency
+
+
+def at_hour(hour: int) -> float:
+    return time.mktime((2026, 3, 2, hour, 30, 0, 0, 0, -1))
+
+
+def test_usual_hours_and_recent_activity_keep_the_model_hot(monkeypatch):
+
+    residency = make_residency(monkeypatch)
+    assert not residency.should_stay_hot(at_hour(7))
+
+    # Каждое утро в 8 - привычка выучена, к 7:30 модель уже стоит греть
+    residency.hours[8] = 5.0
+    assert residency.should_stay_hot(at_hour(7))
+    assert not residency.should_stay_hot(at_hour(14))
+
+    residency.note_request(0.01, now=at_hour(14))
+    assert residency.should_stay_hot(at_hour(14) + 60)
+    assert not residency.should_stay_hot(at_hour(14) + llm_module.RESIDENCY_ACTIVE_WINDOW + 1)
+
+
+def test_cold_requests_are_counted(monkeypatch):
+
+    residency = make_residency(monkeypatch)
+    assert residency.note_request(4.2, now=at_hour(10))
+    assert not residency.note_request(0.01, now=at_hour(10) + 5)
+    # Время загрузки неизвестно - судим по тому, истёк ли keep_alive
+    assert not residency.note_request(None, now=at_hour(10) + 30)
+    assert residency.note_request(None, now=at_hour(10) + 200)
+    stats = residency.get_stats()
+    assert stats["requests"] == 4 and stats["cold"] == 2 and stats["cold_rate"] == 0.5
+
+
+def test_tick_prewarms_when_hot_and_unloads_under_pressure(monkeypatch):
+
+    residency = make_residency(monkeypatch)
+    residency._client = FakeOllama(loaded=False)
+    residency.last_use = at_hour(9)
+    asyncio.run(residency.tick(now=at_hour(9) + 10))
+    assert residency._client.generated == ["60s"]
+    assert residency.stats["prewarms"] == 1
+
+    monkeypatch.setattr(residency, "available_mb", lambda: 100)
+    asyncio.run(residency.tick(now=at_hour(9) + 30))
+    assert residency._client.generated == ["60s", 0]
+    assert residency.stats["unloads"] == 1
+    # Параметры раннера те же, что у ChatOllama, - иначе пинг перезагружал бы модель
+    expected = {"num_ctx": llm_module.LOCAL_CONTEXT, "num_thread": llm_module.LOCAL_THREADS,
+                "num_gpu": llm_module.LOCAL_NUM_GPU, "low_vram": llm_module.LOCAL_LOW_VRAM}
+    assert residency._client.options == [expected, expected]
+
+
+def test_pings_send_the_runner_options_of_chat_requests():
+
+    pytest.importorskip("langchain_ollama")
+    from langchain_core.messages import HumanMessage
+
+    residency = llm_module.LLMManager(provider="local", preload=False).residency
+    assert residency.options["num_ctx"] == llm_module.LOCAL_CONTEXT
+    for model in (llm_module._init_llm("local", 0.3), llm_module._init_classifier("local")):
+        sent = model._chat_params([HumanMessage("привет")])["options"]
+        assert {name: sent.get(name) for name in residency.options} == residency.options
+
+
+def test_tagless_model_matches_latest_in_ps(monkeypatch):
+
+    residency = make_residency(monkeypatch)
+    residency._client = FakeOllama(loaded=True, name="m:latest")
+    assert asyncio.run(residency._loaded())
+
+    residency.model = "m:latest"
+    residency._client = FakeOllama(loaded=True, name="m")
+    assert asyncio.run(residency._loaded())
+
+    residency._client = FakeOllama(loaded=True, name="m:7b")
+    assert not asyncio.run(residency._loaded())
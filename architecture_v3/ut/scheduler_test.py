@@ -0,0 +1,75 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import RequestScheduler
+
+
+def test_stage_slots_rotate_between_sites():
+
+    async def scenario():
+        scheduler = RequestScheduler(limits={"llm": 1})
+        order = []
+        release = asyncio.Event()
+
+        async def job(site_id, name, hold=False):
+            async with scheduler.stage("llm", site_id):
+                order.append(name)
+                if hold:
+                    await release.wait()
+
+        first = asyncio.create_task(job("kitchen", "k0", hold=True))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(job("kitchen", f"k{i}")) for i in range(1, 4)]
+        tasks.append(asyncio.create_task(job("bedroom", "b1")))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *tasks)
+        return order, scheduler.get_stats()
+
+    order, stats = asyncio.run(scenario())
+    # Спальня не ждёт, пока кухня выберет всю свою очередь
+    assert order[:3] == ["k0", "k1", "b1"]
+    assert stats["stages"]["llm"]["acquired"] == 5
+    assert stats["stages"]["llm"]["active"] == 0
+
+
+def test_stages_overlap_and_site_queue_is_bounded():
+
+    async def scenario():
+        scheduler = RequestScheduler(limits={"stt": 1, "tts": 1}, site_queue_max=1)
+        in_tts = asyncio.Event()
+        finish = asyncio.Event()
+
+        async def tts_job():
+            async with scheduler.stage("tts", "kitchen"):
+                in_tts.set()
+                await finish.wait()
+
+        tts_task = asyncio.create_task(tts_job())
+        await in_tts.wait()
+        # STT другой комнаты идёт параллельно с TTS кухни
+        async with scheduler.stage("stt", "bedroom"):
+            pass
+
+        processed = []
+
+        async def process(item):
+            await finish.wait()
+            processed.append(item)
+
+        site = scheduler.open_site("hall", process)
+        accepted = [site.submit(0)]
+        await asyncio.sleep(0)  # первая фраза уже в обработке, ещё одна может ждать
+        accepted += [site.submit(1), site.submit(2)]
+        finish.set()
+        await tts_task
+        await site.queue.join()
+        scheduler.close_site(site)
+        return accepted, processed
+
+    accepted, processed = asyncio.run(scenario())
+    assert accepted[0] and accepted[1] and not accepted[2]
+    assert processed == [0, 1]
@@ -0,0 +1,50 @@
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sentence_splitter import SentenceBuffer, split_sentences
+
+
+def test_split_simple_sentences():
+
+    text = "Привет! Как дела? Сегодня хорошая погода."
+
+    assert split_sentences(text) == ["Привет!", "Как дела?", "Сегодня хорошая погода."]
+
+
+def test_split_keeps_abbreviations_and_decimals():
+
+    text = "Будет 3.5 градуса, т. е. холодно. Оденьтесь теплее."
+
+    assert split_sentences(text) == ["Будет 3.5 градуса, т. е. холодно.", "Оденьтесь теплее."]
+
+
+def test_split_long_sentence_by_clauses():
+
+    text = ("Это очень длинное предложение, в котором много запятых, и оно продолжается, "
+            "и продолжается дальше, пока не закончится где-то тут, а потом ещё немного текста.")
+
+    segments = split_sentences(text, max_chars=60, min_chars=20)
+
+    assert len(segments) > 1
+    assert all(len(segment) <= 80 for segment in segments)
+    assert " ".join(segments) == text
+
+
+def test_split_empty_text():
+
+    assert split_sentences("") == []
+    assert split_sentences("   ") == []
+
+
+def test_sentence_buffer_emits_complete_sentences():
+
+    buffer = SentenceBuffer()
+    emitted = []
+    for token in ["При", "вет! Сейчас", " т. е. ", "утро. Хоро", "шего дня"]:
+        emitted.append(buffer.feed(token))
+
+    assert emitted == [[], ["Привет!"], [], ["Сейчас т. е. утро."], []]
+    assert buffer.flush() == ["Хорошего дня"]
+    assert buffer.flush() == []
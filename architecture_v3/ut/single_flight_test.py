@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqtt_tools
+from mqtt_tools import SingleFlight, execute_tool, tool_key
+
+
+def test_tool_key_ignores_argument_order():
+
+    assert tool_key("set_timer", {"minutes": 1, "seconds": 5}) == tool_key("set_timer", {"seconds": 5, "minutes": 1})
+    assert tool_key("get_weather", None) == tool_key("get_weather", {})
+
+
+def test_concurrent_calls_share_one_execution():
+
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def slow():
+        calls.append(1)
+        release.wait(2)
+        return "ясно"
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(flight.do, ("get_weather", "{}"), slow) for _ in range(4)]
+        time.sleep(0.1)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert results == ["ясно"] * 4
+    assert len(calls) == 1
+    assert flight.get_stats() == {"calls": 4, "shared": 3, "in_flight": 0}
+
+
+# Второй вариант - SPECULATIVE_TOOLS=get_weather,set_timer в окружении: таймер всё равно не общий
+@pytest.mark.parametrize("speculative", [None, frozenset({"get_weather", "set_timer"})])
+def test_side_effecting_tools_are_not_coalesced(monkeypatch, speculative):
+
+    calls = {"get_weather": 0, "set_timer": 0}
+    lock = threading.Lock()
+
+    def tool(name):
+        def run(**kwargs):
+            with lock:
+                calls[name] += 1
+            time.sleep(0.1)
+            return name
+        return run
+
+    monkeypatch.setattr(mqtt_tools, "tool_flight", SingleFlight())
+    if speculative is not None:
+        monkeypatch.setattr(mqtt_tools, "SPECULATIVE_TOOLS", speculative)
+    monkeypatch.setitem(mqtt_tools.tool_mapping, "get_weather", tool("get_weather"))
+    monkeypatch.setitem(mqtt_tools.tool_mapping, "set_timer", tool("set_timer"))
+
+    with ThreadPoolExecutor(6) as pool:
+        futures = [pool.submit(execute_tool, name, {"minutes": 1} if name == "set_timer" else {})
+                   for name in ["get_weather", "set_timer"] * 3]
+        assert [future.result() for future in futures] == ["get_weather", "set_timer"] * 3
+
+    assert calls == {"get_weather": 1, "set_timer": 3}
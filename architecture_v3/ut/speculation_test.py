@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from improved_tool_parser import OptimizedToolParser, ToolCall
+from speculation import Speculation, speculation_stats
+
+
+def test_speculative_result_is_reused_when_confirmed():
+
+    calls = []
+
+    async def run_tool(name, args):
+        calls.append(name)
+        return f"{name} ok"
+
+    async def scenario():
+        speculation = Speculation(OptimizedToolParser(), run_tool)
+        speculation.observe("который")
+        speculation.observe("который час")
+        speculation.observe("который час сейчас")
+        result = await speculation.take("get_time", {})
+        speculation.discard()
+        return result
+
+    hits = speculation_stats["hits"]
+    assert asyncio.run(scenario()) == "get_time ok"
+    assert calls == ["get_time"]
+    assert speculation_stats["hits"] == hits + 1
+
+
+def test_unconfirmed_speculation_is_discarded():
+
+    async def run_tool(name, args):
+        return "weather"
+
+    async def scenario():
+        speculation = Speculation(OptimizedToolParser(), run_tool)
+        speculation.observe("какая погода")
+        await asyncio.sleep(0)
+        # Финальный текст оказался другим - tools_node спрашивает другой инструмент
+        result = await speculation.take("get_time", {})
+        speculation.discard()
+        return result
+
+    misses = speculation_stats["misses"]
+    assert asyncio.run(scenario()) is None
+    assert speculation_stats["misses"] == misses + 1
+
+
+def test_side_effect_tools_are_not_speculated():
+
+    async def run_tool(name, args):
+        raise AssertionError("не должен вызываться")
+
+    class TimerParser:
+        def parse_text_for_tools(self, text, use_llm_fallback=True):
+            return [ToolCall(name="set_timer", args={"minutes": 5}, confidence=1.0)]
+
+    async def scenario():
+        speculation = Speculation(TimerParser(), run_tool)
+        speculation.observe("поставь таймер на пять минут")
+        return dict(speculation._tasks)
+
+    assert asyncio.run(scenario()) == {}
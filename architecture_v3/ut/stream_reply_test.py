@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("MQTT_ENABLED", "false")
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from agent import AgentState, ClientReply, ThinkFilter
+from deadline import Deadline
+from scheduler import RequestScheduler
+
+CHUNKS = ["<think>Пользователь спрашивает о погоде.</think>", "Сегодня солнечно и тепло. ",
+          "Завтра будет дождь. Возьмите", " зонт."]
+SENTENCES = ["Сегодня солнечно и тепло.", "Завтра будет дождь.", "Возьмите зонт."]
+
+
+class FakeClient:
+    """ws клиента агента: запоминает всё, что ему отправили"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+class FakeLLM:
+
+    async def stream_response(self, txt, system_prompt=None):
+        for chunk in CHUNKS:
+            await asyncio.sleep(0)
+            yield chunk
+
+
+@pytest.fixture
+def reply(monkeypatch):
+    """Запускает stream_llm_reply с заданным TTS, возвращает текст и сообщения клиенту"""
+    monkeypatch.setattr(agent, "llm_manager", FakeLLM())
+    monkeypatch.setattr(agent, "scheduler", RequestScheduler())
+
+    def run(tts_client):
+        monkeypatch.setattr(agent, "tts_client", tts_client)
+        client = FakeClient()
+        state = AgentState(site_id="kitchen", deadline=Deadline(), audio_sink=ClientReply(client))
+        text = asyncio.run(agent.stream_llm_reply(state, "system", "какая погода"))
+        return text, client.sent, state
+    return run
+
+
+def feed_all(think: ThinkFilter, chunks) -> str:
+    return "".join(think.feed(chunk) for chunk in chunks) + think.flush()
+
+
+def test_think_filter_handles_tags_split_across_chunks():
+
+    assert feed_all(ThinkFilter(), ["<thi", "nk>рассуждение</th", "ink>Ответ", "."]) == "Ответ."
+    assert feed_all(ThinkFilter(), ["Раз <", "THINK>", "скрыто<", "/think> два"]) == "Раз  два"
+    # Придержанный хвост, не ставший тегом, отдаётся при flush
+    think = ThinkFilter()
+    assert think.feed("Ответ <") == "Ответ "
+    assert think.feed("3") == "<3"
+    assert think.feed(" <th") == " "
+    assert think.flush() == "<th"
+
+
+def test_think_filter_drops_unclosed_block_on_flush():
+
+    think = ThinkFilter()
+    assert think.feed("Ответ.<think>начало рассуждения</thi") == "Ответ."
+    assert think.flush() == ""
+
+
+def test_client_reply_frames_segments_between_begin_and_end():
+
+    async def scenario():
+        client = FakeClient()
+        sink = ClientReply(client)
+        await sink.close()
+        assert client.sent == []
+        await sink.send(b"one")
+        await sink.send(b"two")
+        await sink.close()
+        return client.sent
+
+    assert asyncio.run(scenario()) == ["AUDIO_STREAM_BEGIN", b"one", b"two", "AUDIO_STREAM_END"]
+
+
+def test_sentences_reach_client_in_order_when_later_tts_finishes_first(reply):
+
+    done = []
+
+    async def tts_client(text, formats=None):
+        # Первое предложение синтезируется дольше остальных
+        await asyncio.sleep(0.05 if text == SENTENCES[0] else 0)
+        done.append(text)
+        return text.encode("utf-8")
+
+    text, sent, state = reply(tts_client)
+    assert done[-1] == SENTENCES[0]
+    assert text == " ".join(SENTENCES)
+    assert sent == ["AUDIO_STREAM_BEGIN", *[s.encode("utf-8") for s in SENTENCES], "AUDIO_STREAM_END"]
+    assert state.audio_streamed
+
+
+def test_tts_failure_skips_only_that_sentence(reply):
+
+    async def tts_client(text, formats=None):
+        if text == SENTENCES[1]:
+            raise RuntimeError("TTS недоступен")
+        return text.encode("utf-8")
+
+    text, sent, state = reply(tts_client)
+    assert text == " ".join(SENTENCES)
+    assert sent == ["AUDIO_STREAM_BEGIN", SENTENCES[0].encode("utf-8"), SENTENCES[2].encode("utf-8"),
+                    "AUDIO_STREAM_END"]
+    assert state.audio_streamed
@@ -0,0 +1,82 @@
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts_cache import TTSCache, collect_canned_phrases
+
+
+def test_cache_normalizes_text():
+
+    cache = TTSCache(max_bytes=1024, max_entries=10)
+    cache.put(TTSCache.make_key("Таймер  активирован ", "model", 0), b"wav")
+
+    assert cache.get(TTSCache.make_key("Таймер активирован", "model", 0)) == b"wav"
+    assert cache.get(TTSCache.make_key("Таймер активирован", "other", 0)) is None
+
+
+def test_cache_evicts_least_recently_used_by_bytes():
+
+    cache = TTSCache(max_bytes=10, max_entries=10)
+    cache.put(("a",), b"1234")
+    cache.put(("b",), b"1234")
+    cache.get(("a",))
+    cache.put(("c",), b"1234")
+
+    assert cache.get(("b",)) is None
+    assert cache.get(("a",)) == b"1234"
+    assert cache.get_stats()["bytes"] <= 10
+
+
+def test_collect_canned_phrases(tmp_path):
+
+    source = tmp_path / "handlers.py"
+    source.write_text(
+        'def handler(client, hours):\n'
+        '    """Документация не озвучивается"""\n'
+        '    print("[INFO] Лог не озвучивается")\n'
+        '    response_text = "Таймер активирован"\n'
+        '    dynamic = f"Текущее время {hours} часов"\n'
+        '    client.publish("hermes/tts/say", json.dumps({"text": "Не поняла"}))\n'
+        '    return response_text\n',
+        encoding="utf-8",
+    )
+
+    assert collect_canned_phrases([str(source)]) == ["Таймер активирован", "Не поняла"]
+
+
+def test_phrase_miss_is_counted_once(monkeypatch):
+
+    import asyncio
+    import piper_tts
+
+    async def fake_piper(text, model_path, speaker_id, low_priority):
+        return b"WAV:" + text.encode("utf-8")
+
+    monkeypatch.setattr(piper_tts, "_synthesize_piper", fake_piper)
+    monkeypatch.setattr(piper_tts, "tts_cache", TTSCache(max_bytes=1024, max_entries=10))
+
+    async def scenario():
+        return [await piper_tts.synthesize_phrase("Таймер активирован") for _ in range(2)]
+
+    assert asyncio.run(scenario()) == [b"WAV:" + "Таймер активирован".encode("utf-8")] * 2
+    stats = piper_tts.tts_cache.get_stats()
+    assert (stats["misses"], stats["hits"], stats["entries"]) == (1, 1, 1)
+
+
+def test_warm_up_skips_failed_phrase(monkeypatch):
+
+    import asyncio
+    import piper_tts
+
+    async def fake_synthesize(text, priority="conversation"):
+        if text == "Ошибка":
+            raise RuntimeError("piper упал")
+        piper_tts.tts_cache.put(TTSCache.make_key(text, piper_tts.PIPER_MODEL_PATH, piper_tts.PIPER_SPEAKER_ID), b"wav")
+        return b"wav"
+
+    monkeypatch.setattr(piper_tts, "synthesize", fake_synthesize)
+    monkeypatch.setattr(piper_tts, "tts_cache", TTSCache(max_bytes=1024, max_entries=10))
+
+    asyncio.run(piper_tts.warm_cache(["Готово", "Ошибка", "Таймер активирован"]))
+    assert piper_tts.tts_cache.get_stats()["entries"] == 2
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts_pool import SynthesisPool, TTSOverloaded, resolve_priority
+
+
+def job(name, order, gate=None):
+    async def factory():
+        if gate is not None:
+            await gate.wait()
+        order.append(name)
+        return name.encode()
+    return factory
+
+
+async def occupy(pool, gate, order):
+    """Занимает единственный воркер, пока не открыт gate"""
+    task = asyncio.create_task(pool.submit(job("busy", order, gate)))
+    await asyncio.sleep(0.01)
+    return task
+
+
+def test_unknown_priority_falls_back_to_conversation():
+
+    assert resolve_priority("alarm") == "alarm"
+    assert resolve_priority("ALARM") == "alarm"
+    assert resolve_priority("other") == "conversation"
+    assert resolve_priority(None) == "conversation"
+
+
+def test_queued_jobs_run_by_priority_then_fifo():
+
+    async def scenario():
+        pool = SynthesisPool(workers=1, max_queue=8)
+        gate, order = asyncio.Event(), []
+        busy = await occupy(pool, gate, order)
+        names = [("warmup", "warmup"), ("conversation", "conv1"), ("alarm", "alarm"),
+                 ("conversation", "conv2"), ("reminder", "reminder")]
+        waiting = [asyncio.create_task(pool.submit(job(name, order), priority)) for priority, name in names]
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(busy, *waiting)
+        return order, results
+
+    order, results = asyncio.run(scenario())
+    assert order == ["busy", "alarm", "reminder", "conv1", "conv2", "warmup"]
+    assert results[1:] == [b"warmup", b"conv1", b"alarm", b"conv2", b"reminder"]
+
+
+def test_full_queue_rejects_equal_priority_and_evicts_less_important():
+
+    async def scenario():
+        pool = SynthesisPool(workers=1, max_queue=2)
+        gate, order = asyncio.Event(), []
+        busy = await occupy(pool, gate, order)
+        queued = [asyncio.create_task(pool.submit(job(f"conv{i}", order), "conversation")) for i in range(2)]
+        await asyncio.sleep(0.01)
+
+        # Вытеснять некого - отказ сразу, без ожидания
+        with pytest.raises(TTSOverloaded):
+            await pool.submit(job("conv2", order), "conversation")
+        # Будильник важнее разговора: вытесняет последний из ожидающих
+        alarm = asyncio.create_task(pool.submit(job("alarm", order), "alarm"))
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(busy, alarm, *queued, return_exceptions=True)
+        return order, results, pool.get_stats()
+
+    order, results, stats = asyncio.run(scenario())
+    assert order == ["busy", "alarm", "conv0"]
+    assert results[:3] == [b"busy", b"alarm", b"conv0"]
+    assert isinstance(results[3], TTSOverloaded)
+    assert stats["classes"]["conversation"]["rejected"] == 2
+    assert stats["classes"]["alarm"]["rejected"] == 0
+
+
+def test_stats_report_queue_and_wait_times():
+
+    async def scenario():
+        pool = SynthesisPool(workers=1, max_queue=4)
+        gate, order = asyncio.Event(), []
+        busy = await occupy(pool, gate, order)
+        reminder = asyncio.create_task(pool.submit(job("reminder", order), "reminder"))
+        await asyncio.sleep(0.05)
+        during = pool.get_stats()
+        gate.set()
+        await asyncio.gather(busy, reminder)
+
+        async def broken():
+            raise RuntimeError("piper упал")
+        with pytest.raises(RuntimeError):
+            await pool.submit(broken, "reminder")
+        return during, pool.get_stats()
+
+    during, after = asyncio.run(scenario())
+    assert (during["workers"], during["busy"], during["queued"]) == (1, 1, 1)
+    assert (after["busy"], after["queued"]) == (0, 0)
+    reminder = after["classes"]["reminder"]
+    assert (reminder["submitted"], reminder["completed"], reminder["failed"]) == (2, 1, 1)
+    # Напоминание ждало, пока воркер занят
+    assert reminder["wait_max"] >= 0.04
+    assert reminder["wait_avg"] <= reminder["wait_p95"] <= reminder["wait_max"]
+    assert after["classes"]["conversation"]["wait_max"] < 0.04
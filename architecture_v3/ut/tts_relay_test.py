@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+import websockets
+
+os.environ.setdefault("MQTT_ENABLED", "false")
+os.environ.setdefault("PERF_MONITOR", "false")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from agent import ClientReply, tts_relay
+from ws_pool import WSConnectionPool
+from ws_protocol import MsgType, select_subprotocol, serve_framed
+
+FRAMES = [b"\x01\x00" * 4, b"\x02\x00" * 4]
+HEADER = {"format": "pcm", "sample_rate": 22050, "channels": 1}
+
+
+class FakeClient:
+    """ws клиента агента: запоминает всё, что ему отправили"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+async def legacy_tts(ws):
+    async for message in ws:
+        request = json.loads(message)
+        ws.requests.append(request["text"])
+        await ws.send(json.dumps({"type": "stream_start", "id": request["id"], **HEADER}))
+        for frame in FRAMES:
+            await ws.send(frame)
+        if request["text"] == "обрыв":
+            await ws.close()
+            return
+        await ws.send(json.dumps({"type": "stream_end", "id": request["id"]}))
+
+
+async def framed_tts(ws):
+    async def handle(request):
+        ws.requests.append(request.first.headers["text"])
+        if request.first.headers["text"] == "занято":
+            await request.send(MsgType.BUSY)
+            return
+        await request.send(MsgType.AUDIO_START, HEADER, stream_id=1)
+        for frame in FRAMES:
+            await request.send(MsgType.AUDIO, payload=frame, stream_id=1)
+        await request.send(MsgType.END, stream_id=1)
+        await request.send(MsgType.END)
+    await serve_framed(ws, handle)
+
+
+def relay(monkeypatch, server, text, framed):
+    requests = []
+
+    async def handler(ws):
+        ws.requests = requests
+        await server(ws)
+
+    async def scenario():
+        async with websockets.serve(handler, "127.0.0.1", 0, select_subprotocol=select_subprotocol) as srv:
+            port = srv.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("tts", f"ws://127.0.0.1:{port}", size=1, framed=framed)
+            monkeypatch.setattr(agent, "tts_pool", pool)
+            # Соединение уже в пуле: обрыв на нём раньше приводил к повтору запроса
+            await pool.warm()
+            client = FakeClient()
+            relayed = await tts_relay(text, ClientReply(client))
+            await pool.close()
+            return relayed, client.sent
+
+    relayed, sent = asyncio.run(scenario())
+    return relayed, sent, requests
+
+
+@pytest.mark.parametrize("server,framed", [(legacy_tts, False), (framed_tts, True)])
+def test_relay_frames_audio_between_begin_and_end(monkeypatch, server, framed):
+
+    relayed, sent, requests = relay(monkeypatch, server, "привет", framed)
+    assert relayed is True
+    assert json.loads(sent[0]) == {"type": "audio_relay", **HEADER}
+    assert sent[1:] == FRAMES + ["AUDIO_RELAY_END"]
+    assert requests == ["привет"]
+
+
+def test_refused_relay_falls_back_without_touching_client(monkeypatch):
+
+    relayed, sent, requests = relay(monkeypatch, framed_tts, "занято", True)
+    assert relayed is False
+    assert sent == []
+
+
+def test_mid_stream_failure_is_not_retried(monkeypatch):
+
+    relayed, sent, requests = relay(monkeypatch, legacy_tts, "обрыв", False)
+    assert relayed is True
+    # Начало потока и аудио ушли клиенту ровно один раз, поток закрыт
+    assert [message for message in sent if isinstance(message, str)] == [
+        json.dumps({"type": "audio_relay", **HEADER}), "AUDIO_RELAY_END"]
+    assert sent[1:3] == FRAMES
+    assert requests == ["обрыв"]
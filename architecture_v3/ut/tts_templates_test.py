@@ -0,0 +1,106 @@
+import asyncio
+import sys
+import os
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_utils import pcm_to_wav, wav_to_pcm
+from tts_templates import TemplateSynthesizer, normalize_number
+
+
+async def fake_render(text, priority):
+
+    # 0.1 с тишины, тон, длина которого зависит от текста, и снова 0.1 с тишины
+    silence = np.zeros(2205, dtype=np.int16)
+    tone = (np.sin(np.arange(1000 + 50 * len(text)) / 5) * 8000).astype(np.int16)
+    return pcm_to_wav(np.concatenate([silence, tone, silence]).tobytes(), 22050)
+
+
+def test_time_template_is_assembled_from_prerendered_fragments():
+
+    synth = TemplateSynthesizer(fake_render)
+    asyncio.run(synth.prerender())
+
+    wav = asyncio.run(synth.synthesize("Текущее время 12 часов, 5 минут"))
+    pcm, sample_rate, channels, _ = wav_to_pcm(wav)
+
+    assert sample_rate == 22050 and channels == 1
+    assert len(pcm) > 0
+    assert synth.stats == {"assembled": 1, "dynamic_renders": 0}
+
+
+def test_weather_template_renders_open_slots_on_demand():
+
+    synth = TemplateSynthesizer(fake_render)
+    asyncio.run(synth.prerender())
+
+    text = ("Текущая погода для региона Kazan: температура 12.3 градусов по цельсию, "
+            "скорость ветра 14.0 километров в час")
+    assert asyncio.run(synth.synthesize(text)) is not None
+    assert asyncio.run(synth.synthesize(text)) is not None
+
+    # Регион - один раз; дробные числа округлены и взяты из пререндеренных
+    assert synth.stats["dynamic_renders"] == 1
+    assert list(synth.dynamic) == ["Kazan"]
+
+
+def test_number_normalization():
+
+    assert normalize_number("14.0") == 14
+    assert normalize_number("-3,0") == -3
+    assert normalize_number("12.5") == 13
+    assert normalize_number("-0.4") == 0
+    assert normalize_number("12.3", round_numbers=False) is None
+    assert normalize_number("много") is None
+
+
+def test_unknown_text_is_not_templated():
+
+    synth = TemplateSynthesizer(fake_render)
+    asyncio.run(synth.prerender())
+
+    assert asyncio.run(synth.synthesize("Привет, как дела?")) is None
+
+
+class FakeStreamOut:
+
+    def __init__(self):
+        self.segments = None
+        self.data = b""
+
+    async def stream_start(self, header, segments):
+        self.segments = segments
+
+    async def frames(self, data):
+        self.data += data
+        return len(data)
+
+    async def stream_end(self, segments, total_bytes):
+        pass
+
+    async def error(self, message):
+        raise AssertionError(message)
+
+
+def test_stream_matches_template_before_sentence_split(monkeypatch):
+
+    import piper_tts
+
+    async def no_piper(text, priority="conversation"):
+        raise AssertionError(f"Piper для '{text}'")
+
+    synth = TemplateSynthesizer(fake_render)
+    asyncio.run(synth.prerender())
+    monkeypatch.setattr(piper_tts, "template_synth", synth)
+    monkeypatch.setattr(piper_tts, "synthesize_phrase", no_piper)
+
+    text = ("Текущая погода для региона Санкт-Петербург и Ленинградская область: температура -3.6 градусов "
+            "по цельсию, скорость ветра 7.0 километров в час")
+    assert len(piper_tts.split_sentences(text)) > 1
+    out = FakeStreamOut()
+    asyncio.run(piper_tts.tts_stream(out, text, formats=["pcm"]))
+
+    assert out.segments == 1 and out.data
+    assert synth.stats == {"assembled": 1, "dynamic_renders": 1}
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sys
+
+import websockets
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_pool import WSConnectionPool
+
+
+async def _echo(ws):
+    async for message in ws:
+        if message == "bye":
+            await ws.close()
+            return
+        await ws.send(message)
+
+
+async def _ask(ws, request_id):
+    await ws.send(f"req {request_id}")
+    return await ws.recv()
+
+
+def test_pool_reuses_connections():
+
+    async def scenario():
+        async with websockets.serve(_echo, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("echo", f"ws://127.0.0.1:{port}", size=2)
+            answers = await asyncio.gather(*[pool.request(_ask) for _ in range(5)])
+            await pool.close()
+            return answers, pool.get_stats()
+
+    answers, stats = asyncio.run(scenario())
+    assert sorted(answers) == [f"req {i}" for i in range(1, 6)]
+    assert stats["requests"] == 5
+    assert stats["connects"] <= 2
+
+
+def test_pool_reconnects_after_server_close():
+
+    async def bye(ws, request_id):
+        await ws.send("bye")
+        return await ws.recv()
+
+    async def scenario():
+        async with websockets.serve(_echo, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("echo", f"ws://127.0.0.1:{port}", size=1)
+            await pool.warm()
+            try:
+                await pool.request(bye)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            answer = await pool.request(_ask)
+            await pool.close()
+            return answer, pool.get_stats()
+
+    answer, stats = asyncio.run(scenario())
+    assert answer.startswith("req")
+    assert stats["connects"] >= 2
+
+
+def test_non_idempotent_handler_is_not_retried_after_partial_output():
+
+    output = []
+
+    async def partial(ws, request_id):
+        await ws.send("bye")
+        # Что-то уже ушло дальше (например, клиенту) до обрыва соединения
+        output.append(request_id)
+        return await ws.recv()
+
+    async def scenario(idempotent):
+        async with websockets.serve(_echo, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("echo", f"ws://127.0.0.1:{port}", size=1)
+            await pool.warm()
+            try:
+                await pool.request(partial, idempotent=idempotent)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+            await pool.close()
+            return pool.get_stats()
+
+    stats = asyncio.run(scenario(False))
+    assert output == [1]
+    assert stats["reconnects"] == 0 and stats["failures"] == 1
+
+    # Идемпотентный handler после обрыва простаивающего соединения повторяется
+    output.clear()
+    stats = asyncio.run(scenario(True))
+    assert output == [1, 1]
+    assert stats["reconnects"] == 1
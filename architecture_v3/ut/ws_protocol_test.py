@@ -0,0 +1,174 @@
+import asyncio
+import os
+import struct
+import sys
+
+import pytest
+import websockets
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_pool import WSConnectionPool
+from ws_protocol import (FLAG_FINAL, SUBPROTOCOL, Frame, MsgType, ProtocolError, decode_frame, encode_frame,
+                         select_subprotocol, serve_framed)
+
+
+def test_frame_round_trip():
+
+    frame = Frame(MsgType.AUDIO_START, request_id=7, stream_id=2, flags=FLAG_FINAL, payload=b"\x00\x01",
+                  headers={"format": "pcm", "sample_rate": 24000, "gain": 0.5, "relay": True,
+                           "formats": ["opus", "wav"], "raw": b"\xff"})
+    decoded = decode_frame(encode_frame(frame))
+    assert decoded == frame
+
+
+def test_decode_rejects_garbage():
+
+    with pytest.raises(ProtocolError):
+        decode_frame(b"\x01\x02")
+    data = bytearray(encode_frame(Frame(MsgType.END)))
+    data[0] = 9
+    with pytest.raises(ProtocolError):
+        decode_frame(bytes(data))
+
+
+def _with_header(key: bytes, tag: int, raw: bytes) -> bytes:
+    headers = bytes([len(key)]) + key + struct.pack("!BH", tag, len(raw)) + raw
+    return struct.pack("!BBBBIIH", 1, int(MsgType.REQUEST), 0, 0, 1, 0, len(headers)) + headers
+
+
+def test_list_items_keep_their_types():
+
+    frame = Frame(MsgType.HELLO, headers={"sample_rates": [16000, 22050], "mixed": ["pcm", 1.5, True, [1]],
+                                          "empty": []})
+    assert decode_frame(encode_frame(frame)).headers == frame.headers
+
+
+@pytest.mark.parametrize("data", [
+    _with_header(b"\xff\xfe", 3, b"pcm"),          # ключ не UTF-8
+    _with_header(b"format", 3, b"\xc3"),            # строка не UTF-8
+    _with_header(b"rate", 1, b"\x00\x01"),          # int не из 8 байт
+    _with_header(b"rates", 6, b"\x01\x00\x08\x00"),  # элемент списка обрезан
+    _with_header(b"rates", 6, b"\x01"),             # заголовок элемента обрезан
+    _with_header(b"format", 3, b"pcm")[:-4],        # заголовок обрезан
+])
+def test_decode_wraps_malformed_frames(data):
+
+    with pytest.raises(ProtocolError):
+        decode_frame(data)
+
+
+def test_server_survives_malformed_frame():
+
+    async def handler(ws):
+        await serve_framed(ws, _slow_echo)
+
+    async def scenario():
+        async with websockets.serve(handler, "127.0.0.1", 0, select_subprotocol=select_subprotocol) as server:
+            port = server.sockets[0].getsockname()[1]
+            async with websockets.connect(f"ws://127.0.0.1:{port}", subprotocols=[SUBPROTOCOL]) as ws:
+                await ws.send(_with_header(b"n", 3, b"\xc3"))
+                error = decode_frame(await ws.recv())
+                await ws.send(encode_frame(Frame(MsgType.REQUEST, request_id=2, headers={"n": 1})))
+                return error, decode_frame(await ws.recv())
+
+    error, answer = asyncio.run(scenario())
+    assert error.type == MsgType.ERROR
+    assert answer.request_id == 2 and answer.payload == b"1"
+
+
+async def _slow_echo(request):
+    # Первый запрос отвечает последним: ответы приходят не по порядку
+    await asyncio.sleep(0.05 if request.first.headers["n"] == 0 else 0)
+    await request.send(MsgType.TEXT, payload=str(request.first.headers["n"]).encode(), flags=FLAG_FINAL)
+
+
+async def _framed_server(ws):
+    await serve_framed(ws, _slow_echo)
+
+
+async def _ask(request, request_id):
+    await request.send(MsgType.REQUEST, {"n": request_id - 1})
+    frame = await request.recv()
+    return frame.payload.decode()
+
+
+def test_pool_multiplexes_over_one_connection():
+
+    async def scenario():
+        async with websockets.serve(_framed_server, "127.0.0.1", 0, select_subprotocol=select_subprotocol) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("framed", f"ws://127.0.0.1:{port}", size=1)
+            answers = await asyncio.gather(*[pool.request(_ask) for _ in range(4)])
+            stats = pool.get_stats()
+            await pool.close()
+            return answers, stats
+
+    answers, stats = asyncio.run(scenario())
+    assert answers == ["0", "1", "2", "3"]
+    assert stats["framed"] is True
+    assert stats["connects"] == 1
+
+
+def test_cancelled_request_keeps_connection():
+
+    cancelled = []
+
+    async def never_answers(request):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(request.request_id)
+            raise
+
+    async def handler(ws):
+        await serve_framed(ws, lambda request: never_answers(request) if request.first.headers.get("hang")
+                           else _slow_echo(request))
+
+    async def hang(request, request_id):
+        await request.send(MsgType.REQUEST, {"hang": True, "n": 0})
+        return await request.recv()
+
+    async def scenario():
+        async with websockets.serve(handler, "127.0.0.1", 0, select_subprotocol=select_subprotocol) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("framed", f"ws://127.0.0.1:{port}")
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(pool.request(hang), timeout=0.05)
+            answer = await pool.request(_ask)
+            await asyncio.sleep(0.05)
+            stats = pool.get_stats()
+            await pool.close()
+            return answer, stats
+
+    answer, stats = asyncio.run(scenario())
+    assert answer == "1"
+    assert cancelled == [1]
+    assert stats["connects"] == 1 and stats["discarded"] == 0
+
+
+def test_framed_non_idempotent_handler_is_not_retried():
+
+    calls = []
+
+    async def handler(ws):
+        await serve_framed(ws, lambda request: ws.close())
+
+    async def partial(request, request_id):
+        calls.append(request_id)
+        await request.send(MsgType.REQUEST, {"n": 0})
+        return await request.recv()
+
+    async def scenario():
+        async with websockets.serve(handler, "127.0.0.1", 0, select_subprotocol=select_subprotocol) as server:
+            port = server.sockets[0].getsockname()[1]
+            pool = WSConnectionPool("framed", f"ws://127.0.0.1:{port}")
+            with pytest.raises(websockets.exceptions.ConnectionClosed):
+                await pool.request(partial, idempotent=False)
+            stats = pool.get_stats()
+            await pool.close()
+            return stats
+
+    stats = asyncio.run(scenario())
+    assert calls == [1]
+    assert stats["reconnects"] == 0 and stats["failures"] == 1
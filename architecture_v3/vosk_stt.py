@@ -7,6 +7,7 @@ from typing import Optional
 from dotenv import load_dotenv
 import numpy as np
 import webrtcvad
+from ws_protocol import FLAG_FINAL, MsgType, ServerRequest, is_framed, select_subprotocol, serve_framed
 
 load_dotenv()
 
@@ -94,17 +95,112 @@ async def stt_vosk(audio: AudioMsg) -> str:
     
     return recognized_text
 
+# Потоковое распознавание: аудио подаётся по мере записи, клиент получает промежуточные гипотезы
+class StreamSession:
+    def __init__(self, sample_rate: int = PCM_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.rec = KaldiRecognizer(model, sample_rate)
+        self.audio = bytearray()
+        self.final_parts = []
+        self.last_partial = ""
+
+    def accept(self, chunk: bytes) -> Optional[str]:
+        """Подаёт кусок аудио; возвращает новую промежуточную гипотезу или None"""
+        self.audio.extend(chunk)
+        if self.rec.AcceptWaveform(chunk):
+            text = json.loads(self.rec.Result()).get("text", "")
+            if text:
+                self.final_parts.append(text)
+            partial = ""
+        else:
+            partial = json.loads(self.rec.PartialResult()).get("partial", "")
+        hypothesis = " ".join(self.final_parts + ([partial] if partial else []))
+        if hypothesis and hypothesis != self.last_partial:
+            self.last_partial = hypothesis
+            return hypothesis
+        return None
+
+    def finish(self) -> str:
+        text = json.loads(self.rec.FinalResult()).get("text", "")
+        if text:
+            self.final_parts.append(text)
+        if not detect_speech(bytes(self.audio), self.sample_rate):
+            return "Не удалось распознать речь"
+        return " ".join(self.final_parts) or "Не удалось распознать речь"
+
+# Обработчик запроса magus.v1
+async def handle_framed_request(request: ServerRequest):
+    """
+    REQUEST {sample_rate, partials}, кадры AUDIO, END -> TEXT с FLAG_FINAL.
+    Промежуточные гипотезы - кадры TEXT без флага, если клиент их попросил.
+    """
+    first = request.first
+    if first.type != MsgType.REQUEST:
+        await request.send(MsgType.ERROR, {"message": f"Ожидался REQUEST, получен {first.type.name}"})
+        return
+    session = StreamSession(int(first.headers.get("sample_rate", PCM_SAMPLE_RATE)))
+    partials = bool(first.headers.get("partials", False))
+    try:
+        while True:
+            frame = await request.recv()
+            if frame.type == MsgType.END:
+                break
+            if frame.type != MsgType.AUDIO:
+                continue
+            partial = await asyncio.to_thread(session.accept, frame.payload)
+            if partial and partials:
+                await request.send(MsgType.TEXT, payload=partial.encode("utf-8"))
+        text = await asyncio.to_thread(session.finish)
+        await request.send(MsgType.TEXT, payload=text.encode("utf-8"), flags=FLAG_FINAL)
+    except websockets.exceptions.ConnectionClosed:
+        raise
+    except Exception as e:
+        await request.send(MsgType.ERROR, {"message": str(e)})
+
 # Обработчик WebSocket для сервера STT
 async def stt_ws_handler(ws):
+    """
+    Старый протокол: одно бинарное сообщение PCM -> текст.
+    Потоковый: {"type": "stream_begin"}, бинарные куски PCM, {"type": "stream_end"};
+    сервер отвечает {"type": "partial", "text"} по мере распознавания и {"type": "final", "text"} в конце.
+    """
+    if is_framed(ws):
+        try:
+            await serve_framed(ws, handle_framed_request)
+        except websockets.exceptions.ConnectionClosed as e:
+            print(f"[STT WS] Connection closed: {e}")
+        return
+
+    session = None
     try:
         async for message in ws:
             if isinstance(message, bytes):
+                if session is not None:
+                    partial = await asyncio.to_thread(session.accept, message)
+                    if partial:
+                        await ws.send(json.dumps({"type": "partial", "text": partial}, ensure_ascii=False))
+                    continue
                 audio = AudioMsg(message)
                 try:
                     text = await stt_vosk(audio)
                     await ws.send(text)
                 except Exception as e:
                     await ws.send(f"ERROR: {e}")
+                continue
+
+            try:
+                request = json.loads(message)
+            except json.JSONDecodeError:
+                request = None
+            if isinstance(request, dict) and request.get("type") == "stream_begin":
+                session = StreamSession(int(request.get("sample_rate", PCM_SAMPLE_RATE)))
+            elif isinstance(request, dict) and request.get("type") == "stream_end" and session is not None:
+                try:
+                    text = await asyncio.to_thread(session.finish)
+                    await ws.send(json.dumps({"type": "final", "text": text}, ensure_ascii=False))
+                except Exception as e:
+                    await ws.send(f"ERROR: {e}")
+                session = None
             else:
                 await ws.send("ERROR: Only binary PCM messages supported")
     except websockets.exceptions.ConnectionClosedError as e:
@@ -122,7 +218,8 @@ async def main_ws():
         STT_WS_PORT, 
         max_size=8*2**20, 
         ping_interval=300,   # 5 минут
-        ping_timeout=None):  # Без таймаута
+        ping_timeout=None,   # Без таймаута
+        select_subprotocol=select_subprotocol):
         await asyncio.Future()  # run forever
 
 # Тестовая функция для прямого использования модуля
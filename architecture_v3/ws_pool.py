@@ -0,0 +1,214 @@
+# ws_pool.py
+import asyncio
+import itertools
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import websockets
+
+from ws_protocol import SUBPROTOCOL, FramedChannel, is_framed
+
+T = TypeVar("T")
+
+# Сколько одновременных соединений держать к каждому сервису
+try:
+    WS_POOL_SIZE = int(os.getenv("WS_POOL_SIZE", "2"))
+except (ValueError, TypeError):
+    WS_POOL_SIZE = 2
+
+try:
+    WS_CONNECT_TIMEOUT = float(os.getenv("WS_CONNECT_TIMEOUT", "5"))
+except (ValueError, TypeError):
+    WS_CONNECT_TIMEOUT = 5.0
+
+# Предлагать сервисам протокол magus.v1 (см. ws_protocol.py)
+WS_FRAMED = os.getenv("WS_FRAMED", "true").lower() == "true"
+
+
+class WSConnectionPool:
+    """
+    Пул постоянных WebSocket-соединений к одному сервису (STT или TTS).
+    Серверы отвечают на запросы строго по порядку, поэтому соединение
+    выдаётся одному запросу целиком; параллельные запросы идут по разным
+    соединениям пула. Каждому запросу присваивается id. Соединение, на котором
+    запрос оборвался посередине ответа, закрывается, а не возвращается в пул.
+    Если сервер закрыл простаивающее соединение, запрос повторяется на новом -
+    handler целиком, поэтому только для idempotent=True. Handler с побочными
+    эффектами (например, пересылающий аудио клиенту) передаёт idempotent=False
+    и получает ConnectionClosed сам.
+
+    Если сервер согласился на magus.v1, все запросы идут по одному соединению
+    одновременно (FramedChannel), а handler получает FramedRequest вместо ws.
+    Недочитанный ответ тогда не портит соединение: сервер получает CANCEL.
+    """
+
+    def __init__(self, name: str, uri: str, size: int = WS_POOL_SIZE, max_size: int = 8 * 2**20,
+                 connect_timeout: float = WS_CONNECT_TIMEOUT, framed: bool = WS_FRAMED):
+        self.name = name
+        self.uri = uri
+        self.size = max(1, size)
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.framed = framed
+        self._channel: Optional[FramedChannel] = None
+        self._channel_lock: Optional[asyncio.Lock] = None
+        self._idle = deque()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = None
+        self._ids = itertools.count(1)
+        self.stats = {"requests": 0, "connects": 0, "reconnects": 0, "failures": 0, "discarded": 0}
+        self._waits = deque(maxlen=500)
+
+    def _bind_loop(self):
+        # CLI и сервер запускаются через asyncio.run: соединения чужого цикла не переиспользуем
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._idle.clear()
+            self._slots = asyncio.Semaphore(self.size)
+            self._channel = None
+            self._channel_lock = asyncio.Lock()
+
+    async def _connect(self):
+        ws = await asyncio.wait_for(
+            websockets.connect(self.uri, max_size=self.max_size, ping_interval=None,
+                               subprotocols=[SUBPROTOCOL] if self.framed else None),
+            timeout=self.connect_timeout,
+        )
+        self.stats["connects"] += 1
+        return ws
+
+    def _take_idle(self):
+        while self._idle:
+            ws = self._idle.pop()
+            if ws.close_code is None:
+                return ws
+        return None
+
+    async def _open_channel(self) -> Optional[FramedChannel]:
+        """Общее соединение magus.v1; None, если сервер говорит только по-старому"""
+        async with self._channel_lock:
+            if not self.framed:
+                return None
+            if self._channel is not None and self._channel.alive:
+                return self._channel
+            if self._channel is not None:
+                self.stats["discarded"] += 1
+                await self._channel.close()
+                self._channel = None
+            ws = await self._connect()
+            if not is_framed(ws):
+                print(f"[WS POOL] {self.name}: сервер не поддерживает {SUBPROTOCOL}, старый протокол")
+                self.framed = False
+                self._idle.append(ws)
+                return None
+            self._channel = FramedChannel(ws)
+            return self._channel
+
+    async def _request_framed(self, channel: FramedChannel, handler: Callable[[object, int], Awaitable[T]],
+                              request_id: int, idempotent: bool) -> T:
+        for attempt in range(2):
+            request = channel.open(request_id)
+            completed = False
+            try:
+                result = await handler(request, request_id)
+                completed = True
+                return result
+            except websockets.exceptions.ConnectionClosed:
+                # Соединение умерло - один раз повторяем на новом
+                if idempotent and attempt == 0:
+                    self.stats["reconnects"] += 1
+                    channel = await self._open_channel()
+                    if channel is not None:
+                        continue
+                self.stats["failures"] += 1
+                raise
+            except BaseException:
+                self.stats["failures"] += 1
+                raise
+            finally:
+                await request.channel.release(request, completed)
+
+    async def request(self, handler: Callable[[object, int], Awaitable[T]], idempotent: bool = True) -> T:
+        """Выполняет handler(ws, request_id) на соединении из пула"""
+        self._bind_loop()
+        request_id = next(self._ids)
+        self.stats["requests"] += 1
+
+        if self.framed:
+            channel = await self._open_channel()
+            if channel is not None:
+                return await self._request_framed(channel, handler, request_id, idempotent)
+
+        wait_start = time.perf_counter()
+        async with self._slots:
+            self._waits.append(time.perf_counter() - wait_start)
+            for attempt in range(2):
+                ws = self._take_idle()
+                reused = ws is not None
+                if ws is None:
+                    ws = await self._connect()
+                try:
+                    result = await handler(ws, request_id)
+                except websockets.exceptions.ConnectionClosed:
+                    await self._discard(ws)
+                    # Сервер мог закрыть простаивающее соединение - повторяем один раз на новом
+                    if idempotent and reused and attempt == 0:
+                        self.stats["reconnects"] += 1
+                        continue
+                    self.stats["failures"] += 1
+                    raise
+                except BaseException:
+                    # Ответ мог остаться недочитанным - такое соединение больше не годится
+                    self.stats["failures"] += 1
+                    await self._discard(ws)
+                    raise
+                self._idle.append(ws)
+                return result
+
+    async def _discard(self, ws):
+        self.stats["discarded"] += 1
+        try:
+            await ws.close()
+        except Exception:
+            pass
+
+    async def warm(self, count: int = 1):
+        """Заранее открывает соединения, чтобы первый запрос не платил за рукопожатие"""
+        self._bind_loop()
+        if self.framed:
+            try:
+                if await self._open_channel() is not None:
+                    return
+            except Exception as e:
+                print(f"[WS POOL] {self.name}: не удалось открыть соединение: {e}")
+                return
+        for _ in range(min(count, self.size) - len(self._idle)):
+            try:
+                self._idle.append(await self._connect())
+            except Exception as e:
+                print(f"[WS POOL] {self.name}: не удалось открыть соединение: {e}")
+                break
+
+    async def close(self):
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
+        while self._idle:
+            await self._discard(self._idle.pop())
+
+    def get_stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            **self.stats,
+            "idle": len(self._idle),
+            "framed": self._channel is not None and self._channel.alive,
+            "inflight": len(self._channel.requests) if self._channel is not None else 0,
+            "size": self.size,
+            "wait_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+            "wait_p95": round(waits[max(0, math.ceil(0.95 * len(waits)) - 1)], 4) if waits else 0.0,
+            "wait_max": round(waits[-1], 4) if waits else 0.0,
+        }
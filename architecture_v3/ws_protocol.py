@@ -0,0 +1,307 @@
+# ws_protocol.py
+"""
+Бинарный протокол magus.v1 для агента, STT, TTS и mic_client.
+
+Клиент предлагает его при подключении как WebSocket-подпротокол; если сервер
+его не выбрал (старая версия), обе стороны продолжают говорить по-старому
+строками "END", "BUSY", "AUDIO_CHUNKS_BEGIN" и т.д.
+
+Каждое сообщение - один бинарный WebSocket-фрейм:
+    version u8 | type u8 | flags u8 | reserved u8 | request_id u32 | stream_id u32 | headers_len u16
+    | заголовки (headers_len байт) | полезная нагрузка (до конца сообщения)
+Заголовок: key_len u8 | key (UTF-8) | tag u8 | value_len u16 | value.
+Список - подряд идущие элементы tag u8 | value_len u16 | value, поэтому
+элементы сохраняют тип ([16000, 22050] так и приходит списком чисел).
+
+request_id связывает кадры одного запроса, поэтому по одному соединению
+может идти несколько запросов одновременно. stream_id нумерует аудиопотоки
+внутри ответа (например, предложения), 0 - ответ целиком.
+"""
+import asyncio
+import struct
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import websockets
+
+SUBPROTOCOL = "magus.v1"
+VERSION = 1
+
+
+class MsgType(IntEnum):
+    HELLO = 1        # возможности клиента: site_id, audio_formats, ...
+    REQUEST = 2      # начало запроса, параметры в заголовках
+    AUDIO = 3        # кусок аудио запроса или ответа
+    END = 4          # конец ввода запроса / конец аудиопотока / конец ответа (stream_id 0)
+    TEXT = 5         # текст (гипотеза STT); FLAG_FINAL - окончательный
+    AUDIO_START = 6  # начало аудиопотока ответа: format, sample_rate, channels
+    ERROR = 7        # заголовок message
+    BUSY = 8
+    ACK = 9
+    CANCEL = 10      # клиент больше не ждёт ответа на запрос
+
+
+FLAG_FINAL = 0x01
+
+_HEADER = struct.Struct("!BBBBIIH")
+_FIELD = struct.Struct("!BH")
+
+_TAG_INT, _TAG_FLOAT, _TAG_STR, _TAG_BOOL, _TAG_BYTES, _TAG_LIST = range(1, 7)
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+@dataclass
+class Frame:
+    type: MsgType
+    request_id: int = 0
+    stream_id: int = 0
+    headers: Dict[str, Any] = field(default_factory=dict)
+    payload: bytes = b""
+    flags: int = 0
+
+
+def _encode_value(value) -> tuple:
+    # bool проверяется раньше int: bool - подкласс int
+    if isinstance(value, bool):
+        return _TAG_BOOL, b"\x01" if value else b"\x00"
+    if isinstance(value, int):
+        return _TAG_INT, struct.pack("!q", value)
+    if isinstance(value, float):
+        return _TAG_FLOAT, struct.pack("!d", value)
+    if isinstance(value, str):
+        return _TAG_STR, value.encode("utf-8")
+    if isinstance(value, (bytes, bytearray)):
+        return _TAG_BYTES, bytes(value)
+    if isinstance(value, (list, tuple)):
+        items = bytearray()
+        for item in value:
+            tag, raw = _encode_value(item)
+            items += _FIELD.pack(tag, len(raw)) + raw
+        return _TAG_LIST, bytes(items)
+    raise ProtocolError(f"Неподдерживаемый тип заголовка: {type(value).__name__}")
+
+
+def _decode_value(tag: int, raw: bytes):
+    if tag == _TAG_BOOL:
+        return raw != b"\x00"
+    if tag == _TAG_INT:
+        return struct.unpack("!q", raw)[0]
+    if tag == _TAG_FLOAT:
+        return struct.unpack("!d", raw)[0]
+    if tag == _TAG_STR:
+        return raw.decode("utf-8")
+    if tag == _TAG_BYTES:
+        return raw
+    if tag == _TAG_LIST:
+        items = []
+        offset = 0
+        while offset < len(raw):
+            item_tag, item_len = _FIELD.unpack_from(raw, offset)
+            offset += _FIELD.size
+            if offset + item_len > len(raw):
+                raise ProtocolError("Элемент списка выходит за пределы заголовка")
+            items.append(_decode_value(item_tag, raw[offset:offset + item_len]))
+            offset += item_len
+        return items
+    raise ProtocolError(f"Неизвестный тип заголовка: {tag}")
+
+
+def encode_frame(frame: Frame) -> bytes:
+    headers = bytearray()
+    for key, value in frame.headers.items():
+        if value is None:
+            continue
+        key_bytes = key.encode("utf-8")
+        tag, raw = _encode_value(value)
+        if len(key_bytes) > 255 or len(raw) > 0xFFFF:
+            raise ProtocolError(f"Слишком длинный заголовок: {key}")
+        headers += bytes([len(key_bytes)]) + key_bytes + _FIELD.pack(tag, len(raw)) + raw
+    if len(headers) > 0xFFFF:
+        raise ProtocolError("Слишком большие заголовки")
+    return b"".join((
+        _HEADER.pack(VERSION, int(frame.type), frame.flags, 0, frame.request_id, frame.stream_id, len(headers)),
+        bytes(headers),
+        frame.payload,
+    ))
+
+
+def decode_frame(data: bytes) -> Frame:
+    """Любой некорректный кадр (обрезанный, битый UTF-8 и т.п.) - ProtocolError"""
+    try:
+        return _decode_frame(data)
+    except ProtocolError:
+        raise
+    except (struct.error, UnicodeDecodeError, IndexError, ValueError) as e:
+        raise ProtocolError(f"Некорректный кадр: {e}")
+
+
+def _decode_frame(data: bytes) -> Frame:
+    if not isinstance(data, (bytes, bytearray)) or len(data) < _HEADER.size:
+        raise ProtocolError("Кадр короче заголовка")
+    version, msg_type, flags, _, request_id, stream_id, headers_len = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ProtocolError(f"Неподдерживаемая версия протокола: {version}")
+    try:
+        msg_type = MsgType(msg_type)
+    except ValueError:
+        raise ProtocolError(f"Неизвестный тип сообщения: {msg_type}")
+    end = _HEADER.size + headers_len
+    if end > len(data):
+        raise ProtocolError("Заголовки выходят за пределы кадра")
+
+    headers = {}
+    offset = _HEADER.size
+    while offset < end:
+        key_len = data[offset]
+        key = bytes(data[offset + 1:offset + 1 + key_len]).decode("utf-8")
+        offset += 1 + key_len
+        tag, value_len = _FIELD.unpack_from(data, offset)
+        offset += _FIELD.size
+        if offset + value_len > end:
+            raise ProtocolError(f"Заголовок {key} выходит за пределы кадра")
+        headers[key] = _decode_value(tag, bytes(data[offset:offset + value_len]))
+        offset += value_len
+    return Frame(msg_type, request_id, stream_id, headers, bytes(data[end:]), flags)
+
+
+def is_framed(ws) -> bool:
+    return getattr(ws, "subprotocol", None) == SUBPROTOCOL
+
+
+def select_subprotocol(connection, subprotocols) -> Optional[str]:
+    """Для websockets.serve: magus.v1, если клиент его предложил; иначе старый протокол"""
+    return SUBPROTOCOL if SUBPROTOCOL in subprotocols else None
+
+
+async def send_frame(ws, msg_type: MsgType, request_id: int = 0, stream_id: int = 0,
+                     headers: Optional[Dict[str, Any]] = None, payload: bytes = b"", flags: int = 0):
+    await ws.send(encode_frame(Frame(msg_type, request_id, stream_id, headers or {}, payload, flags)))
+
+
+class FramedRequest:
+    """Один запрос внутри мультиплексированного соединения"""
+
+    def __init__(self, channel: "FramedChannel", request_id: int):
+        self.channel = channel
+        self.request_id = request_id
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def send(self, msg_type: MsgType, headers: Optional[Dict[str, Any]] = None, payload: bytes = b"",
+                   stream_id: int = 0, flags: int = 0):
+        await send_frame(self.channel.ws, msg_type, self.request_id, stream_id, headers, payload, flags)
+
+    async def recv(self) -> Frame:
+        item = await self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+class FramedChannel:
+    """
+    Клиентская сторона magus.v1: одно соединение, несколько запросов сразу.
+    Фоновый читатель раскладывает кадры по request_id; кадры запросов,
+    которые уже никто не ждёт, отбрасываются.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.requests: Dict[int, FramedRequest] = {}
+        self._reader = asyncio.create_task(self._read())
+
+    @property
+    def alive(self) -> bool:
+        return not self._reader.done()
+
+    def open(self, request_id: int) -> FramedRequest:
+        request = FramedRequest(self, request_id)
+        self.requests[request_id] = request
+        return request
+
+    async def release(self, request: FramedRequest, completed: bool = True):
+        """Запрос закончен; если ответ не дочитан - просим сервер его бросить"""
+        self.requests.pop(request.request_id, None)
+        if not completed and self.alive:
+            try:
+                await request.send(MsgType.CANCEL)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    async def _read(self):
+        error: BaseException = websockets.exceptions.ConnectionClosedError(None, None)
+        try:
+            async for message in self.ws:
+                try:
+                    frame = decode_frame(message)
+                except ProtocolError as e:
+                    print(f"[WS PROTO] Некорректный кадр: {e}")
+                    continue
+                request = self.requests.get(frame.request_id)
+                if request is not None:
+                    request.queue.put_nowait(frame)
+        except websockets.exceptions.ConnectionClosed as e:
+            error = e
+        finally:
+            for request in self.requests.values():
+                request.queue.put_nowait(error)
+
+    async def close(self):
+        await self.ws.close()
+        await asyncio.gather(self._reader, return_exceptions=True)
+
+
+class ServerRequest:
+    """Серверная сторона одного запроса magus.v1: первый кадр и последующие кадры того же request_id"""
+
+    def __init__(self, ws, first: Frame):
+        self.ws = ws
+        self.request_id = first.request_id
+        self.first = first
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    async def send(self, msg_type: MsgType, headers: Optional[Dict[str, Any]] = None, payload: bytes = b"",
+                   stream_id: int = 0, flags: int = 0):
+        await send_frame(self.ws, msg_type, self.request_id, stream_id, headers, payload, flags)
+
+    async def recv(self) -> Frame:
+        return await self.queue.get()
+
+
+async def serve_framed(ws, handle_request: Callable[[ServerRequest], Awaitable[None]]):
+    """
+    Цикл сервера magus.v1: каждый новый request_id обрабатывается своей задачей,
+    поэтому запросы одного соединения не ждут друг друга. CANCEL снимает задачу.
+    """
+    tasks: Dict[int, asyncio.Task] = {}
+    requests: Dict[int, ServerRequest] = {}
+
+    def done(request_id: int):
+        tasks.pop(request_id, None)
+        requests.pop(request_id, None)
+
+    try:
+        async for message in ws:
+            try:
+                frame = decode_frame(message)
+            except ProtocolError as e:
+                await send_frame(ws, MsgType.ERROR, headers={"message": str(e)})
+                continue
+            if frame.type == MsgType.CANCEL:
+                task = tasks.get(frame.request_id)
+                if task:
+                    task.cancel()
+                continue
+            request = requests.get(frame.request_id)
+            if request is not None:
+                request.queue.put_nowait(frame)
+                continue
+            request = requests[frame.request_id] = ServerRequest(ws, frame)
+            task = tasks[frame.request_id] = asyncio.create_task(handle_request(request))
+            task.add_done_callback(lambda _, request_id=frame.request_id: done(request_id))
+    finally:
+        for task in list(tasks.values()):
+            task.cancel()